@@ -0,0 +1,104 @@
+"""
+Benchmarks of the speed and compression ratio of each codec (see
+splitvar.compression) writing synthetic MOM and CICE datasets (see
+benchmarks.datasets). Run with asv, or directly with
+
+    python -m benchmarks.compression --model mom --nfiles 4
+
+to print a table of time, throughput and ratio for each codec.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import splitvar.cli
+from splitvar import outputsize
+
+from .datasets import MODELS, datasize, generate
+from .stages import CONFIG, options
+
+# Codecs and levels compared, as given to --codec
+CODEC_SPECS = ['zlib:1', 'zlib:5', 'zstd:1', 'zstd:3', 'zstd:9', 'blosc-lz4:5', 'blosc-zstd:3', 'none']
+
+def writecodec(paths, model, codec, outdir):
+    """
+    Split paths with codec, returning the total size of the outputs
+    """
+    splitvar.cli.main_parse_args(options(model, outdir) + ['--codec', codec] + paths)
+    return sum(outputsize(os.path.join(root, name)) for root, dirs, names in os.walk(outdir) for name in names)
+
+class Codecs(object):
+
+    params = (list(MODELS), CODEC_SPECS)
+    param_names = ['model', 'codec']
+    timeout = 600
+
+    def setup_cache(self):
+        return {model: [os.path.abspath(p) for p in generate(os.path.join('data', model), model, **CONFIG[model])]
+                for model in MODELS}
+
+    def setup(self, paths, model, codec):
+        self.paths = paths[model]
+        self.outdir = tempfile.mkdtemp()
+
+    def teardown(self, paths, model, codec):
+        shutil.rmtree(self.outdir, ignore_errors=True)
+
+    def time_write(self, paths, model, codec):
+        writecodec(self.paths, model, codec, self.outdir)
+
+    def track_ratio(self, paths, model, codec):
+        return datasize(self.paths, CONFIG[model]['nvars']) / writecodec(self.paths, model, codec, self.outdir)
+
+    track_ratio.unit = 'ratio'
+
+def runcodec(paths, model, codec, outdir):
+    """
+    Split paths with codec and return the time taken and the size of the outputs
+    """
+    start = time.perf_counter()
+    size = writecodec(paths, model, codec, outdir)
+    return time.perf_counter() - start, size
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare compression codecs splitting a synthetic dataset')
+    parser.add_argument('--model', choices=MODELS, default='mom')
+    parser.add_argument('--nfiles', type=int)
+    parser.add_argument('--ntime', type=int, help='Time steps in each file')
+    parser.add_argument('--nx', type=int)
+    parser.add_argument('--ny', type=int)
+    parser.add_argument('--nvars', type=int)
+    parser.add_argument('--codec', dest='codecs', action='append',
+                        help='Codec to compare, as given to splitvar --codec. Use more than once for multiple codecs (default=all)')
+    args = parser.parse_args()
+
+    config = dict(CONFIG[args.model])
+    for option in ('nfiles', 'ntime', 'nx', 'ny', 'nvars'):
+        if getattr(args, option) is not None:
+            config[option] = getattr(args, option)
+
+    # Inputs are uncompressed, so chunks are never copied from them and
+    # every codec does the same work
+    context = multiprocessing.get_context('spawn')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with context.Pool(1) as pool:
+            paths = pool.apply(generate, (os.path.join(tmpdir, 'data'), args.model), dict(config, complevel=0))
+        size = datasize(paths, config['nvars'])
+        print('{} files, {:.1f} MB of data'.format(len(paths), size / 2**20))
+        print('{:>14} {:>10} {:>10} {:>8}'.format('codec', 'time (s)', 'MB/s', 'ratio'))
+        for codec in args.codecs or CODEC_SPECS:
+            outdir = os.path.join(tmpdir, 'output')
+            with context.Pool(1) as pool:
+                elapsed, written = pool.apply(runcodec, (paths, args.model, codec, outdir))
+            shutil.rmtree(outdir)
+            print('{:>14} {:10.3f} {:10.1f} {:8.2f}'.format(codec, elapsed, size / 2**20 / elapsed, size / written))
+    finally:
+        shutil.rmtree(tmpdir)
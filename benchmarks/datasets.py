@@ -0,0 +1,299 @@
+"""
+Generate synthetic multi-file datasets resembling MOM ocean and CICE sea ice
+model output, as in the ocean_daily.nc and iceh.*.nc examples in the README,
+for benchmarking. Run directly to write a dataset, e.g.
+
+    python -m benchmarks.datasets --model cice --nfiles 12 bench_data
+
+Fields are smooth in space and vary smoothly in time, around a climatology
+with a seasonal cycle, and are masked over land (and CICE fields are zero
+away from the ice), so they compress and decode like model output.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+
+import cftime
+import numpy as np
+import xarray as xr
+
+MODELS = ('mom', 'cice')
+
+# Variable names and units of typical diagnostics, extra variables are
+# numbered after these
+MOM_VARIABLES = [('surface_temp', 'deg_C', 'Conservative temperature'),
+                 ('eta_t', 'meter', 'surface height on T cells'),
+                 ('mld', 'm', 'mixed layer depth determined by density criteria'),
+                 ('surface_salt', 'psu', 'Practical Salinity'),
+                 ('sea_level', 'm', 'effective sea level (eta_t + patm/(rho0*g)) on T cells')]
+CICE_VARIABLES = [('aice_m', '1', 'ice area  (aggregate)'),
+                  ('hi_m', 'm', 'grid cell mean ice thickness'),
+                  ('hs_m', 'm', 'grid cell mean snow thickness'),
+                  ('Tsfc_m', 'C', 'snow/ice surface temperature'),
+                  ('uvel_m', 'm/s', 'ice velocity (x)')]
+
+# Climatology of MOM variables, (polar mean, equator to pole difference,
+# seasonal amplitude, anomaly amplitude, minimum). Extra variables use the
+# last entry
+MOM_CLIMATOLOGY = {'surface_temp': (-1., 29., 3., 1., -1.8),
+                   'eta_t': (-1., 1.5, 0.1, 0.2, None),
+                   'mld': (250., -230., 40., 15., 10.),
+                   'surface_salt': (34., 1.5, 0.2, 0.3, None),
+                   'sea_level': (-0.9, 1.5, 0.1, 0.2, None),
+                   None: (0., 1., 0.5, 1., None)}
+
+# Missing values over land, as written by each model
+MISSING_VALUE = {'mom': np.float32(-1e20), 'cice': np.float32(1e30)}
+
+# Length scale in grid cells of the patterns of anomalies, and periods in
+# days of their variations
+ANOMALY_SCALE = 8
+ANOMALY_PERIODS = (7., 23., 71., 365.)
+
+# Relative amplitude of noise at the grid scale
+GRID_NOISE = 0.02
+
+def variablenames(model, nvars):
+    """
+    Return a list of nvars (name, units, long_name) for model
+    """
+    known = MOM_VARIABLES if model == 'mom' else CICE_VARIABLES
+    extra = [('field{:03d}'.format(i), '1', 'diagnostic field {}'.format(i))
+             for i in range(len(known), nvars)]
+    return (known + extra)[:nvars]
+
+def timeaxis(nsteps, freq, calendar, units, start='0001-01-01'):
+    """
+    Return the encoded start and end of nsteps periods of length freq
+    (pandas frequency string, e.g. D or MS)
+    """
+    dates = xr.cftime_range(start=start, periods=nsteps + 1, freq=freq, calendar=calendar)
+    edges = cftime.date2num(list(dates), units, calendar=calendar)
+    return edges[:-1], edges[1:]
+
+def grid(nx, ny):
+    """
+    Return 1D longitude and latitude, and 2D longitude and latitude arrays
+    for a regular global grid
+    """
+    lon = np.linspace(-280., 80., nx, endpoint=False) + 180. / nx
+    lat = np.linspace(-78., 90., ny, endpoint=False) + 84. / ny
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    return lon, lat, lon2d.astype('f4'), lat2d.astype('f4')
+
+def smoothnoise(shape, scale, rng):
+    """
+    Return random noise of unit variance smoothed with a gaussian of width
+    scale grid cells. The noise is periodic, like a global grid
+    """
+    ky = np.fft.fftfreq(shape[0])[:, None]
+    kx = np.fft.rfftfreq(shape[1])[None, :]
+    response = np.exp(-2. * (np.pi * scale)**2 * (kx**2 + ky**2))
+    noise = np.fft.irfft2(np.fft.rfft2(rng.standard_normal(shape)) * response, s=shape)
+    return noise / noise.std()
+
+def anomalies(times, shape, seed):
+    """
+    Return anomalies of unit variance at times (in days) on a grid of shape,
+    the sum of random smooth patterns each varying sinusoidally with one of
+    ANOMALY_PERIODS, plus a little noise at the grid scale. The patterns
+    only depend on seed, so datasets written separately continue each other
+    """
+    rng = np.random.default_rng(seed)
+    field = np.zeros((len(times),) + shape, dtype='f4')
+    for period in ANOMALY_PERIODS:
+        pattern = smoothnoise(shape, ANOMALY_SCALE, rng)
+        phase = rng.uniform(0., 2. * np.pi)
+        field += np.cos(2. * np.pi * times / period + phase).astype('f4')[:, None, None] * pattern.astype('f4')
+    field *= np.sqrt(2. / len(ANOMALY_PERIODS))
+    noise = np.random.default_rng(np.append(seed, int(times[0])))
+    field += GRID_NOISE * noise.standard_normal(field.shape, dtype='f4')
+    return field
+
+def seasonal(times, lat2d):
+    """
+    Return the seasonal cycle at times (in days) and latitudes lat2d,
+    warmest in February in the south and August in the north
+    """
+    phase = np.cos(2. * np.pi * (times - 45.) / 365.)
+    return -phase[:, None, None] * np.sign(lat2d) * np.abs(lat2d / 90.)**0.5
+
+def landmask(lat2d, seed):
+    """
+    Return True over land: about a quarter of the grid in smooth continents,
+    and Antarctica south of 70S
+    """
+    continents = smoothnoise(lat2d.shape, 4 * ANOMALY_SCALE, np.random.default_rng(seed))
+    return (continents > 0.7) | (lat2d < -70.)
+
+def mom_dataset(start, end, nx, ny, nvars, calendar, units, seed=0):
+    """
+    Return a dataset resembling MOM5 ocean output, with time at the middle
+    of each period and time bounds and averaging information
+    """
+    lon, lat, lon2d, lat2d = grid(nx, ny)
+    times = (start + end) / 2.
+    land = landmask(lat2d, seed)
+    season = seasonal(times, lat2d)
+    dims = ('time', 'yt_ocean', 'xt_ocean')
+    variables = {
+        'xt_ocean': xr.IndexVariable('xt_ocean', lon, {'long_name': 'tcell longitude', 'units': 'degrees_E', 'cartesian_axis': 'X'}),
+        'yt_ocean': xr.IndexVariable('yt_ocean', lat, {'long_name': 'tcell latitude', 'units': 'degrees_N', 'cartesian_axis': 'Y'}),
+        'time': xr.IndexVariable('time', (start + end) / 2., {'long_name': 'time', 'units': units, 'cartesian_axis': 'T',
+                                                               'calendar_type': calendar.upper(), 'calendar': calendar.upper(),
+                                                               'bounds': 'time_bounds'}),
+        'nv': xr.IndexVariable('nv', [1., 2.], {'long_name': 'vertex number', 'units': 'none', 'cartesian_axis': 'N'}),
+        'geolon_t': xr.Variable(dims[1:], lon2d, {'long_name': 'tracer longitude', 'units': 'degrees_E'}),
+        'geolat_t': xr.Variable(dims[1:], lat2d, {'long_name': 'tracer latitude', 'units': 'degrees_N'}),
+        'area_t': xr.Variable(dims[1:], np.full((ny, nx), 1e10, dtype='f4'), {'long_name': 'tracer cell area', 'units': 'm^2'}),
+        'average_T1': xr.Variable('time', start, {'long_name': 'Start time for average period', 'units': units}),
+        'average_T2': xr.Variable('time', end, {'long_name': 'End time for average period', 'units': units}),
+        'average_DT': xr.Variable('time', end - start, {'long_name': 'Length of average period', 'units': 'days'}),
+        'time_bounds': xr.Variable(('time', 'nv'), np.stack([start, end], axis=1), {'long_name': 'time axis boundaries', 'units': 'days'}),
+    }
+    for i, (name, varunits, long_name) in enumerate(variablenames('mom', nvars)):
+        mean, gradient, seasonality, variability, minimum = MOM_CLIMATOLOGY.get(name, MOM_CLIMATOLOGY[None])
+        data = mean + gradient * np.cos(np.radians(lat2d))**2 + seasonality * season
+        data = (data + variability * anomalies(times, (ny, nx), [seed, i + 1])).astype('f4')
+        if minimum is not None:
+            np.maximum(data, minimum, out=data)
+        data[:, land] = np.nan
+        variables[name] = xr.Variable(dims, data, {
+            'long_name': long_name,
+            'units': varunits,
+            'missing_value': MISSING_VALUE['mom'],
+            'cell_methods': 'time: mean',
+            'time_avg_info': 'average_T1,average_T2,average_DT',
+            'coordinates': 'geolon_t geolat_t',
+            'standard_name': name,
+        })
+    return xr.Dataset(variables, attrs={'filename': 'ocean_daily.nc', 'title': 'ACCESS-OM2', 'grid_type': 'mosaic'})
+
+def icefields(times, lat2d, seed):
+    """
+    Return the ice concentration at times (in days) and latitudes lat2d,
+    zero away from the ice edge at about 60 degrees, which moves with the
+    seasons, and a thickness scale, largest at the poles
+    """
+    edge = 62. + 8. * seasonal(times, lat2d) + 2. * anomalies(times, lat2d.shape, seed)
+    aice = np.clip((np.abs(lat2d) - edge) / 6., 0., 1.)
+    thickness = 1. + 2. * np.clip((np.abs(lat2d) - 60.) / 30., 0., 1.)
+    return aice.astype('f4'), thickness
+
+def cice_dataset(start, end, nx, ny, nvars, calendar, units, seed=0):
+    """
+    Return a dataset resembling CICE sea ice output, with time at the end
+    of each period and time bounds
+    """
+    lon, lat, lon2d, lat2d = grid(nx, ny)
+    times = (start + end) / 2.
+    land = landmask(lat2d, seed)
+    aice, thickness = icefields(times, lat2d, [seed, 0])
+    dims = ('time', 'nj', 'ni')
+    variables = {
+        'time': xr.IndexVariable('time', end, {'long_name': 'model time', 'units': units,
+                                               'calendar': calendar, 'bounds': 'time_bounds'}),
+        'time_bounds': xr.Variable(('time', 'd2'), np.stack([start, end], axis=1), {'long_name': 'boundaries for time-averaging interval', 'units': units}),
+        'TLON': xr.Variable(dims[1:], lon2d, {'long_name': 'T grid center longitude', 'units': 'degrees_east'}),
+        'TLAT': xr.Variable(dims[1:], lat2d, {'long_name': 'T grid center latitude', 'units': 'degrees_north'}),
+        'ULON': xr.Variable(dims[1:], lon2d + 180. / nx, {'long_name': 'U grid center longitude', 'units': 'degrees_east'}),
+        'ULAT': xr.Variable(dims[1:], lat2d + 84. / ny, {'long_name': 'U grid center latitude', 'units': 'degrees_north'}),
+        'tarea': xr.Variable(dims[1:], np.full((ny, nx), 1e10, dtype='f4'), {'long_name': 'area of T grid cells', 'units': 'm^2', 'coordinates': 'TLON TLAT'}),
+        'uarea': xr.Variable(dims[1:], np.full((ny, nx), 1e10, dtype='f4'), {'long_name': 'area of U grid cells', 'units': 'm^2', 'coordinates': 'ULON ULAT'}),
+    }
+    for i, (name, varunits, long_name) in enumerate(variablenames('cice', nvars)):
+        grid_point = 'U' if name.startswith('uvel') else 'T'
+        variability = anomalies(times, (ny, nx), [seed, i + 1])
+        if name == 'aice_m':
+            data = aice
+        elif name == 'hi_m':
+            data = aice * thickness * np.maximum(1. + 0.2 * variability, 0.)
+        elif name == 'hs_m':
+            data = aice * 0.1 * thickness * np.maximum(1. + 0.3 * variability, 0.)
+        elif name == 'Tsfc_m':
+            data = np.where(aice > 0, np.minimum(-2. - 25. * aice * (thickness - 1.) / 2. + variability, 0.), -1.8)
+        else:
+            data = aice * 0.1 * variability
+        data = np.array(data, dtype='f4')
+        data[:, land] = np.nan
+        variables[name] = xr.Variable(dims, data, {
+            'long_name': long_name,
+            'units': varunits,
+            'coordinates': '{0}LON {0}LAT time'.format(grid_point),
+            'cell_measures': 'area: {}area'.format(grid_point.lower()),
+            'cell_methods': 'time: mean',
+            'time_rep': 'averaged',
+            'missing_value': MISSING_VALUE['cice'],
+        })
+    return xr.Dataset(variables, attrs={'title': 'sea ice model output for CICE', 'source': 'Los Alamos Sea Ice Model (CICE)'})
+
+def generate(outdir, model='mom', nfiles=2, ntime=30, nx=360, ny=300, nvars=3,
+             calendar='noleap', freq='D', complevel=1, seed=0):
+    """
+    Write nfiles files of ntime steps of frequency freq for model (one of
+    MODELS) to outdir, on an nx by ny grid with nvars data variables. Data
+    variables are chunked by time step and compressed with complevel, or
+    uncompressed if complevel is 0, and land is filled with the missing
+    value of the model. Returns the list of files
+    """
+    if model not in MODELS:
+        raise ValueError('Unknown model {}, must be one of {}'.format(model, ', '.join(MODELS)))
+    os.makedirs(outdir, exist_ok=True)
+    units = 'days since 0001-01-01 00:00:00' if model == 'mom' else 'days since 1900-01-01 00:00:00'
+    startdate = '0001-01-01' if model == 'mom' else '2253-01-01'
+    start, end = timeaxis(nfiles * ntime, freq, calendar, units, startdate)
+
+    paths = []
+    for i in range(nfiles):
+        steps = slice(i * ntime, (i + 1) * ntime)
+        if model == 'mom':
+            ds = mom_dataset(start[steps], end[steps], nx, ny, nvars, calendar, units, seed)
+            path = os.path.join(outdir, 'ocean_daily_{:03d}.nc'.format(i))
+        else:
+            ds = cice_dataset(start[steps], end[steps], nx, ny, nvars, calendar, units, seed)
+            first = cftime.num2date(start[steps][0], units, calendar=calendar)
+            path = os.path.join(outdir, 'iceh.{:04d}-{:02d}.nc'.format(first.year, first.month) if ntime == 1
+                                        else 'iceh.{:04d}-{:02d}-{:02d}.nc'.format(first.year, first.month, first.day))
+        encoding = {}
+        for name, var in ds.data_vars.items():
+            encoding[name] = {'_FillValue': var.attrs.get('missing_value')}
+            if var.ndim == 3:
+                encoding[name]['chunksizes'] = (1,) + var.shape[1:]
+                if complevel > 0:
+                    encoding[name].update(zlib=True, shuffle=True, complevel=complevel)
+        for name in ds.coords:
+            encoding[name] = {'_FillValue': None}
+        ds.to_netcdf(path, unlimited_dims=['time'], encoding=encoding)
+        paths.append(path)
+    return paths
+
+def datasize(paths, nvars):
+    """
+    Return the uncompressed size in bytes of the data variables in paths
+    """
+    total = 0
+    for path in paths:
+        with xr.open_dataset(path, decode_cf=False) as ds:
+            total += sum(ds[v].nbytes for v in ds.data_vars if ds[v].ndim == 3)
+    return total
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Write a synthetic MOM or CICE dataset')
+    parser.add_argument('--model', choices=MODELS, default='mom')
+    parser.add_argument('--nfiles', type=int, default=2)
+    parser.add_argument('--ntime', type=int, default=30, help='Time steps in each file')
+    parser.add_argument('--nx', type=int, default=360)
+    parser.add_argument('--ny', type=int, default=300)
+    parser.add_argument('--nvars', type=int, default=3)
+    parser.add_argument('--calendar', default='noleap')
+    parser.add_argument('--freq', default='D', help='Time step frequency, e.g. D or MS')
+    parser.add_argument('--complevel', type=int, default=1, help='Deflate level, 0 for no compression')
+    parser.add_argument('outdir')
+    args = parser.parse_args()
+
+    paths = generate(args.outdir, args.model, args.nfiles, args.ntime, args.nx, args.ny, args.nvars,
+                     args.calendar, args.freq, args.complevel)
+    print('Wrote {} files, {:.1f} MB of data'.format(len(paths), datasize(paths, args.nvars) / 2**20))
@@ -0,0 +1,68 @@
+"""
+Benchmark of finding variable dependencies. Run with asv, or directly with
+
+    python -m benchmarks.dependencies
+
+to print the time taken for increasing numbers of variables. The time per
+variable should stay roughly constant, as the time taken scales linearly
+with the number of variables and attributes.
+"""
+
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import xarray as xr
+
+from splitvar import getdependents
+
+def make_dataset(nvars):
+    """
+    Return a dataset resembling atmosphere model output with nvars data 
+    variables, each with the usual CF attributes referring to coordinates,
+    bounds and cell measures. Arrays are tiny, as only attributes are used
+    """
+    variables = {
+        'time': xr.IndexVariable('time', [0.], {'units': 'days since 2000-01-01', 'bounds': 'time_bnds'}),
+        'lat': xr.IndexVariable('lat', [0.], {'units': 'degrees_north', 'bounds': 'lat_bnds'}),
+        'lon': xr.IndexVariable('lon', [0.], {'units': 'degrees_east', 'bounds': 'lon_bnds'}),
+        'nv': xr.IndexVariable('nv', [0, 1]),
+        'time_bnds': xr.Variable(('time', 'nv'), np.zeros((1, 2))),
+        'lat_bnds': xr.Variable(('lat', 'nv'), np.zeros((1, 2))),
+        'lon_bnds': xr.Variable(('lon', 'nv'), np.zeros((1, 2))),
+        'area': xr.Variable(('lat', 'lon'), np.zeros((1, 1)), {'units': 'm2'}),
+    }
+    for i in range(nvars):
+        variables['fld_s{:02d}i{:03d}_{}'.format(i // 1000, i % 1000, i)] = xr.Variable(('time', 'lat', 'lon'), np.zeros((1, 1, 1)), {
+            'long_name': 'field {} of the atmosphere model'.format(i),
+            'units': 'K',
+            'cell_methods': 'time: mean area: mean',
+            'cell_measures': 'area: area',
+            'coordinates': 'lat lon',
+            'um_stash_source': 'm01s{:02d}i{:03d}'.format(i // 1000, i % 1000),
+        })
+    # Construct from Variables in one step, as adding variables one at a
+    # time is very slow for large numbers of variables
+    return xr.Dataset(variables)
+
+class TimeGetDependents(object):
+
+    params = [500, 1000, 2000, 4000, 8000]
+    param_names = ['nvars']
+
+    def setup(self, nvars):
+        self.ds = make_dataset(nvars)
+
+    def time_getdependents(self, nvars):
+        getdependents(self.ds)
+
+if __name__ == '__main__':
+
+    print('{:>8} {:>10} {:>14}'.format('nvars', 'time (s)', 'per var (ms)'))
+    for nvars in TimeGetDependents.params:
+        ds = make_dataset(nvars)
+        start = time.perf_counter()
+        getdependents(ds)
+        elapsed = time.perf_counter() - start
+        print('{:8d} {:10.3f} {:14.3f}'.format(nvars, elapsed, 1000 * elapsed / nvars))
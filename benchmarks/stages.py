@@ -0,0 +1,204 @@
+"""
+Benchmarks of the stages of splitting synthetic MOM and CICE datasets (see
+benchmarks.datasets): finding dependencies, opening the inputs, splitting
+by time, aggregating and writing. The inputs are opened, chunked and 
+decoded with the same functions as splitvar.cli.main. Run with asv, or 
+directly with
+
+    python -m benchmarks.stages --model mom --nfiles 4
+
+to print the time, throughput and peak memory of each stage. Run directly
+each stage is run in a new process, so the peak memory is for that stage
+alone.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import dask
+
+import splitvar.cli
+from splitvar import (decodevars, findmatchingvars, getdependents, groupbytime, open_files,
+                      peakrss, resamplebytime, PeriodIndex)
+
+from .datasets import MODELS, datasize, generate, variablenames
+
+# Size of the datasets used with asv
+CONFIG = {
+    'mom': dict(nfiles=4, ntime=31, nx=360, ny=300, nvars=3, freq='D'),
+    'cice': dict(nfiles=12, ntime=1, nx=360, ny=300, nvars=3, freq='MS'),
+}
+
+# Output and aggregation frequencies for each model
+SPLIT_FREQUENCY = {'mom': 'MS', 'cice': 'YS'}
+AGGREGATE_FREQUENCY = {'mom': 'MS', 'cice': 'QS'}
+
+def datavars(model, nvars):
+    return [name for (name, units, long_name) in variablenames(model, nvars)]
+
+def options(model, outdir, aggregate=False):
+    """
+    Return the splitvar command line options used to split model, and to
+    aggregate it if aggregate is True
+    """
+    # Only the time taken is of interest, not the progress messages
+    args = ['--overwrite', '--log-level', 'warning', '--no-progress', '-f', SPLIT_FREQUENCY[model], '-o', outdir]
+    if model == 'cice':
+        args.append('--usebounds')
+    if aggregate:
+        args += ['--aggregate', AGGREGATE_FREQUENCY[model]]
+    return args
+
+def opendataset(paths, model, outdir, aggregate=False):
+    """
+    Open, chunk and decode paths as splitvar.cli.main does with the options
+    for model (see options), except the time coordinate isn't changed. 
+    Returns the dataset, the time coordinate, the arguments and the chunk
+    target
+    """
+    args = splitvar.cli.parse_args(options(model, outdir, aggregate) + paths)
+    first = open_files(paths[0], None, args.delvars, index=args.index)
+    timevar = findmatchingvars(first, matchstrings=[' since '], coords_only=True)[0]
+    chunktarget = dask.utils.parse_bytes(args.chunktarget)
+    ds = splitvar.cli.openinputs(paths, first, timevar, set(first.variables), args, chunktarget)
+    ds = splitvar.cli.alignchunks(ds, timevar, args, chunktarget)
+    ds = decodevars(ds, timevar, splitvar.cli.changedvars(ds, args))
+    return splitvar.cli.loadtimes(ds), timevar, args, chunktarget
+
+def stage_getdependents(paths, model, nvars, outdir):
+    getdependents(open_files(paths[0], None))
+
+def stage_open(paths, model, nvars, outdir):
+    opendataset(paths, model, outdir)
+
+def stage_split(paths, model, nvars, outdir):
+    ds, timevar, args, chunktarget = opendataset(paths, model, outdir)
+    periods = PeriodIndex(ds[timevar], args.frequency)
+    for var in datavars(model, nvars):
+        for dsbytime in groupbytime(ds[[var]], args.frequency, timevar, periods):
+            dsbytime[var].values
+
+def stage_aggregate(paths, model, nvars, outdir):
+    ds, timevar, args, chunktarget = opendataset(paths, model, outdir, aggregate=True)
+    resamplebytime(ds, datavars(model, nvars), args.aggregate, timedim=timevar, 
+                   statistics=args.statistics, chunksize=chunktarget).compute()
+
+def stage_write(paths, model, nvars, outdir):
+    splitvar.cli.main_parse_args(options(model, outdir) + paths)
+
+STAGES = {
+    'getdependents': stage_getdependents,
+    'open': stage_open,
+    'split': stage_split,
+    'aggregate': stage_aggregate,
+    'write': stage_write,
+}
+
+# Stages which read all the data, for which throughput is reported
+DATA_STAGES = ('split', 'aggregate', 'write')
+
+class Stages(object):
+
+    params = list(MODELS)
+    param_names = ['model']
+    timeout = 600
+
+    def setup_cache(self):
+        return {model: [os.path.abspath(p) for p in generate(os.path.join('data', model), model, **CONFIG[model])]
+                for model in MODELS}
+
+    def setup(self, paths, model):
+        self.paths = paths[model]
+        self.nvars = CONFIG[model]['nvars']
+        self.outdir = tempfile.mkdtemp()
+
+    def teardown(self, paths, model):
+        shutil.rmtree(self.outdir, ignore_errors=True)
+
+    def run(self, stage, model):
+        STAGES[stage](self.paths, model, self.nvars, self.outdir)
+
+    def time_getdependents(self, paths, model):
+        self.run('getdependents', model)
+
+    def time_open(self, paths, model):
+        self.run('open', model)
+
+    def time_split(self, paths, model):
+        self.run('split', model)
+
+    def time_aggregate(self, paths, model):
+        self.run('aggregate', model)
+
+    def time_write(self, paths, model):
+        self.run('write', model)
+
+    def peakmem_split(self, paths, model):
+        self.run('split', model)
+
+    def peakmem_aggregate(self, paths, model):
+        self.run('aggregate', model)
+
+    def peakmem_write(self, paths, model):
+        self.run('write', model)
+
+    def track_write_rate(self, paths, model):
+        start = time.perf_counter()
+        self.run('write', model)
+        return datasize(self.paths, self.nvars) / 2**20 / (time.perf_counter() - start)
+
+    track_write_rate.unit = 'MB/s'
+
+def runstage(stage, paths, model, nvars, outdir):
+    """
+    Run stage and return the time taken and the peak memory of the process
+    """
+    start = time.perf_counter()
+    STAGES[stage](paths, model, nvars, outdir)
+    return time.perf_counter() - start, peakrss()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Time each stage of splitting a synthetic dataset')
+    parser.add_argument('--model', choices=MODELS, default='mom')
+    parser.add_argument('--nfiles', type=int)
+    parser.add_argument('--ntime', type=int, help='Time steps in each file')
+    parser.add_argument('--nx', type=int)
+    parser.add_argument('--ny', type=int)
+    parser.add_argument('--nvars', type=int)
+    parser.add_argument('--calendar')
+    parser.add_argument('--complevel', type=int, help='Deflate level, 0 for no compression')
+    parser.add_argument('--stage', dest='stages', action='append', choices=list(STAGES),
+                        help='Stage to run, use more than once for multiple stages (default=all)')
+    args = parser.parse_args()
+
+    config = dict(CONFIG[args.model])
+    for option in ('nfiles', 'ntime', 'nx', 'ny', 'nvars', 'calendar', 'complevel'):
+        if getattr(args, option) is not None:
+            config[option] = getattr(args, option)
+
+    # The peak memory of a new process includes the memory of the process
+    # which started it, so keep this process small by generating the data
+    # in another process
+    context = multiprocessing.get_context('spawn')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with context.Pool(1) as pool:
+            paths = pool.apply(generate, (os.path.join(tmpdir, 'data'), args.model), config)
+        size = datasize(paths, config['nvars']) / 2**20
+        print('{} files, {:.1f} MB of data'.format(len(paths), size))
+        print('{:>14} {:>10} {:>10} {:>16}'.format('stage', 'time (s)', 'MB/s', 'peak memory (MB)'))
+        for stage in args.stages or list(STAGES):
+            outdir = os.path.join(tmpdir, 'output')
+            with context.Pool(1) as pool:
+                elapsed, peak = pool.apply(runstage, (stage, paths, args.model, config['nvars'], outdir))
+            rate = '{:10.1f}'.format(size / elapsed) if stage in DATA_STAGES else '{:>10}'.format('-')
+            print('{:>14} {:10.3f} {} {:16.1f}'.format(stage, elapsed, rate, peak / 2**20))
+    finally:
+        shutil.rmtree(tmpdir)
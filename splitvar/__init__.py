@@ -1,2 +1,11 @@
 from .splitvar import *
 from .utils import *
+from .fileindex import *
+from .manifest import *
+from .memory import *
+from .profiling import *
+from .progress import *
+from .passthrough import *
+from .periods import *
+from .compression import *
+from .precision import *
@@ -17,27 +17,49 @@ limitations under the License.
 '''
 
 import argparse
+import dask
+import functools
+import logging
 import numpy as np
 import sys
 import xarray
 
 from splitvar import *
 
+logger = logging.getLogger(__name__)
+
 def parse_args(args):
 
     parser = argparse.ArgumentParser(description='Split multiple netCDF files by time and variable')
 
     parser.add_argument('--verbose', 
-                        help='Verbose output', 
+                        help='Verbose output, the same as --log-level debug', 
                         action='store_true')
+    parser.add_argument('--log-level', 
+                        dest='loglevel',
+                        help='Level of messages to show. debug shows the contents of every output (default=info)', 
+                        choices=LOG_LEVELS,
+                        default='info')
+    parser.add_argument('--no-progress', 
+                        dest='progress',
+                        help='Do not show progress. Progress is shown on a single line on a terminal, otherwise logged every {} seconds'.format(PROGRESS_INTERVAL), 
+                        action='store_false')
     parser.add_argument('-f','--frequency', 
                         help='Time period to group for output', 
                         default='Y', 
                         action='store')
     parser.add_argument('--aggregate', 
-                        help='Apply mean in time, using pandas frequency notation e.g Y, 6M, 2Y', 
+                        help='Aggregate in time, using pandas frequency notation e.g Y, 6M, 2Y', 
                         default=None,
                         action='store')
+    parser.add_argument('--statistic', 
+                        help='Statistic calculated when aggregating: mean, min, max, sum or std. Can be specified multiple times. Statistics other than the mean are saved as variables with the statistic appended to the name (default=mean)', 
+                        dest='statistics',
+                        choices=list(STATISTICS),
+                        action='append')
+    parser.add_argument('--stream', 
+                        help='Aggregate by reading the inputs in time order, keeping running statistics for each aggregation period. Memory use is limited to one output file of each variable, however long the inputs', 
+                        action='store_true')
     # parser.add_argument('--function', 
     #                     help='Function to apply to aggregation', 
     #                     default='mean',
@@ -73,6 +95,10 @@ def parse_args(args):
     parser.add_argument('--timeformat', 
                         help='strftime format string for date fields in filename', 
                         default='%Y%m')
+    parser.add_argument('--start', 
+                        help='Only output data from this date, of the form YYYY[-MM[-DD]]. Input files which end before this date are not opened')
+    parser.add_argument('--end', 
+                        help='Only output data up to and including this date, of the form YYYY[-MM[-DD]]. Input files which start after this date are not opened')
     parser.add_argument('--timeshift', 
                         help='Shift time axis by specified amount (in whatever units are used in the file). Default is to automatically shift current start date to time origin', 
                         const='auto', 
@@ -98,18 +124,124 @@ def parse_args(args):
                         help='Create variable for any dimension without corresponding coordinate variable as per CF convention',
                         action='store_true')
     parser.add_argument('--engine', 
-                        help='Back-end used to write output files (options are netcdf4 and h5netcdf)', 
+                        help='Back-end used to write netCDF output files (options are netcdf4 and h5netcdf)', 
                         default='netcdf4')
+    parser.add_argument('--format', 
+                        help='Format of output files. Zarr outputs are stores (directories) with consolidated metadata, and require zarr (default=netcdf)', 
+                        choices=FORMATS,
+                        default='netcdf')
     parser.add_argument('--deflate', 
                         help='Deflate compression level', 
                         default=5, 
+                        type=int,
                         choices=range(0, 10))
+    parser.add_argument('--codec', 
+                        dest='codecs',
+                        help='Compression codec and level, CODEC[:LEVEL], where CODEC is one of {}, e.g. zstd:3. Use VARIABLE=CODEC[:LEVEL] to set the codec of one variable. Can be used more than once, and overrides --deflate. Codecs other than zlib need hdf5plugin, and netCDF outputs are then written with h5netcdf'.format(', '.join(CODECS)), 
+                        type=codecspec,
+                        action='append')
+    parser.add_argument('--keep-bits', 
+                        dest='keepbits',
+                        help='Round floating point data variables to NBITS mantissa bits (bit rounding), so they compress better. Use VARIABLE=NBITS to set the bits of one variable, or VARIABLE=none to not round it. Can be used more than once', 
+                        type=variablespec(keepbits),
+                        action='append')
+    parser.add_argument('--significant-digits', 
+                        dest='significantdigits',
+                        help='Round floating point data variables to the fewest bits which keep NDIGITS significant decimal digits (granular bit rounding). Use VARIABLE=NDIGITS to set the digits of one variable, or VARIABLE=none to not round it. Can be used more than once', 
+                        type=variablespec(significantdigits),
+                        action='append')
+    parser.add_argument('--pack', 
+                        dest='packs',
+                        help='Pack floating point data variables into integers of TYPE, one of {}, with scale_factor and add_offset set from the range of each output. Use VARIABLE=TYPE to set the type of one variable, or VARIABLE=none to not pack it. Can be used more than once'.format(', '.join(PACK_TYPES)), 
+                        type=variablespec(packtype),
+                        action='append')
+    parser.add_argument('--no-passthrough', 
+                        dest='passthrough',
+                        help='Always decompress and compress data. By default when outputs are only a time period of the inputs, with the same chunks and compression, compressed chunks are copied directly from the inputs. Requires h5py and h5netcdf', 
+                        action='store_false')
+    parser.add_argument('--layout', 
+                        help='Choose the chunk shapes of output variables for reading whole fields (map), time series at a point (timeseries), equally along all dimensions (balanced) or the same number of chunks for fields and time series (auto). By default chunks are chosen by the netCDF library', 
+                        choices=LAYOUTS)
+    parser.add_argument('--chunk-cache', 
+                        dest='chunkcache',
+                        help='HDF5 chunk cache size for each variable used when writing output files, e.g. 64MB, or auto to make it large enough that chunks are not evicted before they are completely written (default=netCDF library default)')
+    parser.add_argument('--transpose', 
+                        help='Loop over time periods first and then variables. Each time period is read from the inputs once and written to all the variables', 
+                        action='store_true')
+    parallel = parser.add_mutually_exclusive_group()
+    parallel.add_argument('-j','--jobs', 
+                        help='Number of worker processes used to write output files (default=1)', 
+                        default=1, 
+                        type=int)
+    parallel.add_argument('--workers', 
+                        help='Start a local dask cluster with this many workers, and write output files in batches', 
+                        type=int)
+    parser.add_argument('--threads-per-worker', 
+                        dest='threadsperworker',
+                        help='Number of threads for each dask worker (default=1)', 
+                        default=1, 
+                        type=int)
+    parser.add_argument('--memory-limit', 
+                        dest='memorylimit',
+                        help='Memory limit for each dask worker, e.g. 4GB (default=auto)', 
+                        default='auto')
+    parser.add_argument('--batch-size', 
+                        dest='batchsize',
+                        help='Number of output files computed together by the dask cluster (default=4 x number of workers)', 
+                        type=int)
+    parser.add_argument('--index', 
+                        help='Index file used to store metadata and time axes of input files. Created if it does not exist, and only files which have changed since they were indexed are reopened', 
+                        default=None)
+    parser.add_argument('--manifest', 
+                        help='Manifest file recording completed output files. Outputs in the manifest made from the same inputs with the same options are skipped, so an interrupted run can be resumed', 
+                        default=None)
+    parser.add_argument('--chunk-target', 
+                        dest='chunktarget',
+                        help='Target size of the chunks the input data is read and processed in, e.g. 64MB (default=128MB)', 
+                        default='128MB')
+    parser.add_argument('--max-memory', 
+                        dest='maxmemory',
+                        help='Maximum memory to use, e.g. 8GB. Used to choose the chunk size, the chunk cache and how much data is loaded at once', 
+                        default=None)
+    parser.add_argument('--profile', 
+                        help='Write a JSON report of the time spent in each stage, the uncompressed size of the data and bytes written and the time taken for each output file to this file', 
+                        default=None)
+    parser.add_argument('--profiler', 
+                        help='Profile writing the outputs with cProfile or pyinstrument. Saved next to the --profile report as .prof (cprofile) or .html (pyinstrument), or splitvar.prof/splitvar.html', 
+                        choices=PROFILERS,
+                        default=None)
     parser.add_argument('--filecachesize', 
                         help='Number of files xarray keeps in cache. For large datasets this may need to be set to a lower value to avoid excessive memory use (default=128)', 
                         type=int)
     parser.add_argument('inputs', help='netCDF files', nargs='+')
 
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if args.statistics and not args.aggregate:
+        parser.error('--statistic can only be used with --aggregate')
+    return args
+
+def codecspec(spec):
+    """
+    Check spec is a valid codec specification for argparse
+    """
+    try:
+        parsecodec(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return spec
+
+def variablespec(convert):
+    """
+    Return a function which checks a VALUE or VARIABLE=VALUE specification
+    is valid for argparse, where VALUE is converted by convert
+    """
+    def check(spec):
+        try:
+            parsevariablespec(spec, convert)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+        return spec
+    return check
 
 def main_parse_args(args):
     '''
@@ -127,7 +259,27 @@ def main_argv():
 
 def main(args):
 
-    verbose = args.verbose
+    setuplogging('debug' if args.verbose else args.loglevel)
+
+    if args.format == 'zarr':
+        try:
+            import zarr
+        except ImportError:
+            logger.error('zarr must be installed to write zarr output')
+            raise
+
+    # Writing netCDF with compression filter plugins needs h5netcdf
+    engine = args.engine
+    hasplugins = useplugins()
+    if needsplugins(parsecodecs(args.codecs or [])) and args.format == 'netcdf':
+        if not hasplugins:
+            logger.error('hdf5plugin must be installed to use codecs {}'.format(', '.join(PLUGIN_CODECS)))
+            raise ImportError('No module named hdf5plugin')
+        if engine != 'h5netcdf':
+            logger.info('Writing with h5netcdf to use compression plugins')
+            engine = 'h5netcdf'
+
+    profile = RunProfile()
 
     if args.filecachesize:
         xarray.set_options(file_cache_maxsize=args.filecachesize)
@@ -135,20 +287,22 @@ def main(args):
     # Open first file in series to determine dependencies and variables
     # needed to load the full dataset. Don't specify delvars on open,
     # delete after
-    ds = open_files(args.inputs[0], None, args.delvars)
+    with profile.stage('open_files'):
+        ds = open_files(args.inputs[0], None, args.delvars, index=args.index)
 
     # Find the time coordinate. Will return the first one. Code doesn't
     # support multiple time axes
     try:
         timevar = findmatchingvars(ds, matchstrings=[' since '], coords_only=True)[0]
     except IndexError:
-        print('No time coordinate found! Aborting')
+        logger.error('No time coordinate found! Aborting')
         raise
-    if verbose: print('Found time coordinate: {}'.format(timevar))
+    logger.debug('Found time coordinate: {}'.format(timevar))
 
     # Add additional variables, such as grid information. Need to add
     # at this stage to properly determing dependencies
-    ds = add_vars(ds, args.add, timevar)
+    with profile.stage('add_vars'):
+        ds = add_vars(ds, args.add, timevar)
 
     # Need this step to make sure the dependencies are correct later
     if args.makecoords:
@@ -161,7 +315,8 @@ def main(args):
 
     # Create a dictionary we can use to find dependent vars
     # for a given variable
-    depvars = getdependents(ds)
+    with profile.stage('getdependents'):
+        depvars = getdependents(ds)
 
     # Mapping from dependent variables back to variables which
     # depend on them
@@ -190,16 +345,41 @@ def main(args):
     else:
         encoding = {}
 
+    # Only open input files which contain data in the specified time window.
+    # The window applies to the shifted times if a timeshift is specified, 
+    # so all the files must be opened in that case
+    inputs = args.inputs
+    if (args.start or args.end) and not args.timeshift:
+        inputs = selectfiles(inputs, timevar, args.start, args.end, args.calendar, args.index)
+        logger.debug('{} of {} input files contain data between {} and {}'.format(
+            len(inputs), len(args.inputs), args.start, args.end))
+        if len(inputs) == 0:
+            logger.warning('No input files contain data between {} and {}'.format(args.start, args.end))
+            return
+
+    chunktarget = dask.utils.parse_bytes(args.chunktarget)
+    budget = None
+    if args.maxmemory:
+        if args.workers:
+            budget = MemoryBudget(dask.utils.parse_bytes(args.maxmemory), args.workers, args.threadsperworker)
+        else:
+            budget = MemoryBudget(dask.utils.parse_bytes(args.maxmemory), args.jobs, threads=1)
+        chunktarget = budget.chunktarget(chunktarget)
+        logger.debug('Memory budget: {} available, chunk target {}'.format(
+            dask.utils.format_bytes(budget.available), dask.utils.format_bytes(chunktarget)))
+
     # Open full dataset and exclude all variables that aren't
-    # in vars
-    ds = open_files(args.inputs, timevar, set(ds.variables).difference(variables), verbose, encoding)
+    # in vars. Limit the size of chunks read from each file, they are
+    # aligned with the output periods once the time axis is known
+    with profile.stage('open_files'):
+        ds = openinputs(inputs, ds, timevar, variables, args, chunktarget, encoding)
+    profile.add('open_files', files=len(inputs), bytes=sum(os.path.getsize(f) for f in inputs))
 
     # Add auxiliary data
-    ds = add_vars(ds, args.add, timevar)
+    with profile.stage('add_vars'):
+        ds = add_vars(ds, args.add, timevar)
 
-    if verbose: 
-        print('Opened source data:\n')
-        print(ds)
+    logger.debug('Opened source data:\n%s', ds)
 
     if args.simname:
         ds.attrs['simname'] = args.simname
@@ -230,17 +410,23 @@ def main(args):
             boundsvar = ds[timevar].attrs['bounds']
             ds[boundsvar].attrs['units'] = ds[timevar].attrs['units']
 
+    # Times of the inputs, before they are changed by --timeshift or
+    # --usebounds, to check chunks are copied from the right inputs
+    inputtimes = None
+    if args.passthrough and (args.timeshift or args.usebounds):
+        inputtimes = xarray.decode_cf(ds[[timevar]]).indexes[timevar]
+
     if args.timeshift:
         # Apply a timeshift to all variables with a time axis
         if args.timeshift == 'auto':
+            # Only read the first value
             if boundsvar is not None:
-                shift = ds[boundsvar].values[0][0]
+                shift = ds[boundsvar][0, 0].values
             else:
-                shift = ds[timevar].values[0]
+                shift = ds[timevar][0].values
         else:
             shift = float(args.timeshift)
-        for var in findmatchingvars(ds, matchstrings=[' since ']):
-            ds[var] = ds[var].copy(data = (ds[var].values[:] - shift))
+        ds = shift_time(ds, shift)
             
     if args.usebounds:
         # Replace time variable with the average of the time bounds. Useful
@@ -248,8 +434,8 @@ def main(args):
         # than the middle 
         if 'bounds' in ds[timevar].attrs:
             boundsvar = ds[timevar].attrs['bounds']
-            newtime = [(e.values - b.values)//2 + b.values for (b,e) in ds[boundsvar]]
-            ds[timevar] = ds[timevar].copy(data = newtime)
+            newtime = bounds_midpoint(ds[boundsvar])
+            ds[timevar] = ds[timevar].copy(data = newtime.data)
 
     if args.makecoords:
         # Loop over all dimensions without coordinates and make a
@@ -259,91 +445,462 @@ def main(args):
                                    coords={var:ds[var].values.astype(dtype=np.float32)}, 
                                    dims=[var])
 
-    ds = xarray.decode_cf(ds)
+    # Choose chunks aligned with the output (and aggregation) periods
+    # before decoding, so reading a chunk only reads that part of the file
+    with profile.stage('planchunks'):
+        ds = alignchunks(ds, timevar, args, chunktarget)
+    logger.info('Chunks: {}'.format(chunkreport(ds)))
+
+    # Only the times, and the variables whose values are changed, are
+    # decoded. All other variables are written as they are stored
+    with profile.stage('decode_cf'):
+        ds = decodevars(ds, timevar, changedvars(ds, args))
+
+    # Outputs which are only a time period of the inputs can be written by
+    # copying compressed chunks. Only the time coordinate is changed by
+    # --usebounds and --timeshift, so this doesn't prevent copying. 
+    # Reducing precision changes the data, so it does
+    chunksources = None
+    trimming = args.keepbits or args.significantdigits or args.packs
+    if args.passthrough and not args.aggregate and args.format == 'netcdf' and not trimming:
+        try:
+            import h5py
+            import h5netcdf
+            chunksources = ChunkSources(inputs, timevar, ds.indexes[timevar], inputtimes, args.calendar)
+        except ImportError:
+            logger.debug('h5py or h5netcdf is not installed, so chunks are not copied from the inputs')
+
+    if args.start or args.end:
+        ds = ds.sel({timevar: slice(args.start, args.end)})
+
+    # Date and time variables, such as time bounds, are small and are 
+    # needed for every output, so load them once rather than decoding
+    # them again for every output file. Times which aren't decoded are
+    # also only read once
+    with profile.stage('decode_cf'):
+        ds = loadtimes(ds)
 
     # Add all dependent variables to the skipvar list
     skipvars = set(args.skipvars + list(is_dependent.keys()))
 
-    for var in splitbyvar(ds, args.variables, skipvars, verbose):
-        i = 0
-        print('Splitting {var} by time'.format(var=var))
-        name = sanitise(var)
-        outpath = os.path.normpath(os.path.join(args.outputdir, ds.simname, args.modeltype, name))
+    variables = list(splitbyvar(ds, args.variables, skipvars))
+
+    manifest = None
+    if args.manifest:
+        manifest = Manifest(args.manifest, args.inputs + args.add, outputoptions(args))
+
+    progress = None
+    if args.progress:
+        progress = Progress(countoutputs(ds, variables, timevar, args.frequency))
+
+    # Remember which outputs are finished, so each is only checked once,
+    # and the times of each output to record in the manifest
+    finished = {}
+    times = {}
+    def isdone(fpath, dsbytime):
+        if fpath not in finished:
+            times[fpath] = outputtimes(dsbytime, timevar)
+            finished[fpath] = isfinished(fpath, args, manifest, times[fpath])
+            if finished[fpath] and progress is not None:
+                progress.skip()
+        return finished[fpath]
+
+    if args.transpose:
+        loadlimit = budget.loadlimit() if budget is not None else None
+        outputs = splitbytimefirst(ds, variables, depvars, timevar, args, isdone, loadlimit, chunktarget)
+    else:
+        outputs = splitbyvarfirst(ds, variables, depvars, timevar, args, isdone, chunktarget)
+
+    # Time spent finding the data for each output, and setting its
+    # attributes. Time spent in writevars is the time to read, process
+    # and write the data
+    outputs = profile.iterate(outputs, 'split')
+    outputs = profile.track(profile.iterate(prepareoutputs(outputs, timevar, args, chunksources), 'attributes'))
+
+    def callback(fpath):
+        profile.finish(fpath)
+        if manifest is not None:
+            manifest.record(fpath, times.get(fpath))
+        if progress is not None:
+            progress.update(fpath)
+
+    profilerpath = None
+    if args.profiler:
+        profilerpath = os.path.splitext(args.profile or 'splitvar')[0]
+        profilerpath += '.prof' if args.profiler == 'cprofile' else '.html'
+
+    chunkcache = args.chunkcache
+    if chunkcache is not None and chunkcache != 'auto':
+        chunkcache = dask.utils.parse_bytes(chunkcache)
+    if budget is not None and chunkcache is not None:
+        if chunkcache == 'auto':
+            chunkcache = functools.partial(chunkcachesize, limit=budget.chunkcache())
+        else:
+            chunkcache = min(chunkcache, budget.chunkcache())
+
+    if args.workers:
+        from distributed import Client, LocalCluster
+        batchsize = args.batchsize or 4 * args.workers
+        memorylimit = args.memorylimit
+        if budget is not None and memorylimit == 'auto':
+            memorylimit = budget.workermemory()
+        with LocalCluster(n_workers=args.workers, 
+                          threads_per_worker=args.threadsperworker,
+                          memory_limit=memorylimit) as cluster, Client(cluster) as client:
+            logger.info('Started dask cluster: {}'.format(client))
+            if hasplugins:
+                client.run(useplugins)
+            with profile.stage('write'), profiler(args.profiler, profilerpath):
+                writevars(outputs, batchsize=batchsize, 
+                          unlimited=timevar, engine=engine, callback=callback,
+                          chunkcache=chunkcache, format=args.format)
+    else:
+        with profile.stage('write'), profiler(args.profiler, profilerpath):
+            writevars(outputs, jobs=args.jobs, 
+                      unlimited=timevar, engine=engine, callback=callback,
+                      chunkcache=chunkcache, format=args.format,
+                      loadlimit=budget.loadlimit() if budget is not None else None)
+
+    if progress is not None:
+        progress.close()
+
+    logger.info('Peak memory: {} ({} in worker processes)'.format(
+        dask.utils.format_bytes(peakrss()), dask.utils.format_bytes(peakrss(children=True))))
+
+    if args.profile:
+        profile.write(args.profile)
+        logger.info('Wrote profile to {}'.format(args.profile))
+    if profilerpath is not None:
+        logger.info('Wrote {} output to {}'.format(args.profiler, profilerpath))
+
+# Options which don't change the contents of output files, so don't
+# invalidate outputs recorded in a manifest
+RUNTIME_OPTIONS = ['verbose', 'overwrite', 'transpose', 'jobs', 'workers', 
+                   'threadsperworker', 'memorylimit', 'batchsize', 'index', 
+                   'manifest', 'chunktarget', 'chunkcache', 'maxmemory', 'profile', 'profiler', 'loglevel', 'progress', 'filecachesize', 'inputs', 
+                   'start', 'end']
+
+def outputoptions(args):
+    """
+    Return a dictionary of the options which determine the contents of output files
+    """
+    return {k: v for (k, v) in vars(args).items() if k not in RUNTIME_OPTIONS}
+
+def isfinished(fpath, args, manifest=None, times=None):
+    """
+    Return True if output file fpath has already been written and does not
+    need to be written again. If there is a manifest only outputs recorded 
+    in it as completed with the same inputs, options and times (see 
+    outputtimes) are finished, otherwise any existing file is assumed to 
+    be finished
+    """
+    if args.overwrite:
+        return False
+    if manifest is not None:
+        if manifest.iscomplete(fpath, times):
+            logger.debug("Output file {} already completed. Skipping".format(fpath))
+            return True
+        return False
+    if os.path.exists(fpath):
+        logger.info("Output file {} already exists, and --overwrite not enabled. Skipping".format(fpath))
+        return True
+    return False
+
+def countoutputs(ds, variables, timevar, freq):
+    """
+    Return the number of outputs for variables split by freq, or None if it
+    can't be determined without reading the data. Variables which don't 
+    vary in time have no outputs
+    """
+    try:
+        labels, counts = timegroups(ds, freq, timevar)
+    except Exception:
+        return None
+    timedims = set(ds[timevar].dims)
+    return len([v for v in variables if not timedims.isdisjoint(ds[v].dims)]) * len(counts)
+
+def openinputs(inputs, first, timevar, variables, args, chunktarget, encoding={}):
+    """
+    Open inputs as one dataset with only variables. first is the first
+    input, opened on its own, and chunks read from each input are at most
+    about chunktarget bytes (see readchunks)
+    """
+    chunks = readchunks(first, timevar, chunktarget)
+    return open_files(inputs, timevar, set(first.variables).difference(variables), encoding, 
+                      index=args.index, chunks=chunks)
+
+def alignchunks(ds, timevar, args, chunktarget):
+    """
+    Rechunk ds so chunks are aligned with the output and aggregation
+    periods, and at most about chunktarget bytes (see planchunks)
+    """
+    freqs = [args.frequency] + ([args.aggregate] if args.aggregate else [])
+    return applychunks(ds, planchunks(ds, timevar, freqs, chunktarget))
+
+def loadtimes(ds):
+    """
+    Load the date and time variables of ds, and any encoded times which
+    weren't decoded
+    """
+    timevars = [v for v in ds.variables if ds[v].dtype.kind in 'mMO' or
+                ' since ' in ds[v].attrs.get('units', '')]
+    ds.update(ds[timevars].compute())
+    return ds
+
+def changedvars(ds, args):
+    """
+    Return the names of the variables of ds whose values are changed, by
+    aggregating or reducing their precision, so must be decoded
+    """
+    if args.aggregate:
+        return list(ds.variables)
+    names = set()
+    for specs in (args.keepbits, args.significantdigits, args.packs):
+        for spec in specs or []:
+            variable = parsevariablespec(spec, str)[0]
+            if variable is None:
+                return list(ds.variables)
+            names.add(variable)
+    return names
+
+def prepareoutputs(outputs, timevar, args, chunksources=None):
+    """
+    Yield (dataset, filename) for every output, creating the output 
+    directory and setting output attributes. If chunksources is specified
+    variables which can be copied chunk by chunk from the inputs are set
+    in the chunksources encoding of each output
+    """
+    geospatialcache = {}
+    codecs = parsecodecs(args.codecs or [])
+    nbits = parsevariablespecs(args.keepbits or [], keepbits)
+    ndigits = parsevariablespecs(args.significantdigits or [], significantdigits)
+    packs = parsevariablespecs(args.packs or [], packtype)
+    for dsbytime, fpath in outputs:
+
         try:
-            os.makedirs(outpath)
+            os.makedirs(os.path.dirname(fpath))
         except FileExistsError:
             pass
-        varlist = [var,] + depvars[var]
-        dsbyvar = ds[varlist]
-        # Drop any variables xarray has automatically added that are not
-        # superfluous. Especially important to not get spurious/confusing 
-        # coordinates
-        try:
-            dsbyvar = dsbyvar.drop_vars(set(dsbyvar.variables).difference(varlist))
-        except AttributeError:
-            dsbyvar = dsbyvar.drop(set(dsbyvar.variables).difference(varlist))
 
-        if args.aggregate:
-            dsbyvar = resamplebytime(dsbyvar, var, args.aggregate, timedim=timevar)
-        for dsbytime in groupbytime(dsbyvar, freq=args.frequency, timedim=timevar):
-            i += 1
-            startdate = format_date(dsbytime[timevar].values[0], args.timeformat)
-            enddate = format_date(dsbytime[timevar].values[-1], args.timeformat)
-            if 'bounds' in dsbytime[timevar].attrs and args.datefrombounds:
-                boundsvar = ds[timevar].attrs['bounds']
-                startdate = format_date(dsbytime[boundsvar].values[0][0], args.timeformat)
-                enddate = format_date(dsbytime[boundsvar].values[-1][1], args.timeformat)
-            fname = '{name}_{simulation}_{fromdate}_{todate}.nc'.format(
-                        name=name,
-                        simulation=ds.attrs['simname'],
-                        fromdate=startdate,
-                        todate=enddate,
-                     )
-            fpath = os.path.join(outpath, fname)
-            if os.path.exists(fpath) and not args.overwrite:
-                print("Output file {} already exists, and --overwrite not enabled. Skipping".format(fpath))
+        setoutputattrs(dsbytime, timevar, args, geospatialcache)
+
+        if args.layout is not None:
+            setlayout(dsbytime, timevar, args.layout)
+
+        if codecs:
+            setcodecs(dsbytime, codecs, args.format)
+
+        if nbits or ndigits:
+            setprecision(dsbytime, timevar, nbits, ndigits)
+
+        if packs:
+            setpacking(dsbytime, timevar, packs)
+
+        if chunksources is not None:
+            sources = chunksources.find(dsbytime, args.layout)
+            if sources:
+                # The encoding of a dataset is shared with the datasets
+                # selected from it, so replace it rather than changing it
+                dsbytime.encoding = dict(dsbytime.encoding, chunksources=sources)
+
+        # Formatting a dataset is slow, so only done if it will be shown
+        logger.debug('%s', dsbytime)
+
+        yield dsbytime, fpath
+
+def selectvar(ds, var, depvars, statistics=None):
+    """
+    Return a dataset containing only var and the variables it depends on. 
+    If statistics is specified the aggregated statistics of var are selected
+    instead of var
+    """
+    if statistics:
+        varlist = [statvarname(var, stat) for stat in statistics] + depvars[var]
+    else:
+        varlist = [var,] + depvars[var]
+    dsbyvar = ds[varlist]
+    # Drop any variables xarray has automatically added that are not
+    # superfluous. Especially important to not get spurious/confusing 
+    # coordinates
+    try:
+        dsbyvar = dsbyvar.drop_vars(set(dsbyvar.variables).difference(varlist))
+    except AttributeError:
+        dsbyvar = dsbyvar.drop(set(dsbyvar.variables).difference(varlist))
+
+    # Shallow copy so attributes set on one output are not shared
+    # with any other
+    return dsbyvar.copy()
+
+def splitbyvarfirst(ds, variables, depvars, timevar, args, isdone, chunktarget=None):
+    """
+    Yield (dataset, filename) for each output, looping over variables
+    in the outer loop and time periods in the inner loop. Each variable
+    makes a separate pass through the input data. Outputs for which 
+    isdone(filename, dataset) is True are skipped before any data is read.
+    chunktarget limits the size in bytes of chunks aggregated at once
+    """
+    # Every variable has the same times unless aggregated, so the periods
+    # are only found once
+    periods = None
+    if not args.aggregate:
+        periods = PeriodIndex(ds[timevar], args.frequency)
+    for var in variables:
+        logger.info('Splitting {var} by time'.format(var=var))
+        dsbyvar = selectvar(ds, var, depvars)
+        if args.aggregate and args.stream:
+            def wanted(dsbytime):
+                return not isdone(outputfilepath(dsbytime, var, timevar, ds.attrs['simname'], args), dsbytime)
+            outputs = streamaggregate(dsbyvar, var, args.aggregate, args.frequency, timedim=timevar, 
+                                      statistics=args.statistics, wanted=wanted)
+        else:
+            if args.aggregate:
+                dsbyvar = resamplebytime(dsbyvar, var, args.aggregate, timedim=timevar, 
+                                         statistics=args.statistics, chunksize=chunktarget)
+            outputs = groupbytime(dsbyvar, freq=args.frequency, timedim=timevar, periods=periods)
+        for dsbytime in outputs:
+            fpath = outputfilepath(dsbytime, var, timevar, ds.attrs['simname'], args)
+            if isdone(fpath, dsbytime):
                 continue
+            yield dsbytime, fpath
+
+def splitbytimefirst(ds, variables, depvars, timevar, args, isdone, loadlimit=None, chunktarget=None):
+    """
+    Yield (dataset, filename) for each output, looping over time periods
+    in the outer loop and variables in the inner loop. The data for each
+    time period is read from the inputs once and shared between all the 
+    variables, so peak memory use is one time period of all variables.
+    If loadlimit is specified the variables are loaded in groups of at 
+    most loadlimit bytes instead, and any variable larger than loadlimit
+    is not loaded but read as it is written. Outputs for which 
+    isdone(filename, dataset) is True are skipped, and only the variables
+    needed for the remaining outputs are read. chunktarget limits the size 
+    in bytes of chunks aggregated at once
+    """
+    varlist = set()
+    for var in variables:
+        varlist.update([var,] + depvars[var])
+    dsall = ds[list(varlist)]
+
+    def fpath(dsbytime, var):
+        return outputfilepath(dsbytime, var, timevar, ds.attrs['simname'], args)
+
+    statistics = None
+    if args.aggregate:
+        statistics = args.statistics
+
+    if args.aggregate and args.stream:
+        def wanted(dsbytime):
+            return not all(isdone(fpath(dsbytime, var), dsbytime) for var in variables)
+        outputs = streamaggregate(dsall, variables, args.aggregate, args.frequency, timedim=timevar, 
+                                  statistics=statistics, wanted=wanted)
+    else:
+        if args.aggregate:
+            dsall = resamplebytime(dsall, variables, args.aggregate, timedim=timevar, 
+                                   statistics=statistics, chunksize=chunktarget)
+        outputs = groupbytime(dsall, freq=args.frequency, timedim=timevar)
+
+    for dsbytime in outputs:
+        fpaths = {}
+        for var in variables:
+            if not isdone(fpath(dsbytime, var), dsbytime):
+                fpaths[var] = fpath(dsbytime, var)
+        if len(fpaths) == 0:
+            continue
+        logger.info('Splitting {start} to {end} by variable'.format(
+            start=dsbytime[timevar].values[0], end=dsbytime[timevar].values[-1]))
+        needed = {}
+        for var in fpaths:
+            needed[var] = [statvarname(var, stat) for stat in statistics or ['mean']] + depvars[var]
+        sizes = {var: sum(dsbytime[v].nbytes for v in needed[var]) for var in fpaths}
+        groups = [list(fpaths)]
+        if loadlimit is not None:
+            groups = groupbysize(sizes, loadlimit)
+        for group in groups:
+            names = set().union(*[needed[var] for var in group])
+            dsgroup = dsbytime[[v for v in dsbytime.variables if v in names]]
+            # A variable too large to load is read in chunks when it is written
+            if loadlimit is None or sum(sizes[var] for var in group) <= loadlimit:
+                dsgroup = dsgroup.load()
+            for var in group:
+                yield selectvar(dsgroup, var, depvars, statistics), fpaths[var]
+
+def outputfilepath(dsbytime, var, timevar, simname, args):
+    """
+    Generate the path of the output file for a single variable and time
+    period. Sets the start and end dates used in the filename as attributes 
+    of dsbytime. Only the time coordinate and bounds are read
+    """
+    name = sanitise(var)
+    outpath = os.path.normpath(os.path.join(args.outputdir, simname, args.modeltype, name))
+
+    startdate = format_date(dsbytime[timevar].values[0], args.timeformat)
+    enddate = format_date(dsbytime[timevar].values[-1], args.timeformat)
+    if 'bounds' in dsbytime[timevar].attrs and args.datefrombounds:
+        boundsvar = dsbytime[timevar].attrs['bounds']
+        startdate = format_date(dsbytime[boundsvar].values[0][0], args.timeformat)
+        enddate = format_date(dsbytime[boundsvar].values[-1][1], args.timeformat)
+
+    dsbytime.attrs['time_coverage_start'] = startdate
+    dsbytime.attrs['time_coverage_end'] = enddate
+
+    fname = '{name}_{simulation}_{fromdate}_{todate}{extension}'.format(
+                name=name,
+                simulation=simname,
+                fromdate=startdate,
+                todate=enddate,
+                extension=FORMAT_EXTENSIONS[args.format],
+             )
+    return os.path.join(outpath, fname)
+
+def geospatialextent(dsbytime, var, timevar, cache=None):
+    """
+    Return minimum and maximum of var. Variables which don't vary in time,
+    i.e. don't share a dimension with timevar, have the same extent in
+    every output, so if cache is specified their extent is computed once
+    and saved in cache, keyed by variable name
+    """
+    if cache is not None and var in cache:
+        return cache[var]
+    vmin, vmax = dask.compute(dsbytime[var].min(), dsbytime[var].max())
+    extent = (vmin.values, vmax.values)
+    if cache is not None and set(dsbytime[timevar].dims).isdisjoint(dsbytime[var].dims):
+        cache[var] = extent
+    return extent
+
+def setoutputattrs(dsbytime, timevar, args, cache=None):
+    """
+    Set geospatial global attributes and delete unwanted global attributes.
+    Extents of time invariant coordinates are saved in cache, if specified,
+    and reused for subsequent outputs
+    """
+    dsbytime.attrs['geospatial_lat_min'] =  99999.
+    dsbytime.attrs['geospatial_lat_max'] = -99999.
+    for var in findmatchingvars(dsbytime, matchstrings=['degrees_N', 'degrees_north']):
+        if var in dsbytime:
+            vmin, vmax = geospatialextent(dsbytime, var, timevar, cache)
+            dsbytime.attrs['geospatial_lat_min'] = min(vmin, dsbytime.attrs['geospatial_lat_min'])
+            dsbytime.attrs['geospatial_lat_max'] = max(vmax, dsbytime.attrs['geospatial_lat_max'])
+
+    dsbytime.attrs['geospatial_lon_min'] = 99999.
+    dsbytime.attrs['geospatial_lon_max'] = -99999.
+    for var in findmatchingvars(dsbytime, matchstrings=['degrees_E','degrees_east']):
+        if var in dsbytime:
+            vmin, vmax = geospatialextent(dsbytime, var, timevar, cache)
+            dsbytime.attrs['geospatial_lon_min'] = min(vmin, dsbytime.attrs['geospatial_lon_min'])
+            dsbytime.attrs['geospatial_lon_max'] = max(vmax, dsbytime.attrs['geospatial_lon_max'])
+
+    for attr in list(dsbytime.attrs):
+        try:
+            if abs(float(dsbytime.attrs[attr])) == 99999. :
+                del(dsbytime.attrs[attr])
+        except:
+            pass
 
-            dsbytime.attrs['time_coverage_start'] = startdate
-            dsbytime.attrs['time_coverage_end'] = enddate
-
-            dsbytime.attrs['geospatial_lat_min'] =  99999.
-            dsbytime.attrs['geospatial_lat_max'] = -99999.
-            for var in findmatchingvars(dsbytime, matchstrings=['degrees_N', 'degrees_north']):
-                if var in dsbytime:
-                    dsbytime.attrs['geospatial_lat_min'] = min(
-                        dsbytime[var].min().values, dsbytime.attrs['geospatial_lat_min'])
-                    dsbytime.attrs['geospatial_lat_max'] = max(
-                        dsbytime[var].max().values, dsbytime.attrs['geospatial_lat_max'])
-
-            dsbytime.attrs['geospatial_lon_min'] = 99999.
-            dsbytime.attrs['geospatial_lon_max'] = -99999.
-            for var in findmatchingvars(dsbytime, matchstrings=['degrees_E','degrees_east']):
-                if var in dsbytime:
-                    dsbytime.attrs['geospatial_lon_min'] = min(
-                        dsbytime[var].min().values, dsbytime.attrs['geospatial_lon_min'])
-                    dsbytime.attrs['geospatial_lon_max'] = max(
-                        dsbytime[var].max().values, dsbytime.attrs['geospatial_lon_max'])
-
-            for attr in list(dsbytime.attrs):
-                try:
-                    if abs(float(dsbytime.attrs[attr])) == 99999. :
-                        del(dsbytime.attrs[attr])
-                except:
-                    pass
-
-            for attr in args.delattr:
-                try:
-                    del(dsbytime.attrs[attr])
-                except KeyError:
-                    pass
-
-            print(dsbytime)
-
-            writevar(dsbytime, fpath, unlimited=timevar, engine=args.engine)
-        if i == 0:
-            # No data written, delete empty output directory
-            os.rmdir(outpath)
+    for attr in args.delattr:
+        try:
+            del(dsbytime.attrs[attr])
+        except KeyError:
+            pass
 
 if __name__ == '__main__':
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compression codecs for output variables. zlib is built in to netCDF and
+HDF5, the others are HDF5 filter plugins provided by hdf5plugin, written
+with h5netcdf as the netCDF4 library can't be given them through xarray.
+Zarr outputs use the same codecs from numcodecs.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+CODECS = ('none', 'zlib', 'zstd', 'blosc-lz4', 'blosc-zstd')
+
+# Compression level used if none is specified
+DEFAULT_LEVELS = {'none': 0, 'zlib': 5, 'zstd': 3, 'blosc-lz4': 5, 'blosc-zstd': 3}
+
+# Codecs which need hdf5plugin to write netCDF files
+PLUGIN_CODECS = ('zstd', 'blosc-lz4', 'blosc-zstd')
+
+# Encoding settings which choose the compression of a variable
+COMPRESSION_ENCODING = ('zlib', 'complevel', 'shuffle', 'compression', 'compression_opts',
+                        'compressor', 'filters')
+
+def parsecodec(spec):
+    """
+    Parse a codec specification, CODEC[:LEVEL] or VARIABLE=CODEC[:LEVEL],
+    returning (variable, codec, level). variable is None if not specified
+    """
+    variable = None
+    if '=' in spec:
+        variable, spec = spec.split('=', 1)
+    codec, _, level = spec.partition(':')
+    if codec not in CODECS:
+        raise ValueError('Unknown codec {}, must be one of {}'.format(codec, ', '.join(CODECS)))
+    level = int(level) if level else DEFAULT_LEVELS[codec]
+    return variable, codec, level
+
+def parsecodecs(specs):
+    """
+    Return a dictionary of (codec, level) by variable name from a list of
+    codec specifications (see parsecodec). The codec of all other variables
+    is under the key None
+    """
+    codecs = {}
+    for spec in specs:
+        variable, codec, level = parsecodec(spec)
+        codecs[variable] = (codec, level)
+    return codecs
+
+def needsplugins(codecs):
+    """
+    Return True if any of codecs ({variable: (codec, level)}) needs
+    hdf5plugin to write netCDF files
+    """
+    return any(codec in PLUGIN_CODECS for (codec, level) in codecs.values())
+
+def useplugins():
+    """
+    Register the HDF5 filter plugins from hdf5plugin with h5py, so they can
+    be used to write and read files with h5netcdf. Returns False if 
+    hdf5plugin is not installed
+    """
+    try:
+        import hdf5plugin
+    except ImportError:
+        return False
+    return True
+
+def netcdfencoding(codec, level):
+    """
+    Return the encoding to write a variable with codec at level to netCDF
+    """
+    if codec == 'none':
+        return {'zlib': False, 'shuffle': False}
+    if codec == 'zlib':
+        return {'zlib': True, 'complevel': level, 'shuffle': True}
+    import hdf5plugin
+    if codec == 'zstd':
+        return dict(hdf5plugin.Zstd(clevel=level), shuffle=True)
+    # Blosc shuffles the data itself
+    cname = codec.split('-')[1]
+    return dict(hdf5plugin.Blosc(cname=cname, clevel=level, shuffle=hdf5plugin.Blosc.SHUFFLE), shuffle=False)
+
+def zarrencoding(codec, level, itemsize):
+    """
+    Return the encoding to write a variable with codec at level and
+    itemsize bytes per element to zarr
+    """
+    import numcodecs
+    if codec == 'none':
+        return {'compressor': None, 'filters': None}
+    if codec in ('zlib', 'zstd'):
+        compressor = numcodecs.Zlib(level=level) if codec == 'zlib' else numcodecs.Zstd(level=level)
+        return {'compressor': compressor, 'filters': [numcodecs.Shuffle(elementsize=itemsize)]}
+    cname = codec.split('-')[1]
+    return {'compressor': numcodecs.Blosc(cname=cname, clevel=level, shuffle=numcodecs.Blosc.SHUFFLE),
+            'filters': None}
+
+def setcodecs(ds, codecs, format='netcdf'):
+    """
+    Set the compression of the variables in ds from codecs, a dictionary
+    of (codec, level) by variable name, and for all other variables under
+    the key None, for writing in format, netcdf or zarr. Only numeric
+    variables with at least one dimension are compressed
+    """
+    for name, var in ds.variables.items():
+        if name in codecs:
+            codec, level = codecs[name]
+        elif None in codecs:
+            codec, level = codecs[None]
+        else:
+            continue
+        dtype = np.dtype(var.encoding.get('dtype', var.dtype))
+        if var.ndim == 0 or dtype.kind not in 'biuf':
+            continue
+        for key in COMPRESSION_ENCODING:
+            var.encoding.pop(key, None)
+        if codec != 'none':
+            # Compressed variables must be chunked
+            var.encoding.pop('contiguous', None)
+        if format == 'zarr':
+            var.encoding.update(zarrencoding(codec, level, dtype.itemsize))
+        else:
+            var.encoding.update(netcdfencoding(codec, level))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Persistent index of input file metadata. Opening a large number of files
+with open_mfdataset is slow, as every file has to be opened to determine
+the structure and time axis of the concatenated dataset. The index stores
+everything needed to reconstruct the concatenated dataset lazily in a sidecar
+sqlite database, so files only need to be opened again if they have changed.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+
+import dask
+import dask.array
+import netCDF4
+import numpy as np
+import xarray
+
+logger = logging.getLogger(__name__)
+
+# Increment when the contents of a file record change, so that records
+# written by an older version are rescanned
+INDEX_VERSION = 1
+
+# The netCDF4/HDF5 library is not thread safe, so all reads from the
+# indexed arrays share a single lock
+NETCDF_LOCK = dask.utils.SerializableLock()
+
+class NetCDFVariableReader(object):
+    """
+    Array-like wrapper around a variable in a netCDF file. Only the shape and
+    dtype are stored; the file is opened by manager, a CachingFileManager, when 
+    data is read, and kept open in the same cache of open files used by xarray. 
+    Values are returned without any masking or scaling, the same as decode_cf=False
+    """
+
+    def __init__(self, manager, name, shape, dtype):
+        self.manager = manager
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        var = self.manager.acquire().variables[self.name]
+        var.set_auto_maskandscale(False)
+        var.set_auto_chartostring(False)
+        return np.asarray(var[key])
+
+def fingerprint(path):
+    """
+    Return (size, mtime) of path, used to determine if a file has changed
+    since it was indexed
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def checksum(values):
+    """
+    Return checksum of the values in an array
+    """
+    return hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+def findtimedim(ds):
+    """
+    Return the name of the time dimension: the first coordinate with units
+    of the form "units since date", otherwise the first unlimited dimension
+    """
+    for name in ds.coords:
+        if ' since ' in ds[name].attrs.get('units', ''):
+            return name
+    unlimited = ds.encoding.get('unlimited_dims', set())
+    if len(unlimited) > 0:
+        return sorted(unlimited)[0]
+    return None
+
+def scanfile(path):
+    """
+    Read the metadata of a netCDF file and return a record containing the
+    dimensions, variable definitions, attributes and encoding, and the
+    values of all the coordinates and time bounds. A checksum of all
+    variables which don't depend on time is also saved so time invariant
+    variables can be compared between files without opening them
+    """
+    record = {'version': INDEX_VERSION}
+
+    with xarray.open_dataset(path, decode_cf=False) as ds:
+
+        timedim = findtimedim(ds)
+
+        record['timedim'] = timedim
+        record['dims'] = dict(ds.dims)
+        record['attrs'] = dict(ds.attrs)
+        record['order'] = list(ds.variables)
+
+        boundsvar = None
+        if timedim in ds and 'bounds' in ds[timedim].attrs:
+            boundsvar = ds[timedim].attrs['bounds']
+
+        variables = {}
+        for name in ds.variables:
+            var = ds.variables[name]
+            variables[name] = {
+                'dims': var.dims,
+                'shape': var.shape,
+                'dtype': var.dtype,
+                'attrs': dict(var.attrs),
+                'encoding': dict(var.encoding),
+            }
+            if name in ds.dims or name == boundsvar:
+                # Coordinates and time bounds are small and needed to
+                # construct the dataset, so store the values
+                variables[name]['values'] = var.values
+            if timedim not in var.dims:
+                variables[name]['checksum'] = checksum(var.values)
+        record['variables'] = variables
+
+    return record
+
+def openindex(indexfile):
+    """
+    Open sqlite index file, creating it if it doesn't exist
+    """
+    db = sqlite3.connect(indexfile)
+    db.execute('CREATE TABLE IF NOT EXISTS files '
+               '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, record BLOB)')
+    return db
+
+def indexfiles(paths, indexfile):
+    """
+    Return a list of metadata records for paths. Records are read from
+    indexfile, and only files which are not in the index, or whose size
+    or modification time has changed, are scanned and the index updated
+    """
+    records = []
+    with openindex(indexfile) as db:
+        for path in paths:
+            path = os.path.abspath(path)
+            size, mtime = fingerprint(path)
+            row = db.execute('SELECT size, mtime, record FROM files WHERE path = ?',
+                             (path,)).fetchone()
+            record = None
+            if row is not None and tuple(row[:2]) == (size, mtime):
+                # Records are pickled as they contain numpy arrays and dtypes
+                record = pickle.loads(row[2])
+                if record.get('version') != INDEX_VERSION:
+                    record = None
+            if record is None:
+                logger.debug('Indexing {}'.format(path))
+                record = scanfile(path)
+                db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                           (path, size, mtime, pickle.dumps(record)))
+            record['path'] = path
+            records.append(record)
+    return records
+
+def lazyvariable(record, name, manager, chunks=None):
+    """
+    Return a lazily loaded dask array for variable name in an indexed file.
+    chunks is a dictionary of chunk sizes for each dimension, the same as 
+    open_mfdataset, and by default the variable is a single chunk
+    """
+    var = record['variables'][name]
+    reader = NetCDFVariableReader(manager, name, var['shape'], var['dtype'])
+    chunks = [(chunks or {}).get(dim, size) for dim, size in zip(var['dims'], var['shape'])]
+    token = dask.base.tokenize(record['path'], name, var['shape'], str(var['dtype']))
+    # Specify meta so dask does not need to read from the file to determine it
+    meta = np.empty((0,) * reader.ndim, dtype=reader.dtype)
+    return dask.array.from_array(reader, chunks=tuple(chunks), lock=NETCDF_LOCK,
+                                 name='{}-{}'.format(name, token), meta=meta)
+
+def isconcatenable(records, concat_dim, delvars):
+    """
+    Check the indexed files can be simply concatenated along concat_dim: all
+    contain the same variables with the same dimensions and type, and time
+    invariant variables are identical in all files
+    """
+    first = records[0]
+    if concat_dim not in first['variables']:
+        return False
+    for record in records:
+        if record['timedim'] != concat_dim:
+            return False
+        if set(record['variables']) != set(first['variables']):
+            return False
+        for name, var in record['variables'].items():
+            if name in delvars:
+                continue
+            firstvar = first['variables'][name]
+            if var['dims'] != firstvar['dims'] or var['dtype'] != firstvar['dtype']:
+                return False
+            if var.get('checksum') != firstvar.get('checksum'):
+                return False
+    return True
+
+def datasetfromindex(records, concat_dim, delvars=None, chunks=None):
+    """
+    Construct a lazily loaded dataset from indexed file records, equivalent
+    to opening the files with open_mfdataset and decode_cf=False. Files are
+    concatenated along concat_dim in order of their first time value. Returns
+    None if the files cannot be simply concatenated
+    """
+    delvars = set(delvars or [])
+
+    if concat_dim is not None:
+        if not isconcatenable(records, concat_dim, delvars):
+            return None
+        records = sorted(records, key=lambda r: r['variables'][concat_dim]['values'][0])
+    elif len(records) > 1:
+        return None
+
+    first = records[0]
+
+    managers = {r['path']: xarray.backends.CachingFileManager(netCDF4.Dataset, r['path'], mode='r')
+                for r in records}
+
+    variables = {}
+    for name in first['order']:
+        if name in delvars:
+            continue
+        var = first['variables'][name]
+        if concat_dim in var['dims']:
+            axis = var['dims'].index(concat_dim)
+            if 'values' in var:
+                data = np.concatenate([r['variables'][name]['values'] for r in records], axis=axis)
+            else:
+                data = dask.array.concatenate([lazyvariable(r, name, managers[r['path']], chunks) for r in records], axis=axis)
+        elif 'values' in var:
+            data = var['values']
+        else:
+            data = lazyvariable(first, name, managers[first['path']], chunks)
+        variables[name] = xarray.Variable(var['dims'], data, attrs=var['attrs'],
+                                          encoding=dict(var['encoding']))
+
+    if concat_dim is not None and len(records) > 1:
+        # Concatenated time coordinate has no encoding, same as open_mfdataset
+        variables[concat_dim].encoding = {}
+
+    # Without decoding the only coordinates are dimension coordinates, which
+    # are automatically made coordinates by xarray
+    ds = xarray.Dataset(variables, attrs=first['attrs'])
+
+    def close():
+        for manager in managers.values():
+            manager.close()
+    ds.set_close(close)
+
+    return ds
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Manifest of completed output files, used to resume an interrupted run. An
+output is only recorded once it has been completely written, along with a
+fingerprint of the input files, a hash of the options used to create it and
+the times it contains, so an output is only considered finished if it was
+made from the same inputs with the same options, and has the same times.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+from .fileindex import fingerprint
+
+# Increment when the contents of a manifest entry change, so that entries
+# written by an older version are not trusted
+MANIFEST_VERSION = 2
+
+def filechecksum(path, blocksize=2**20):
+    """
+    Return sha256 checksum of the contents of a file, or of the names and
+    contents of all the files in a directory, such as a zarr store
+    """
+    sha = hashlib.sha256()
+    for name in outputfiles(path):
+        if name != path:
+            sha.update(os.path.relpath(name, path).encode())
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def outputfiles(path):
+    """
+    Return a sorted list of the files in output path, which is either a 
+    single file or a directory, such as a zarr store
+    """
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for root, dirs, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names)
+    return sorted(files)
+
+def outputsize(path):
+    """
+    Return the size in bytes of output path, the total size of all the 
+    files if it is a directory
+    """
+    return sum(os.path.getsize(name) for name in outputfiles(path))
+
+def inputsfingerprint(paths):
+    """
+    Return a hash of the path, size and modification time of all input
+    files, which changes if any input is modified, added or removed
+    """
+    sha = hashlib.sha1()
+    for path in sorted(set(os.path.abspath(p) for p in paths)):
+        size, mtime = fingerprint(path)
+        sha.update('{}:{}:{}\n'.format(path, size, mtime).encode())
+    return sha.hexdigest()
+
+def optionshash(options):
+    """
+    Return a hash of a dictionary of options
+    """
+    return hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+def outputtimes(ds, timevar):
+    """
+    Return [first time, last time, number of times] of the time coordinate
+    timevar of output dataset ds, as recorded in the manifest
+    """
+    times = ds[timevar].values
+    return [str(times[0]), str(times[-1]), len(times)]
+
+def readmanifest(manifestfile):
+    """
+    Return a dictionary of manifest entries indexed by output path. The
+    manifest is a JSON lines file, with later entries replacing earlier
+    entries for the same output. An incomplete last line, left if a run
+    was killed while writing it, is ignored
+    """
+    entries = {}
+    if not os.path.exists(manifestfile):
+        return entries
+    with open(manifestfile) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('version') == MANIFEST_VERSION:
+                entries[entry['path']] = entry
+    return entries
+
+class Manifest(object):
+    """
+    Manifest of output files completed from inputs using options. Entries
+    are appended to manifestfile as each output is finished
+    """
+
+    def __init__(self, manifestfile, inputs, options):
+        self.manifestfile = manifestfile
+        self.inputs = inputsfingerprint(inputs)
+        self.options = optionshash(options)
+        self.entries = readmanifest(manifestfile)
+
+    def iscomplete(self, filename, times=None):
+        """
+        Return True if filename was completed from the same inputs with the
+        same options, and has not been changed or removed since. If times
+        (see outputtimes) is specified the output must also have been
+        recorded with the same times, which a time window (--start, --end) 
+        can change
+        """
+        entry = self.entries.get(os.path.abspath(filename))
+        if entry is None:
+            return False
+        if entry['inputs'] != self.inputs or entry['options'] != self.options:
+            return False
+        if times is not None and entry.get('times') != list(times):
+            return False
+        try:
+            return outputsize(filename) == entry['size']
+        except OSError:
+            return False
+
+    def record(self, filename, times=None):
+        """
+        Record filename as completed, containing times (see outputtimes).
+        The entry is flushed to disk immediately so it survives the run
+        being killed
+        """
+        path = os.path.abspath(filename)
+        entry = {
+            'version': MANIFEST_VERSION,
+            'path': path,
+            'inputs': self.inputs,
+            'options': self.options,
+            'size': outputsize(path),
+            'sha256': filechecksum(path),
+            'times': None if times is None else list(times),
+        }
+        with open(self.manifestfile, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[path] = entry
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Memory budget, used to choose chunk sizes, chunk caches and how much data
+is loaded at once so that splitvar stays within a maximum amount of memory.
+"""
+
+from __future__ import print_function
+
+import resource
+import sys
+
+# Copies of a chunk held while it is processed: the data read from the
+# input, the decoded data and the compressed data being written
+CHUNK_COPIES = 3
+
+def peakrss(children=False):
+    """
+    Return the peak resident set size in bytes of this process, or if
+    children is True the largest of any child process which has finished
+    """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+def groupbysize(sizes, limit):
+    """
+    Return a list of groups of the keys of the dictionary sizes, in order,
+    where the total size of each group is at most limit. Keys larger than
+    limit are in a group of their own
+    """
+    groups = []
+    group = []
+    total = 0
+    for key, size in sizes.items():
+        if group and total + size > limit:
+            groups.append(group)
+            group = []
+            total = 0
+        group.append(key)
+        total += size
+    if group:
+        groups.append(group)
+    return groups
+
+class MemoryBudget(object):
+    """
+    Divide maxmemory bytes between the processes, each with threads
+    threads, computing outputs: the dask workers, or the -j processes
+    (or just this one) with one thread each. The memory already used by
+    this process, mostly the libraries and the metadata of the inputs,
+    is set aside, and the same again for each worker process if there is
+    more than one.
+    Of the remainder a quarter is for chunks being processed, a quarter
+    for the chunk caches of output files and a half for data loaded at
+    once, such as a whole time period of many variables (--transpose)
+    """
+
+    def __init__(self, maxmemory, processes=1, threads=1, baseline=None):
+        if baseline is None:
+            baseline = peakrss()
+        self.maxmemory = maxmemory
+        self.processes = processes
+        self.threads = threads
+        self.reserved = baseline * (processes + 1 if processes > 1 else 1)
+        self.available = maxmemory - self.reserved
+        if self.available <= 0:
+            raise ValueError('Memory budget of {} bytes is less than the {} bytes needed to start'.format(
+                maxmemory, self.reserved))
+
+    def chunktarget(self, target=None):
+        """
+        Return the largest chunk size in bytes so every thread in every
+        process can process a chunk at once. If target is specified the
+        chunk size is at most target
+        """
+        size = max(1, self.available // (4 * self.processes * self.threads * CHUNK_COPIES))
+        if target is not None:
+            size = min(size, target)
+        return size
+
+    def chunkcache(self):
+        """
+        Return the largest chunk cache size in bytes for writing output files
+        """
+        return max(1, self.available // (4 * self.processes))
+
+    def loadlimit(self):
+        """
+        Return the largest amount of data in bytes to load at once. Loaded
+        data is copied to worker processes, so the limit is halved if there
+        are more than one
+        """
+        limit = self.available // 2
+        if self.processes > 1:
+            limit //= 2
+        return max(1, limit)
+
+    def workermemory(self):
+        """
+        Return the memory limit in bytes for each dask worker
+        """
+        return self.available // self.processes
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Copy compressed chunks directly from input to output files. When an output
+is only a time period of a variable, and the output is chunked and
+compressed the same way as the inputs, the chunks in the output are
+exactly the chunks in the inputs, so they can be copied without being
+decompressed, decoded, encoded and compressed again. Needs h5py and
+h5netcdf. Files are only opened with h5py, as the netCDF library prints
+HDF5 errors when it opens a file in a thread other than the one it was
+first used in.
+"""
+
+from __future__ import print_function
+
+import itertools
+import logging
+import os
+
+import dask.array
+import numpy as np
+import xarray
+
+from .periods import decodetimes
+
+logger = logging.getLogger(__name__)
+
+# Names netCDF4 gives the HDF5 filters it knows
+HDF5_FILTERS = {1: 'zlib', 2: 'shuffle', 3: 'fletcher32', 4: 'szip', 307: 'bzip2',
+                32001: 'blosc', 32015: 'zstd'}
+
+def filterssame(filters, encoding):
+    """
+    Return True if netCDF4 variable filters are the same as those set in
+    xarray encoding
+    """
+    if any(filters.get(f) for f in ('szip', 'zstd', 'bzip2', 'blosc', 'other')):
+        return False
+    if encoding.get('compression') not in (None, 'gzip'):
+        return False
+    if bool(filters['zlib']) != bool(encoding.get('zlib', False)):
+        return False
+    if filters['zlib'] and filters['complevel'] != encoding.get('complevel', 4):
+        return False
+    # Shuffle is only applied with compression
+    if filters['zlib'] and bool(filters['shuffle']) != bool(encoding.get('shuffle', True)):
+        return False
+    return bool(filters['fletcher32']) == bool(encoding.get('fletcher32', False))
+
+def timealigned(segments, lengths, timechunk):
+    """
+    Return True if copying whole chunks of timechunk times from each
+    (file, start, stop) in segments fills the output exactly: every
+    segment starts on a chunk boundary, and ends on one unless it is the
+    last segment and ends at the end of its file
+    """
+    for n, (i, start, stop) in enumerate(segments):
+        if start % timechunk != 0:
+            return False
+        if stop % timechunk != 0 and (stop != lengths[i] or n != len(segments) - 1):
+            return False
+    return True
+
+def h5filters(dset):
+    """
+    Return the filters of h5py Dataset dset in the same form as netCDF4
+    Variable.filters(). Filters netCDF4 doesn't know are under 'other'
+    """
+    filters = {name: False for name in HDF5_FILTERS.values()}
+    filters.update(complevel=0, other=False)
+    for filter, values in filterpipeline(dset):
+        name = HDF5_FILTERS.get(filter, 'other')
+        filters[name] = True
+        if name == 'zlib':
+            filters['complevel'] = values[0]
+    return filters
+
+def h5attr(dset, name, default=None):
+    """
+    Return string attribute name of h5py Dataset dset, or default if it
+    isn't set
+    """
+    value = dset.attrs.get(name, default)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return value
+
+def h5dimensions(dset):
+    """
+    Return the names of the netCDF dimensions of h5py Dataset dset, or
+    None if they aren't all attached, as for dimensions themselves
+    """
+    if any(len(dim) == 0 for dim in dset.dims):
+        return None
+    return tuple(dim[0].name.split('/')[-1] for dim in dset.dims)
+
+class ChunkSources(object):
+    """
+    Chunking, compression and times of the variables in input files
+    paths, concatenated in time order along timedim, with time coordinate
+    index. If the times have been changed since (--timeshift, --usebounds),
+    times is the index of the times of the inputs, in the same order.
+    calendar overrides the calendar of the inputs. Used to find which
+    variables of an output can be copied chunk by chunk from the inputs
+    """
+
+    def __init__(self, paths, timedim, index, times=None, calendar=None):
+        import h5py
+
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.timedim = timedim
+        self.index = index
+        self.times = np.asarray(index if times is None else times)
+        self.lengths = []
+        self.layouts = []
+        self.filetimes = []
+        for path in self.paths:
+            try:
+                f = h5py.File(path, 'r')
+            except OSError:
+                # Not a netCDF4 file, so nothing can be copied from it
+                self.lengths.append(0)
+                self.layouts.append({})
+                self.filetimes.append(None)
+                continue
+            with f:
+                self.lengths.append(len(f[timedim]))
+                self.layouts.append(self.filelayout(f))
+                self.filetimes.append(self.filetimevalues(f[timedim], calendar))
+
+        # The inputs are concatenated in time order, which needn't be the
+        # order they were given in
+        starts = {i: times[0] for (i, times) in enumerate(self.filetimes) if times is not None and len(times)}
+        self.order = sorted(starts, key=starts.get)
+        self.offsets = np.cumsum([0] + [self.lengths[i] for i in self.order])
+
+    def filelayout(self, f):
+        """
+        Return {name: (dims, chunks, filters, dtype)} for the chunked
+        variables with the time dimension in h5py File f
+        """
+        import h5py
+
+        layout = {}
+        for name, dset in f.items():
+            if not isinstance(dset, h5py.Dataset) or dset.chunks is None:
+                continue
+            dims = h5dimensions(dset)
+            if dims is None or self.timedim not in dims:
+                continue
+            layout[name] = (dims, dset.chunks, h5filters(dset), dset.dtype)
+        return layout
+
+    def filetimevalues(self, dset, calendar=None):
+        """
+        Return the times in h5py Dataset dset decoded the same way as the
+        concatenated times, or None if they can't be decoded
+        """
+        units = h5attr(dset, 'units')
+        if units is None:
+            return None
+        calendar = calendar or h5attr(dset, 'calendar', 'standard')
+        try:
+            return decodetimes(dset[()], units, calendar.lower())
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+    def segments(self, ds):
+        """
+        Return a list of (file number, start, stop) of the time period in
+        ds, or None if the times of ds are not a contiguous block of times
+        of the inputs
+        """
+        if not self.index.is_unique or self.offsets[-1] != len(self.times):
+            return None
+        positions = self.index.get_indexer(ds.indexes[self.timedim])
+        if len(positions) == 0 or (positions < 0).any() or (np.diff(positions) != 1).any():
+            return None
+        start, stop = positions[0], positions[-1] + 1
+        segments = []
+        for i, first, last in zip(self.order, self.offsets[:-1], self.offsets[1:]):
+            if max(start, first) < min(stop, last):
+                begin, end = max(start, first), min(stop, last)
+                # Only copy from a file if its times are those of the output
+                if not np.array_equal(self.filetimes[i][begin - first:end - first], self.times[begin:end]):
+                    logger.debug('Times of {} do not match the output, not copying chunks'.format(self.paths[i]))
+                    return None
+                segments.append((i, begin - first, end - first))
+        return segments
+
+    def find(self, ds, layout=None):
+        """
+        Return {name: (axis, [(path, start, stop), ...])} for the variables
+        in ds to copy chunk by chunk from the inputs. Any other variables
+        are loaded when written, so unless every data variable with the 
+        time dimension which has not already been loaded can be copied, 
+        none are. Unless a layout has set the output chunks, output chunks 
+        are set to match the inputs
+        """
+        segments = self.segments(ds)
+        if segments is None:
+            return {}
+        sources = {}
+        for name, var in ds.data_vars.items():
+            if not isinstance(var.data, dask.array.Array) or self.timedim not in var.dims:
+                continue
+            layouts = [self.layouts[i].get(name) for (i, start, stop) in segments]
+            if layouts[0] is None or any(l != layouts[0] for l in layouts[1:]):
+                return {}
+            dims, chunks, filters, dtype = layouts[0]
+            if dims != var.dims or np.dtype(var.encoding.get('dtype', var.dtype)) != dtype:
+                return {}
+            if not filterssame(filters, var.encoding):
+                return {}
+            if layout is not None and tuple(var.encoding.get('chunksizes', ())) != chunks:
+                return {}
+            axis = dims.index(self.timedim)
+            if not timealigned(segments, self.lengths, chunks[axis]):
+                return {}
+            sources[name] = (axis, [(self.paths[i], start, stop) for (i, start, stop) in segments])
+        for name in sources:
+            encoding = ds[name].encoding
+            encoding['chunksizes'] = self.layouts[segments[0][0]][name][1]
+            encoding['contiguous'] = False
+            encoding.pop('original_shape', None)
+        return sources
+
+def filterpipeline(dset):
+    """
+    Return the list of (filter, parameters) applied to chunks of h5py
+    Dataset dset
+    """
+    plist = dset.id.get_create_plist()
+    return [plist.get_filter(i)[0:3:2] for i in range(plist.get_nfilters())]
+
+def samestorage(source, target):
+    """
+    Return True if chunks of h5py Dataset source can be copied to target
+    """
+    return (source.chunks == target.chunks and source.dtype == target.dtype and
+            filterpipeline(source) == filterpipeline(target))
+
+def copychunks(target, name, axis, segments):
+    """
+    Copy the compressed chunks of variable name in each (path, start, stop)
+    in segments to h5py Dataset target, in order along axis. Returns the
+    number of chunks copied, or None if the chunks of any input can't be
+    copied to target
+    """
+    import h5py
+
+    nchunks = 0
+    offset = 0
+    for path, start, stop in segments:
+        with h5py.File(path, 'r') as f:
+            source = f[name]
+            if not samestorage(source, target):
+                return None
+            ranges = [range(0, n, c) for (n, c) in zip(source.shape, source.chunks)]
+            ranges[axis] = range(start, stop, source.chunks[axis])
+            for coords in itertools.product(*ranges):
+                if source.id.get_chunk_info_by_coord(coords).byte_offset is None:
+                    # Chunk never written, so reads as the fill value
+                    continue
+                mask, data = source.id.read_direct_chunk(coords)
+                coords = list(coords)
+                coords[axis] += offset - start
+                target.id.write_direct_chunk(tuple(coords), data, mask)
+                nchunks += 1
+        offset += stop - start
+    return nchunks
+
+def ncattr(value):
+    """
+    Return attribute value as it should be written with h5netcdf. Strings
+    are fixed length, which the netCDF library reads as text, the same as
+    it writes them
+    """
+    if isinstance(value, str):
+        return np.bytes_(value.encode('utf-8'))
+    return value
+
+def definevariables(filename, variables, attrs, sources, unlimited=None):
+    """
+    Add the CF encoded variables in sources to netCDF file filename, with
+    the same chunks and filters as their first input, but without any data.
+    attrs are the global attributes of the encoded dataset
+    """
+    import h5netcdf
+    import h5py
+
+    with h5netcdf.File(filename, 'a') as f:
+        # Coordinates only used by the variables added are listed in a
+        # global coordinates attribute if they are left out
+        if 'coordinates' in attrs:
+            f.attrs['coordinates'] = ncattr(attrs['coordinates'])
+        elif 'coordinates' in f.attrs:
+            del f.attrs['coordinates']
+        for name in sources:
+            var = variables[name]
+            axis, segments = sources[name]
+            with h5py.File(segments[0][0], 'r') as source:
+                dcpl = source[name].id.get_create_plist()
+                chunks = source[name].chunks
+            for dim, size in zip(var.dims, var.shape):
+                if dim not in f.dimensions:
+                    f.dimensions[dim] = None if unlimited and dim in unlimited else size
+            varattrs = dict(var.attrs)
+            fillvalue = varattrs.pop('_FillValue', None)
+            target = f.create_variable(name, var.dims, var.dtype, chunks=chunks, fillvalue=fillvalue, dcpl=dcpl)
+            target.attrs.update({k: ncattr(v) for (k, v) in varattrs.items()})
+
+def writepassthrough(ds, filename, sources, unlimited=None, engine='netcdf4'):
+    """
+    Write ds to netCDF file filename, copying the compressed chunks of the
+    variables in sources (see ChunkSources.find) from the input files
+    rather than computing them. All other variables are loaded and written
+    as usual. Returns False, and removes filename, if the chunks of any of
+    the inputs can't be copied, so it must be written normally
+    """
+    try:
+        import h5netcdf
+        import h5py
+    except ImportError:
+        return False
+
+    ds = ds.copy()
+    for name, var in ds.variables.items():
+        if name not in sources:
+            var.load()
+
+    # Everything else is written first, then the variables to copy are 
+    # defined as they would be encoded and their chunks copied
+    if unlimited is not None and type(unlimited) is str:
+        unlimited = [unlimited]
+    variables, attrs = xarray.conventions.encode_dataset_coordinates(ds)
+    variables, attrs = xarray.conventions.cf_encoder({name: variables[name] for name in sources}, attrs)
+    ds.drop_vars(list(sources)).to_netcdf(filename, format='NETCDF4', engine=engine, unlimited_dims=unlimited)
+    definevariables(filename, variables, attrs, sources, unlimited)
+
+    copied = True
+    with h5py.File(filename, 'r+') as f:
+        for name, (axis, segments) in sources.items():
+            target = f[name]
+            if target.shape[axis] < ds[name].shape[axis]:
+                target.resize(ds[name].shape[axis], axis=axis)
+            nchunks = copychunks(target, name, axis, segments)
+            if nchunks is None:
+                copied = False
+                break
+            logger.debug('Copied {} chunks of {} from {} input files'.format(nchunks, name, len(segments)))
+    if not copied:
+        logger.debug('Chunks of {} do not match its inputs, writing normally'.format(filename))
+        os.remove(filename)
+    return copied
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Periods of time in a time coordinate. The boundaries of the periods of a
+frequency are found once, by a binary search of the times for the period
+boundaries, and the data in each period is selected by position. Encoded
+times are searched as numbers, and only the boundaries are converted to
+and from dates.
+
+The boundaries are calculated with calendar arithmetic on day numbers,
+for every CF calendar, so no dates are made for them unless the times
+searched are cftime objects. Frequencies without a fixed relation to the
+calendar, e.g. weeks and business days, use the periods found by xarray
+resample instead.
+"""
+
+from __future__ import print_function
+
+import datetime
+
+import cftime
+import numpy as np
+import pandas as pd
+import xarray
+
+# Offsets whose periods include their end rather than their start, and
+# are labelled by their end, in resample
+END_OFFSETS = ('M', 'A', 'Q', 'BM', 'BA', 'BQ', 'W')
+
+# Names of the CF calendars used by the calendar arithmetic
+CALENDARS = {'standard': 'standard', 'gregorian': 'standard', 'proleptic_gregorian': 'proleptic_gregorian',
+             'julian': 'julian', 'noleap': 'noleap', '365_day': 'noleap', 'all_leap': 'all_leap',
+             '366_day': 'all_leap', '360_day': '360_day'}
+
+# Days in each month of the calendars with the same months every year
+MONTH_DAYS = {'noleap': [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+              'all_leap': [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+              '360_day': [30] * 12}
+
+# Julian day number of the first day of the Gregorian calendar, 1582-10-15
+GREGORIAN_START = 2299161
+
+# Months in the period of each calendar offset, and the attribute holding
+# the month the periods are anchored to
+CALENDAR_OFFSETS = {
+    pd.offsets.MonthBegin: (1, None), pd.offsets.MonthEnd: (1, None),
+    pd.offsets.QuarterBegin: (3, 'startingMonth'), pd.offsets.QuarterEnd: (3, 'startingMonth'),
+    pd.offsets.YearBegin: (12, 'month'), pd.offsets.YearEnd: (12, 'month'),
+}
+
+SECONDS_PER_DAY = 86400
+
+# Units boundaries are converted to cftime objects from, exact for whole
+# seconds in any calendar
+OBJECT_UNITS = 'seconds since 1970-01-01'
+
+def isencoded(var):
+    """
+    Return True if time variable var holds numeric times with CF units
+    """
+    return var.dtype.kind in 'iuf' and ' since ' in var.attrs.get('units', '')
+
+def searchabletimes(var):
+    """
+    Return (values, units, calendar) of time variable var, which can be
+    decoded (datetime64 or cftime objects) or encoded. values can be
+    searched for times converted by encodetimes with units and calendar:
+    numeric times if encoded, nanoseconds for datetime64 values, and
+    otherwise the cftime objects themselves, which are ordered. units and
+    calendar are None unless var is encoded
+    """
+    if isencoded(var):
+        return np.asarray(var.values), var.attrs['units'], var.attrs.get('calendar', 'standard')
+    values = np.asarray(var.values)
+    if values.dtype.kind == 'M':
+        values = values.astype('datetime64[ns]').astype(np.int64)
+    return values, None, None
+
+def encodetimes(dates, units, calendar):
+    """
+    Convert dates, datetime64 or cftime objects, to numeric times in units
+    and calendar, or if units is None to values which can be searched for
+    in decoded times (see searchabletimes)
+    """
+    dates = np.asarray(dates)
+    if dates.dtype.kind == 'M':
+        if units is None:
+            return dates.astype('datetime64[ns]').astype(np.int64)
+        dates = dates.astype('datetime64[us]').astype(object)
+    if units is None:
+        return dates
+    return np.asarray(cftime.date2num(dates, units, calendar))
+
+def decodetimes(values, units, calendar):
+    """
+    Return the dates of numeric times values, as decoded by xarray
+    """
+    var = xarray.Variable(('time',), values, {'units': units, 'calendar': calendar})
+    return xarray.conventions.decode_cf_variable('time', var).values
+
+def closedright(freq):
+    """
+    Return True if the periods of freq include their end time rather than
+    their start time
+    """
+    rule = pd.tseries.frequencies.to_offset(freq).rule_code
+    return rule.split('-')[0] in END_OFFSETS
+
+def daynumber(year, month, day, calendar):
+    """
+    Return the number of days since a fixed day, the same for every date in
+    calendar, of each year, month and day (integers or arrays). Years are
+    astronomical, so year 0 is the year before year 1 in all calendars
+    """
+    year, month, day = (np.asarray(a, dtype=np.int64) for a in (year, month, day))
+    if calendar in MONTH_DAYS:
+        lengths = np.array(MONTH_DAYS[calendar])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        return year * lengths.sum() + starts[month - 1] + day - 1
+    # Julian day number, with years starting in March so leap days are
+    # the last day of the year
+    a = (14 - month) // 12
+    y = year + 4800 - a
+    m = month + 12 * a - 3
+    days = day + (153 * m + 2) // 5 + 365 * y + y // 4
+    julian = days - 32083
+    gregorian = days - y // 100 + y // 400 - 32045
+    if calendar == 'julian':
+        return julian
+    if calendar == 'proleptic_gregorian':
+        return gregorian
+    return np.where(gregorian >= GREGORIAN_START, gregorian, julian)
+
+def datefields(date, calendar):
+    """
+    Return (astronomical year, month, day, seconds since midnight) of date,
+    a cftime or python datetime in calendar
+    """
+    year = date.year
+    if year < 0 and not getattr(date, 'has_year_zero', calendar == 'proleptic_gregorian'):
+        year += 1
+    seconds = date.hour * 3600 + date.minute * 60 + date.second + date.microsecond * 1e-6
+    return year, date.month, date.day, seconds
+
+class TimeAxis(object):
+    """
+    Conversion between (day number, seconds since midnight) of dates in
+    calendar (see daynumber) and numeric times in units, or nanoseconds
+    since 1970-01-01 if units is None
+    """
+
+    def __init__(self, units, calendar):
+        self.units = units
+        self.calendar = CALENDARS[calendar.lower()]
+        if units is None:
+            reference = datetime.datetime(1970, 1, 1)
+            self.unitseconds = 1e-9
+        else:
+            reference = cftime.num2date(0, units, calendar)
+            self.unitseconds = (cftime.num2date(1, units, calendar) - reference).total_seconds()
+        year, month, day, self.refseconds = datefields(reference, self.calendar)
+        self.refday = int(daynumber(year, month, day, self.calendar))
+
+    def fields(self, date):
+        """
+        Return (day number, seconds since midnight, astronomical year,
+        month) of date
+        """
+        year, month, day, seconds = datefields(date, self.calendar)
+        return int(daynumber(year, month, day, self.calendar)), seconds, year, month
+
+    def times(self, days, seconds):
+        """
+        Return the numeric times of arrays of day numbers and seconds
+        """
+        days = np.asarray(days, dtype=np.int64) - self.refday
+        if self.units is None:
+            # Integer nanoseconds, which can't be represented exactly as floats
+            return days * SECONDS_PER_DAY * 10**9 + np.round((np.asarray(seconds) - self.refseconds) * 1e9).astype(np.int64)
+        return (days * (SECONDS_PER_DAY / self.unitseconds) +
+                (np.asarray(seconds) - self.refseconds) / self.unitseconds)
+
+def monthstartdays(months, calendar):
+    """
+    Return the day numbers of the first day of each of months, numbered
+    from the first month of year 0
+    """
+    months = np.asarray(months)
+    return daynumber(months // 12, months % 12 + 1, 1, calendar)
+
+def calendarperiods(first, last, freq, calendar):
+    """
+    Return (starts, labels) of the periods of freq spanning first to last,
+    (day number, seconds, year, month) in calendar (see TimeAxis.fields),
+    the same periods as resample:
+    starts are (day numbers, seconds) of the start of each period and one
+    past the end of the last, and labels are (day numbers, seconds) of the
+    label of each period. Returns None if freq isn't fixed to the calendar
+    """
+    offset = pd.tseries.frequencies.to_offset(freq)
+    if isinstance(offset, pd.offsets.Tick):
+        # Periods of a fixed length, starting at midnight on the first day
+        step = offset.nanos / 1e9
+        count = int(((last[0] - first[0]) * SECONDS_PER_DAY + last[1]) // step) + 2
+        elapsed = np.arange(count) * step
+        starts = (first[0] + elapsed // SECONDS_PER_DAY, elapsed % SECONDS_PER_DAY)
+        return starts, (starts[0][:-1], starts[1][:-1])
+    if type(offset) not in CALENDAR_OFFSETS:
+        return None
+
+    # Month numbers of the periods, anchored to the anchor month of each
+    # year, or for end offsets on the month before
+    months, attribute = CALENDAR_OFFSETS[type(offset)]
+    anchor = (getattr(offset, attribute) - 1) % months if attribute else 0
+    firstmonth, lastmonth = (12 * year + month - 1 for (year, month) in (first[2:], last[2:]))
+    step = months * offset.n
+    end = closedright(freq)
+    if end:
+        start = firstmonth - 1 - (firstmonth - 1 - anchor) % months - months * (offset.n - 1) + 1
+    else:
+        start = firstmonth - (firstmonth - anchor) % months
+    monthstarts = np.arange(start, lastmonth + step + 1, step)
+    monthstarts = monthstarts[:np.searchsorted(monthstarts, lastmonth, side='right') + 1]
+
+    days = monthstartdays(monthstarts, calendar)
+    zeros = np.zeros(len(days))
+    starts = (days, zeros)
+    if end:
+        # Labelled by the last day of the period
+        labels = (days[1:] - 1, zeros[1:])
+    else:
+        labels = (days[:-1], zeros[:-1])
+    return starts, labels
+
+def timestep(var):
+    """
+    Return the smallest step between the times of time variable var as a
+    pandas Timedelta
+    """
+    values, units, calendar = searchabletimes(var)
+    if len(values) < 2:
+        return pd.Timedelta(0)
+    if units is not None:
+        unitseconds = TimeAxis(units, calendar).unitseconds
+        return pd.Timedelta(seconds=np.diff(values).min() * unitseconds)
+    return pd.Timedelta(np.diff(values).min())
+
+class PeriodIndex(object):
+    """
+    Positions of the periods of freq in time variable var, which must be
+    in increasing order. Periods are the same as xarray resample would
+    find, and periods without any times are dropped. labels is the time
+    coordinate of the periods, as labelled by resample, and starts and
+    ends the index of the first time in each period and one past the last
+    """
+
+    def __init__(self, var, freq):
+        self.freq = freq
+        self.dim = var.dims[0]
+        values, units, calendar = searchabletimes(var)
+        if (values[1:] < values[:-1]).any():
+            raise ValueError('Times of {} must be in increasing order'.format(var.name))
+
+        # Boundaries are converted to the units of encoded times, to
+        # nanoseconds for datetime64 and to cftime objects otherwise
+        self.objects = values.dtype.kind == 'O'
+        axisunits = units
+        if isencoded(var):
+            span = cftime.num2date(values[[0, -1]], units, calendar)
+        elif self.objects:
+            span = values[[0, -1]]
+            calendar = span[0].calendar or 'standard'
+            axisunits = OBJECT_UNITS
+        else:
+            span = pd.to_datetime(values[[0, -1]]).to_pydatetime()
+            calendar = 'proleptic_gregorian'
+        self.units, self.calendar = units, calendar
+
+        periods = None
+        if calendar.lower() in CALENDARS:
+            self.axis = TimeAxis(axisunits, calendar)
+            first, last = (self.axis.fields(date) for date in span)
+            periods = calendarperiods(first, last, freq, self.axis.calendar)
+        if periods is None:
+            starts, stops, labels = self.resampleperiods(var, values, units, calendar, freq)
+        else:
+            edges, labels = periods
+            edges = self.axis.times(*edges)
+            if self.objects:
+                edges = cftime.num2date(edges, OBJECT_UNITS, calendar, only_use_cftime_datetimes=True)
+            elif units is not None:
+                # Times within half a microsecond of a boundary, which
+                # are decoded to the boundary, are in the later period
+                edges = edges - 0.5e-6 / self.axis.unitseconds
+            starts = np.searchsorted(values, edges[:-1], side='left')
+            stops = np.searchsorted(values, edges[1:], side='left')
+
+        nonempty = stops > starts
+        self.starts = starts[nonempty]
+        self.ends = stops[nonempty]
+        if isinstance(labels, xarray.DataArray):
+            self._labels = labels.isel({self.dim: nonempty})
+        else:
+            self._labels = tuple(np.asarray(a)[nonempty] for a in labels)
+
+    def resampleperiods(self, var, values, units, calendar, freq):
+        """
+        Return (starts, stops, labels) of the periods of freq found by
+        resampling the first and last times of var
+        """
+        # Only the first and last times are needed to find all the periods
+        # spanned, as resample would
+        if isencoded(var):
+            span = decodetimes(values[[0, -1]], units, calendar)
+        else:
+            span = np.asarray(var.values)[[0, -1]]
+        span = xarray.DataArray([0, 0], coords={self.dim: span}, dims=self.dim)
+        labels = span.resample({self.dim: freq}).count()[self.dim]
+
+        # Periods start at their labels, or for end offsets end on the day
+        # of their labels
+        if closedright(freq):
+            ends = labels.values + (np.timedelta64(1, 'D') if labels.dtype.kind == 'M' else datetime.timedelta(days=1))
+            stops = np.searchsorted(values, encodetimes(ends, units, calendar), side='left')
+            starts = np.insert(stops[:-1], 0, 0)
+        else:
+            edges = encodetimes(labels.values, units, calendar)
+            starts = np.searchsorted(values, edges, side='left')
+            stops = np.append(starts[1:], len(values))
+        return starts, stops, labels
+
+    @property
+    def labels(self):
+        """
+        Time coordinate of the periods, as labelled by resample, with the
+        same type of dates as the times
+        """
+        if isinstance(self._labels, tuple):
+            # Only converted to dates when needed
+            times = self.axis.times(*self._labels)
+            if self.objects:
+                dates = cftime.num2date(times, OBJECT_UNITS, self.calendar, only_use_cftime_datetimes=True)
+            elif self.units is not None:
+                dates = decodetimes(times, self.units, self.calendar)
+                if dates.dtype.kind == 'M':
+                    # Without the rounding errors of decoding floats
+                    dates = pd.DatetimeIndex(dates).round('us').values
+            else:
+                dates = times.astype('datetime64[ns]')
+            self._labels = xarray.DataArray(dates, coords={self.dim: dates}, dims=self.dim)[self.dim]
+        return self._labels
+
+    @property
+    def counts(self):
+        """
+        Number of times in each period
+        """
+        return self.ends - self.starts
+
+    def __len__(self):
+        return len(self.starts)
+
+    def slices(self):
+        """
+        Return a list of the slice of times in each period
+        """
+        return [slice(start, end) for (start, end) in zip(self.starts, self.ends)]
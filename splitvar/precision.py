@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Reducing the precision of output variables so they compress better:
+rounding floating point data to a number of significant bits (BitRound)
+or decimal digits (GranularBitRound), the same as netCDF-C 4.9 quantize,
+and packing into integers with scale_factor and add_offset.
+"""
+
+from __future__ import print_function
+
+import dask
+import dask.array
+import numpy as np
+
+# Integer types floating point data can be packed into
+PACK_TYPES = ('int8', 'int16', 'int32')
+
+# Attributes netCDF-C sets on quantized variables
+QUANTIZE_ATTRIBUTES = {'bitround': '_QuantizeBitRoundNumberOfSignificantBits',
+                       'granularbitround': '_QuantizeGranularBitRoundNumberOfSignificantDigits'}
+
+def parsevariablespec(spec, convert):
+    """
+    Parse VALUE or VARIABLE=VALUE, returning (variable, value) where value
+    is convert(VALUE), or None if VALUE is none. variable is None if not
+    specified
+    """
+    variable = None
+    if '=' in spec:
+        variable, spec = spec.split('=', 1)
+    if spec == 'none':
+        return variable, None
+    return variable, convert(spec)
+
+def parsevariablespecs(specs, convert):
+    """
+    Return a dictionary of values by variable name from a list of
+    specifications (see parsevariablespec). The value for all other
+    variables is under the key None
+    """
+    return dict(parsevariablespec(spec, convert) for spec in specs)
+
+def keepbits(value):
+    """
+    Convert value to a number of mantissa bits to keep
+    """
+    nbits = int(value)
+    if nbits < 0:
+        raise ValueError('Number of bits to keep must be at least 0: {}'.format(value))
+    return nbits
+
+def significantdigits(value):
+    """
+    Convert value to a number of significant decimal digits to keep
+    """
+    ndigits = int(value)
+    if ndigits < 1:
+        raise ValueError('Number of significant digits must be at least 1: {}'.format(value))
+    return ndigits
+
+def packtype(value):
+    """
+    Check value is one of PACK_TYPES
+    """
+    if value not in PACK_TYPES:
+        raise ValueError('Unknown packing type {}, must be one of {}'.format(value, ', '.join(PACK_TYPES)))
+    return value
+
+def roundmantissa(data, maskbits):
+    """
+    Round the mantissas of floating point array data to zero the lowest
+    maskbits bits, which can be an array of the same shape as data. Ties
+    are rounded to even. Non-finite values are unchanged
+    """
+    utype = np.dtype('u{}'.format(data.dtype.itemsize)).type
+    one = utype(1)
+    maskbits = np.asarray(maskbits).astype(utype)
+    bits = np.ascontiguousarray(data).view(utype)
+    # Add half the quantum, less one unless the lowest bit kept is odd
+    # (nothing if no bits are masked), then zero the masked bits
+    mask = (one << maskbits) - one
+    rounded = (mask >> one) + ((bits >> maskbits) & one)
+    rounded &= mask
+    rounded += bits
+    rounded &= ~mask
+    rounded = rounded.view(data.dtype)
+    finite = np.isfinite(data)
+    if not finite.all():
+        rounded[~finite] = data[~finite]
+    return rounded
+
+def bitround(data, nbits):
+    """
+    Return floating point array data rounded to nbits mantissa bits
+    """
+    mantissa = np.finfo(data.dtype).nmant
+    if nbits >= mantissa:
+        return data
+    return roundmantissa(data, mantissa - nbits)
+
+def granularbitround(data, ndigits):
+    """
+    Return floating point array data rounded to the fewest mantissa bits
+    which keep ndigits significant decimal digits of each value
+    """
+    mantissa = np.finfo(data.dtype).nmant
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Power of two of the largest quantum no bigger than a unit in the
+        # last significant decimal digit, less that of the leading bit
+        maskbits = np.log10(np.abs(data))
+        np.floor(maskbits, out=maskbits)
+        maskbits += 1 - ndigits
+        maskbits *= np.log2(10)
+        np.floor(maskbits, out=maskbits)
+        maskbits -= np.frexp(data)[1] - 1
+        maskbits += mantissa
+    # Zero and non-finite values are not rounded
+    maskbits[~np.isfinite(maskbits)] = 0
+    np.clip(maskbits, 0, mantissa, out=maskbits)
+    return roundmantissa(data, maskbits)
+
+def quantize(var, function, nvalue):
+    """
+    Return DataArray var with function (bitround or granularbitround)
+    applied with nvalue to its data, lazily if it is a dask array
+    """
+    data = var.data
+    if isinstance(data, dask.array.Array):
+        data = data.map_blocks(function, nvalue, dtype=data.dtype)
+    else:
+        data = function(np.asarray(data), nvalue)
+    var = var.copy(data=data)
+    var.attrs[QUANTIZE_ATTRIBUTES[function.__name__]] = nvalue
+    return var
+
+def trimmable(ds, timevar):
+    """
+    Return the names of the floating point data variables of ds with the
+    time dimension, the only variables precision is reduced for
+    """
+    timedim = ds[timevar].dims[0]
+    return [name for (name, var) in ds.data_vars.items()
+            if timedim in var.dims and var.dtype.kind == 'f']
+
+def byvariable(values, names):
+    """
+    Return {name: value} for each of names with a value in values, a
+    dictionary of values by variable name, with the value for all other
+    variables under the key None
+    """
+    selected = {}
+    for name in names:
+        value = values.get(name, values.get(None))
+        if value is not None:
+            selected[name] = value
+    return selected
+
+def setprecision(ds, timevar, nbits=None, ndigits=None):
+    """
+    Round the floating point data variables of ds with the time dimension
+    to nbits mantissa bits or ndigits significant decimal digits, both
+    dictionaries of values by variable name, with the value for all other
+    variables under the key None. Variables with a value in both are
+    rounded to the number of bits
+    """
+    names = trimmable(ds, timevar)
+    digits = byvariable(ndigits or {}, names)
+    bits = byvariable(nbits or {}, names)
+    for name, value in digits.items():
+        if name not in bits:
+            ds[name] = quantize(ds[name], granularbitround, value)
+    for name, value in bits.items():
+        ds[name] = quantize(ds[name], bitround, value)
+
+def packencoding(vmin, vmax, dtype, floattype):
+    """
+    Return the encoding to pack floating point values of floattype
+    between vmin and vmax into integer type dtype. The smallest integer is
+    reserved as the fill value
+    """
+    info = np.iinfo(dtype)
+    # Leave half a step spare at each end so rounding can't overflow
+    nsteps = float(info.max) - float(info.min) - 2
+    if not (np.isfinite(vmin) and np.isfinite(vmax)):
+        vmin, vmax = 0., 0.
+    scale = (float(vmax) - float(vmin)) / nsteps if vmax > vmin else 1.
+    offset = (float(vmax) + float(vmin)) / 2
+    return {'dtype': dtype, 'scale_factor': floattype(scale), 'add_offset': floattype(offset),
+            '_FillValue': np.dtype(dtype).type(info.min)}
+
+def setpacking(ds, timevar, packs):
+    """
+    Set the encoding of the floating point data variables of ds with the
+    time dimension to pack them into the integer types in packs, a
+    dictionary of types by variable name, with the type for all other
+    variables under the key None. The range of each variable is computed
+    from its data
+    """
+    types = byvariable(packs, trimmable(ds, timevar))
+    if not types:
+        return
+    ranges = dask.compute(*[(ds[name].min(), ds[name].max()) for name in types])
+    for (name, dtype), (vmin, vmax) in zip(types.items(), ranges):
+        vmin, vmax = float(vmin), float(vmax)
+        encoding = ds[name].encoding
+        for key in ('scale_factor', 'add_offset', '_FillValue', 'missing_value'):
+            encoding.pop(key, None)
+        encoding.update(packencoding(vmin, vmax, dtype, ds[name].dtype.type))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Instrumentation of a splitvar run: the time spent in each stage, the size of
+the data, the bytes written and the number of outputs, overall and for each
+output file, saved as a JSON report.
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+import contextlib
+import datetime
+import json
+import logging
+import os
+import time
+
+from .manifest import outputsize
+from .memory import peakrss
+
+logger = logging.getLogger(__name__)
+
+# Increment when the layout of the report changes
+REPORT_VERSION = 2
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+class RunProfile(object):
+    """
+    Time spent in each stage of a run, and the outputs written. Stages can
+    be nested, and the time of a stage excludes the time of any stages
+    nested inside it, so the stage times add up to the total time
+    """
+
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.outputs = OrderedDict()
+        self.active = []
+
+    def add(self, name, **counts):
+        """
+        Add counts, e.g. bytes written, to stage name
+        """
+        stage = self.stages.setdefault(name, OrderedDict(time=0., calls=0))
+        for key, value in counts.items():
+            stage[key] = stage.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager which adds the time spent in the context to stage
+        name, excluding time spent in any nested stages
+        """
+        self.add(name)
+        self.active.append(0.)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.active.pop()
+            self.stages[name]['time'] += elapsed - nested
+            self.stages[name]['calls'] += 1
+            if self.active:
+                self.active[-1] += elapsed
+
+    def iterate(self, iterable, name):
+        """
+        Yield the items of iterable, adding the time taken to produce each
+        item to stage name
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def track(self, outputs):
+        """
+        Yield each (dataset, filename) in outputs, recording the time it was
+        ready to be written and the size of its data uncompressed in memory.
+        This is not the number of bytes read from the inputs, which may be
+        compressed or only partly read
+        """
+        for ds, filename in outputs:
+            self.outputs[os.path.abspath(filename)] = OrderedDict([
+                ('path', filename),
+                ('variables', [v for v in ds.data_vars]),
+                ('nbytes', int(ds.nbytes)),
+                ('ready', time.perf_counter()),
+            ])
+            yield ds, filename
+
+    def finish(self, filename):
+        """
+        Record output filename as completely written
+        """
+        output = self.outputs[os.path.abspath(filename)]
+        output['time'] = time.perf_counter() - output.pop('ready')
+        output['bytes_written'] = outputsize(filename)
+        self.add('write', outputs=1, nbytes=output['nbytes'],
+                 bytes_written=output['bytes_written'])
+
+    def report(self):
+        """
+        Return the report as a dictionary
+        """
+        elapsed = time.perf_counter() - self.start
+        finished = [o for o in self.outputs.values() if 'time' in o]
+        return OrderedDict([
+            ('version', REPORT_VERSION),
+            ('started', self.started.isoformat()),
+            ('time', elapsed),
+            ('peak_rss', peakrss()),
+            ('peak_rss_workers', peakrss(children=True)),
+            ('outputs', len(finished)),
+            ('nbytes', sum(o['nbytes'] for o in finished)),
+            ('bytes_written', sum(o['bytes_written'] for o in finished)),
+            ('stages', self.stages),
+            ('files', finished),
+        ])
+
+    def write(self, path):
+        """
+        Write the report to path as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+@contextlib.contextmanager
+def profiler(name, path):
+    """
+    Context manager which profiles the code in the context with name, one
+    of PROFILERS, and saves the results to path: cProfile statistics,
+    which can be read with pstats or snakeviz, or a pyinstrument HTML page.
+    Does nothing if name is None
+    """
+    if name is None:
+        yield
+    elif name == 'cprofile':
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(path)
+    elif name == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.error('pyinstrument is not installed, use --profiler cprofile instead')
+            raise
+        prof = Profiler()
+        prof.start()
+        try:
+            yield
+        finally:
+            prof.stop()
+            with open(path, 'w') as f:
+                f.write(prof.output_html())
+    else:
+        raise ValueError('Unknown profiler {}, must be one of {}'.format(name, ', '.join(PROFILERS)))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the 'License');
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an 'AS IS' BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Logging and progress reporting: the number of outputs written, the bytes
+written, throughput and an estimate of the time remaining.
+"""
+
+from __future__ import print_function
+
+import datetime
+import logging
+import sys
+import time
+
+import dask
+
+from .manifest import outputsize
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
+# Seconds between progress messages when not writing to a terminal
+PROGRESS_INTERVAL = 60
+
+class ProgressHandler(logging.StreamHandler):
+    """
+    Log handler which clears the progress line on a terminal before each
+    message, so messages and progress don't overwrite each other
+    """
+
+    def emit(self, record):
+        if isatty(self.stream):
+            self.stream.write('\r\x1b[K')
+        super(ProgressHandler, self).emit(record)
+
+def isatty(stream):
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+def setuplogging(level='info', stream=None):
+    """
+    Log messages from splitvar at level, one of LOG_LEVELS, to stream,
+    stderr by default. Can be called more than once, the handler is replaced
+    """
+    splitvarlogger = logging.getLogger('splitvar')
+    splitvarlogger.setLevel(level.upper())
+    for handler in list(splitvarlogger.handlers):
+        if isinstance(handler, ProgressHandler):
+            splitvarlogger.removeHandler(handler)
+    handler = ProgressHandler(stream if stream is not None else sys.stderr)
+    if level == 'debug':
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s'))
+    else:
+        handler.setFormatter(logging.Formatter('%(message)s'))
+    splitvarlogger.addHandler(handler)
+    splitvarlogger.propagate = False
+
+class Progress(object):
+    """
+    Report progress writing total outputs, if known. On a terminal a
+    single line is updated after every output, otherwise progress is
+    logged every interval seconds. Outputs which are skipped, for example
+    because they are already finished, are not included in the estimate of
+    the time remaining
+    """
+
+    def __init__(self, total=None, stream=None, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.stream = stream if stream is not None else sys.stderr
+        self.tty = isatty(self.stream)
+        self.interval = interval
+        self.done = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def skip(self):
+        """
+        Record an output which won't be written
+        """
+        self.skipped += 1
+
+    def update(self, filename):
+        """
+        Record output filename as written, and report progress
+        """
+        self.done += 1
+        self.bytes += outputsize(filename)
+        now = time.perf_counter()
+        if self.tty:
+            self.stream.write('\r' + self.status() + '\x1b[K')
+            self.stream.flush()
+        elif now - self.last >= self.interval:
+            logger.info(self.status())
+            self.last = now
+
+    def remaining(self):
+        """
+        Return the estimated seconds until all outputs are written, or None
+        if it can't be estimated
+        """
+        if self.total is None or self.done == 0:
+            return None
+        left = max(0, self.total - self.done - self.skipped)
+        return (time.perf_counter() - self.start) / self.done * left
+
+    def status(self):
+        """
+        Return a one line summary of progress
+        """
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        if self.total is None:
+            status = '{} outputs'.format(self.done)
+        else:
+            status = '{}/{} outputs'.format(self.done, max(0, self.total - self.skipped))
+        if self.skipped:
+            status += ' ({} skipped)'.format(self.skipped)
+        status += ', {} written, {}/s'.format(dask.utils.format_bytes(self.bytes),
+                                              dask.utils.format_bytes(int(self.bytes / elapsed)))
+        remaining = self.remaining()
+        if remaining is not None and self.done + self.skipped < self.total:
+            status += ', ETA {}'.format(datetime.timedelta(seconds=round(remaining)))
+        return status
+
+    def close(self):
+        """
+        Clear the progress line and log a summary
+        """
+        if self.tty:
+            self.stream.write('\r\x1b[K')
+            self.stream.flush()
+        if self.done or self.skipped:
+            logger.info('Finished {} in {:.1f}s'.format(self.status(), time.perf_counter() - self.start))
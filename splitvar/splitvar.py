@@ -3,17 +3,32 @@
 from __future__ import print_function
 
 import argparse
-from collections import defaultdict
+from collections import defaultdict, deque
+import concurrent.futures
+import datetime
+import logging
+import multiprocessing
 import os
 import re
+import shutil
 
 import cftime
-import networkx
+import dask
+import dask.array
+import netCDF4
 import numpy as np
 import pandas as pd
 import sys
 import xarray
 
+from .compression import useplugins
+from .fileindex import datasetfromindex, indexfiles
+from .passthrough import writepassthrough
+from .periods import PeriodIndex, timestep
+from .utils import parse_date_bounds
+
+logger = logging.getLogger(__name__)
+
 def nested_groupby(dataarray, groupby):
     """From https://github.com/pydata/xarray/issues/324#issuecomment-265462343"""
     if len(groupby) == 1:
@@ -35,41 +50,36 @@ def splitbytime(var, freq, timedim='time'):
     """
 
     # Check freq is greater than or equal to the frequency of the variable
-    # (so delta is <)
+    # (so delta is <). The smallest step is no larger than the first, so
+    # all the steps are only needed if the first is larger than freq
     freq_delta = to_timedelta(freq) 
-    varvals = var.indexes[timedim].values
-    vardelta = pd.Timedelta(min(varvals[1:-1]-varvals[0:-2]))
+    vardelta = timestep(var[timedim][:3])
+    if freq_delta < vardelta:
+        vardelta = timestep(var[timedim][:-1])
     if (freq_delta < vardelta):
         # raise ValueError("Split frequency ({}) is higher than data frequency ({}): not supported".format(freq,strfdelta(vardelta,"{D}d {H}h {M}m {S}s")))
         raise ValueError("Split frequency ({}) is higher than data frequency ({}): not supported".format(freq,vardelta))
 
-    if (type(var.indexes[timedim][0]) == cftime.DatetimeNoLeap):
-        # Variable is using a non-standard noleap calendar
-        # Create a temporary pandas data frame with the start and end extracted time dimension
-        # and the same frequency, but this has leap years (not an issue for what we will use this)
-        pdtime = pd.DataFrame(index=pd.date_range(start=varvals[0]._to_real_datetime(),end=varvals[-1]._to_real_datetime(),freq=vardelta))
-        # Change the time dimension to datetime so it can be sliced correctly
-        var[timedim] = [d._to_real_datetime() for d in var.indexes[timedim].values]
-    else:
-        pdtime = pd.DataFrame(index=var.indexes[timedim])
-
-    # Use pandas time grouping to cycle through at freq, grabbing out
-    # the start and end points to select out data
-    for k, v in pdtime.groupby(pd.Grouper(freq=freq)):
-        s, e = v.index.values[[0,-1]]
-        yield var.sel(time=slice(pd.Timestamp(s),pd.Timestamp(e)))
+    for period in PeriodIndex(var[timedim], freq).slices():
+        yield var.isel({timedim: period})
 
-def groupbytime(var, freq, timedim='time'):
+def groupbytime(var, freq, timedim='time', periods=None):
     """
-    Given an xarray variable, split into periods of time defined by freq
+    Given an xarray variable, split into periods of time defined by freq.
+    periods, the PeriodIndex of freq for the times of var, is found if not
+    specified. Nothing is yielded if var does not vary in time
     """
+    if timedim not in var.dims:
+        return
     try:
-        for k, v in var.resample({timedim: freq}):
-            # copyattr(var,v)
-            v.attrs.update(var.attrs)
-            yield v
+        if periods is None:
+            periods = PeriodIndex(var[timedim], freq)
     except KeyError:
         return
+    for period in periods.slices():
+        v = var.isel({timedim: period})
+        v.attrs.update(var.attrs)
+        yield v
 
 def find_bounds(var, dim=None, **kwargs):
     """
@@ -105,6 +115,16 @@ def sum_timedelta(var, dim=None, **kwargs):
 
     return var.sum()
 
+def bounds_midpoint(bounds):
+    """
+    Return the midpoint of each pair of bounds, using integer division of
+    the width of the bounds. Bounds are in the last dimension. The result
+    is computed lazily if bounds is a dask array
+    """
+    start = bounds[..., 0]
+    end = bounds[..., 1]
+    return (end - start)//2 + start
+
 def get_time_type(var):
     """
     Inspect a variable and return it's time type, which can be either
@@ -112,52 +132,330 @@ def get_time_type(var):
     'datetime': is a date/time variable
     'delta': is a timedelta variable
     """
-    vartype = str(type(var.values.ravel()[0]))
-    if 'time' in vartype:
-        if 'delta' in vartype:
-            return 'delta'
-        else:
-            return 'datetime'
+    # Decoded cftime dates keep the units they were decoded from, so only
+    # other object arrays need their first value read
+    if var.dtype.kind == 'm':
+        return 'delta'
+    elif var.dtype.kind == 'M':
+        return 'datetime'
+    elif var.dtype.kind != 'O':
+        return None
+    if ' since ' in var.encoding.get('units', ''):
+        return 'datetime'
+    value = var[(0,) * var.ndim].values.ravel()[0]
+    if isinstance(value, (cftime.datetime, datetime.datetime)):
+        return 'datetime'
+    elif isinstance(value, datetime.timedelta):
+        return 'delta'
     else:
         return None
 
-def resamplebytime(ds, var, freq, timedim='time', function=np.mean, copyattrs=True):
+# Statistics available for aggregation, with the cell_methods name and the
+# numpy function and ufunc used to compute them
+STATISTICS = {
+    'mean': ('mean', np.mean),
+    'min': ('minimum', np.min),
+    'max': ('maximum', np.max),
+    'sum': ('sum', np.sum),
+    'std': ('standard_deviation', np.std),
+}
+
+def statvarname(var, statistic):
+    """
+    Name of the variable holding statistic of var. The mean keeps the name of
+    the variable, other statistics have the statistic appended
+    """
+    if statistic == 'mean':
+        return var
+    return '{}_{}'.format(var, statistic)
+
+def timegroups(ds, freq, timedim='time'):
+    """
+    Return (labels, counts) for the periods of freq spanned by ds. labels
+    is the resampled time coordinate, and counts the number of times in 
+    each period. Times must be in increasing order, so each period is a 
+    contiguous block. Periods without any times are dropped
+    """
+    periods = PeriodIndex(ds[timedim], freq)
+    return periods.labels, periods.counts
+
+def reduce_groups(data, axis, counts, statistic, chunksize=None):
+    """
+    Reduce data along axis over consecutive groups of counts elements with
+    statistic (see STATISTICS), returning an array with one element along
+    axis for each group. dask arrays are rechunked so each chunk is a group
+    and reduced lazily, a chunk at a time. If chunksize is specified the
+    other axes are split, outermost first, so chunks are at most chunksize
+    bytes where possible. numpy arrays are reduced with ufunc.reduceat over
+    all groups at once
+    """
+    func = STATISTICS[statistic][1]
+    counts = np.asarray(counts)
+
+    if isinstance(data, dask.array.Array):
+        chunks = list(data.chunks)
+        chunks[axis] = tuple(counts)
+        if chunksize is not None:
+            otheraxes = [i for i in range(data.ndim) if i != axis]
+            blockbytes = data.dtype.itemsize * int(counts.max())
+            for n, i in enumerate(otheraxes):
+                inner = blockbytes * np.prod([max(chunks[j]) for j in otheraxes[n+1:]], dtype=np.int64)
+                if inner * max(chunks[i]) > chunksize:
+                    chunks[i] = max(1, int(chunksize // inner))
+                    blockbytes *= chunks[i]
+                else:
+                    blockbytes *= max(chunks[i])
+        data = data.rechunk(tuple(chunks))
+        chunks = list(data.chunks)
+        chunks[axis] = (1,) * len(counts)
+        def reduceblock(block):
+            return reduce_groups(block, axis, [block.shape[axis]], statistic)
+        dtype = reduceblock(np.ones((1,) * data.ndim, dtype=data.dtype)).dtype
+        return data.map_blocks(reduceblock, chunks=tuple(chunks), dtype=dtype)
+
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    shape = [1] * data.ndim
+    shape[axis] = len(counts)
+    n = counts.reshape(shape)
+    # Floating point sums are accumulated in double precision, as
+    # reduceat sums sequentially
+    dtype = np.float64 if data.dtype.kind == 'f' else None
+    if statistic == 'min':
+        return np.minimum.reduceat(data, starts, axis=axis)
+    elif statistic == 'max':
+        return np.maximum.reduceat(data, starts, axis=axis)
+    elif statistic == 'sum':
+        return np.add.reduceat(data, starts, axis=axis, dtype=dtype).astype(func(data[:1]).dtype)
+    mean = np.add.reduceat(data, starts, axis=axis, dtype=np.float64) / n
+    if statistic == 'std':
+        deviation = data - np.repeat(mean, counts, axis=axis)
+        mean = np.sqrt(np.add.reduceat(deviation**2, starts, axis=axis) / n)
+    return mean.astype(func(data[:1]).dtype)
+
+def bounds_groups(data, axis, counts):
+    """
+    Return the bounds of consecutive groups of counts elements of data along
+    axis, vectorised equivalent of find_bounds. For bounds arrays the start of
+    the first bounds and the end of the last bounds in each group, otherwise 
+    the last value in each group
+    """
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    last = data[(slice(None),) * axis + (ends - 1,)]
+    if data.ndim > 1:
+        first = data[(slice(None),) * axis + (starts,)]
+        stack = dask.array.stack if isinstance(data, dask.array.Array) else np.stack
+        return stack([first[..., 0], last[..., 1]], axis=-1)
+    return last
+
+def aggregatedvariable(source, data, name, timedim='time', copyattrs=True):
+    """
+    Return variable called name containing data aggregated in time from 
+    the source DataArray. If copyattrs is True the attributes and encoding
+    of source are copied, and if name is a statistic other than the mean
+    (see statvarname) the statistic is added to cell_methods
+    """
+    variable = xarray.Variable(source.dims, data)
+    if copyattrs:
+        variable.attrs.update(source.attrs)
+        variable.encoding.update(source.encoding)
+        if name != source.name:
+            stat = name[len(source.name)+1:]
+            cellmethod = '{}: {}'.format(timedim, STATISTICS[stat][0])
+            cellmethods = variable.attrs.get('cell_methods')
+            variable.attrs['cell_methods'] = ' '.join(filter(None, [cellmethods, cellmethod]))
+    return variable
+
+def resamplebytime(ds, var, freq, timedim='time', function=np.mean, copyattrs=True, statistics=None, chunksize=None):
     """
     Given an xarray dataset, split into periods of time defined by freq
     Major variable is var, others are dependent variables which will be
-    inspected for appropriate reduction methods
+    inspected for appropriate reduction methods: timedelta variables are
+    summed, and for date/time variables the bounds of each period are 
+    found. Other time varying variables are reduced with function. If
+    statistics is a list of names from STATISTICS each is calculated for var 
+    (a variable name or list of names, or all data variables if None), and
+    saved in a variable named by statvarname. Variables which do not vary
+    in time are unchanged. chunksize limits the size in bytes of the chunks
+    reduced at once (see reduce_groups)
     """
+    labels, counts = timegroups(ds, freq, timedim)
+
+    reducers = {np.mean: 'mean', np.min: 'min', np.max: 'max', np.sum: 'sum', np.std: 'std'}
+
+    if var is None:
+        var = list(ds.data_vars)
+    elif isinstance(var, str):
+        var = [var]
+
+    variables = {}
+    for v in ds.data_vars:
+        if timedim not in ds[v].dims:
+            variables[v] = ds[v].variable
+            continue
+        axis = ds[v].get_axis_num(timedim)
+        data = ds[v].data
 
-    # applied = (funcs[i](v) for i, v in enumerate(resampler._iter_grouped()))
-    all = []
-    for  v in ds:
         # Inspect variables to determine most appropriate function
         timetype = get_time_type(ds[v])
         if timetype == 'delta':
-            func = sum_timedelta
+            outputs = {v: reduce_groups(data, axis, counts, 'sum', chunksize)}
         elif timetype == 'datetime':
-            func = find_bounds 
+            outputs = {v: bounds_groups(data, axis, counts)}
+        elif statistics is not None and v in var:
+            outputs = {statvarname(v, stat): reduce_groups(data, axis, counts, stat, chunksize) 
+                       for stat in statistics}
+        elif function in reducers:
+            outputs = {v: reduce_groups(data, axis, counts, reducers[function], chunksize)}
         else:
-            func = function
+            reduced = ds[v].resample({timedim: freq}).reduce(function, dim=timedim)
+            outputs = {v: reduced.sel({timedim: labels}).data}
+
+        for name, data in outputs.items():
+            variables[name] = aggregatedvariable(ds[v], data, name, timedim, copyattrs)
 
-        print(v,func)
-        # resampler = ds[v].resample({timedim: freq})
-        applied = []
-        for dsg in ds[v].resample({timedim: freq}).reduce(func,dim=timedim):
-            print(dsg)
-            applied.append(dsg)
-        all.append(xarray.concat(applied, dim=timedim))
+    coords = {}
+    for c in ds.coords:
+        if c == timedim:
+            coords[c] = labels.variable.to_base_variable()
+        elif timedim not in ds[c].dims:
+            coords[c] = ds[c].variable.copy(deep=False)
+        else:
+            continue
+        if copyattrs:
+            coords[c].attrs.update(ds[c].attrs)
+            coords[c].encoding.update(ds[c].encoding)
 
-    combined = xarray.merge(all)
+    return xarray.Dataset(variables, coords=coords, attrs=ds.attrs if copyattrs else None)
 
-    if copyattrs:
-        for v in list(combined.data_vars) + list(combined.coords):
-            combined[v].attrs.update(ds[v].attrs)
-            combined[v].encoding.update(ds[v].encoding)
+class RunningStatistics(object):
+    """
+    Running statistics of a variable over one aggregation period, updated
+    with one block of times at a time. Sums are accumulated in double 
+    precision, and the standard deviation uses the parallel form of 
+    Welford's algorithm, combining the mean and sum of squared deviations
+    from the mean of each block with the running totals
+    """
+
+    def __init__(self, statistics, axis):
+        self.statistics = statistics
+        self.axis = axis
+        self.count = 0
+        self.sum = self.mean = self.m2 = self.min = self.max = None
 
-    return combined
+    def update(self, block):
+        axis = self.axis
+        n = block.shape[axis]
+        if 'min' in self.statistics:
+            blockmin = np.min(block, axis=axis, keepdims=True)
+            self.min = blockmin if self.min is None else np.minimum(self.min, blockmin)
+        if 'max' in self.statistics:
+            blockmax = np.max(block, axis=axis, keepdims=True)
+            self.max = blockmax if self.max is None else np.maximum(self.max, blockmax)
+        if 'sum' in self.statistics:
+            dtype = np.float64 if block.dtype.kind == 'f' else None
+            blocksum = np.sum(block, axis=axis, keepdims=True, dtype=dtype)
+            self.sum = blocksum if self.sum is None else self.sum + blocksum
+        if 'mean' in self.statistics or 'std' in self.statistics:
+            blockmean = np.sum(block, axis=axis, keepdims=True, dtype=np.float64) / n
+            if 'std' in self.statistics:
+                blockm2 = np.sum((block - blockmean)**2, axis=axis, keepdims=True)
+            if self.mean is None:
+                self.mean = blockmean
+                if 'std' in self.statistics:
+                    self.m2 = blockm2
+            else:
+                delta = blockmean - self.mean
+                total = self.count + n
+                self.mean = self.mean + delta * (n / total)
+                if 'std' in self.statistics:
+                    self.m2 = self.m2 + blockm2 + delta**2 * (self.count * n / total)
+        self.count += n
 
-def splitbyvar(ds, vars=None, skipvars=['time'], verbose=False):
+    def result(self, statistic, dtype):
+        """
+        Return value of statistic, with one element along the time axis
+        """
+        if statistic == 'std':
+            value = np.sqrt(self.m2 / self.count)
+        else:
+            value = getattr(self, statistic)
+        return value.astype(dtype)
+
+def streamaggregate(ds, var, freq, outfreq, timedim='time', statistics=None, wanted=None):
+    """
+    Aggregate ds in time periods of freq, reading the data in time order a
+    block at a time and keeping running statistics for the current period, 
+    and yield datasets of the aggregated data grouped by outfreq. Each 
+    dataset is yielded as soon as all its periods are complete, so at most
+    one block of input and one output dataset of each variable are held in
+    memory. Blocks are the input chunks along the time axis, split at period
+    boundaries, so the chunk size determines the memory used. The results are
+    the same as resamplebytime followed by groupbytime. If specified, 
+    wanted(dataset) is called with a dataset containing only the time
+    coordinates, bounds and time invariant variables of each output, and 
+    outputs for which it returns False are not read
+    """
+    if var is None:
+        var = list(ds.data_vars)
+    elif isinstance(var, str):
+        var = [var]
+
+    # Variables with numeric data which vary in time are streamed, everything
+    # else is small and is aggregated in one step by resamplebytime
+    streamed = [v for v in ds.data_vars 
+                if timedim in ds[v].dims and get_time_type(ds[v]) is None]
+    counts = timegroups(ds, freq, timedim)[1]
+    skeleton = resamplebytime(ds.drop_vars(streamed), None, freq, timedim=timedim)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    # Blocks are split at the boundaries of both the input chunks and periods
+    boundaries = set(starts)
+    for v in streamed:
+        if isinstance(ds[v].data, dask.array.Array):
+            boundaries.update(np.cumsum(ds[v].chunks[ds[v].get_axis_num(timedim)])[:-1])
+            break
+    boundaries = np.array(sorted(boundaries) + [ends[-1]])
+
+    outputs = {}
+    for v in streamed:
+        stats = statistics if (statistics is not None and v in var) else ['mean']
+        dtypes = {stat: reduce_groups(np.ones((1,) * ds[v].ndim, dtype=ds[v].dtype), 0, [1], stat).dtype
+                  for stat in stats}
+        outputs[v] = (stats, dtypes)
+
+    for dsgroup in groupbytime(skeleton, freq=outfreq, timedim=timedim):
+        if wanted is not None and not wanted(dsgroup):
+            continue
+        periods = skeleton.indexes[timedim].get_indexer(dsgroup.indexes[timedim])
+        records = defaultdict(list)
+        for period in periods:
+            running = {v: RunningStatistics(outputs[v][0], ds[v].get_axis_num(timedim)) for v in streamed}
+            blockstarts = boundaries[(boundaries >= starts[period]) & (boundaries < ends[period])]
+            for start, end in zip(blockstarts, list(blockstarts[1:]) + [ends[period]]):
+                block = dask.compute(*[ds[v].isel({timedim: slice(start, end)}).data for v in streamed])
+                for v, values in zip(streamed, block):
+                    running[v].update(np.asarray(values))
+            for v in streamed:
+                stats, dtypes = outputs[v]
+                for stat in stats:
+                    records[(v, stat)].append(running[v].result(stat, dtypes[stat]))
+
+        # Same variable order as resamplebytime
+        variables = {}
+        for v in ds.data_vars:
+            if v in streamed:
+                axis = ds[v].get_axis_num(timedim)
+                for stat in outputs[v][0]:
+                    name = statvarname(v, stat)
+                    variables[name] = aggregatedvariable(ds[v], np.concatenate(records[(v, stat)], axis=axis), 
+                                                         name, timedim)
+            else:
+                variables[v] = dsgroup[v].variable
+        yield xarray.Dataset(variables, coords=dsgroup.coords, attrs=dsgroup.attrs)
+
+def splitbyvar(ds, vars=None, skipvars=['time']):
     """
     Given an xarray variable, split into separate variables
     """
@@ -171,45 +469,157 @@ def splitbyvar(ds, vars=None, skipvars=['time'], verbose=False):
             newvars.discard(varname.upper)
             newvars.discard(varname.lower)
 
-    if verbose: 
-        print("Splitting by variable, skipping: {}".format(newvars.difference(vars)))
+    logger.debug("Splitting by variable, skipping: {}".format(newvars.difference(vars)))
 
     for var in newvars:
         yield var
 
-def getdependents(ds, skip_attrs=['long_name', 'standard_name', 'name', 'description']):
+class AttributeIndex(object):
     """
-    Find all dependencies in dataset. Return dict with varnames as keys and dependent 
-    variable names in value array
+    Index of variable names in a dataset, used to find which variables are
+    referred to in attributes. Attribute strings are split into words, and
+    each word looked up in a dictionary of variable names, so the time taken
+    is proportional to the total length of the attributes, independent of the 
+    number of variables. Names are matched ignoring case, but an exact match
+    is preferred
     """
-    depends = {}
-    skipset = set(skip_attrs)
 
-    G = networkx.DiGraph()
+    def __init__(self, names):
+        self.names = set(names)
+        self.lowernames = defaultdict(list)
+        # Names which are not a single word can't be found by splitting
+        # into words, so are searched for separately
+        self.othernames = []
+        for name in names:
+            if re.fullmatch(r'\w+', name):
+                self.lowernames[name.lower()].append(name)
+            else:
+                self.othernames.append((name, re.compile(r'(?<!\w){}(?!\w)'.format(re.escape(name)), flags=re.I)))
 
-    G.add_nodes_from(ds.variables)
+    def lookup(self, word):
+        """
+        Return list of variable names matching word
+        """
+        if word in self.names:
+            return [word]
+        return self.lowernames.get(word.lower(), [])
 
-    r = re.compile('|'.join([r"\b{}\b".format(v) for v in ds.variables]), flags=re.I | re.X)
+    def references(self, string):
+        """
+        Return list of variable names mentioned in string, in the order
+        they appear
+        """
+        found = []
+        for word in re.findall(r'\w+', string):
+            for name in self.lookup(word):
+                if name not in found:
+                    found.append(name)
+        for name, regex in self.othernames:
+            if name not in found and regex.search(string):
+                found.append(name)
+        return found
 
+def dependencygraph(ds, skip_attrs=['long_name', 'standard_name', 'name', 'description'], coords=True):
+    """
+    Return dict mapping each variable in ds to a list of the variables it 
+    depends on: those named in its attributes (except skip_attrs) and,
+    if coords is True, its coordinates
+    """
+    index = AttributeIndex(list(ds.variables))
+    skipset = set(skip_attrs)
+
+    # Coordinates of a variable are all coordinates with dimensions that
+    # are a subset of the variable dimensions, the same as ds[var].coords
+    coorddims = [(coord, set(ds.variables[coord].dims)) for coord in ds.coords]
+
+    graph = {}
     for var in ds.variables:
-        for attr in ds[var].attrs:
-            if attr in skipset: continue
-            try:
-                match = r.findall(ds[var].attrs[attr])
-                if match:
-                    for vmatch in match:
-                        G.add_edge(var,vmatch)
-            except:
-                pass
+        edges = []
+        for attr, value in ds.variables[var].attrs.items():
+            if attr in skipset or not isinstance(value, str): continue
+            edges.extend(index.references(value))
+        if coords:
+            dims = set(ds.variables[var].dims)
+            edges.extend(coord for (coord, cdims) in coorddims if cdims <= dims)
+        graph[var] = list(dict.fromkeys(v for v in edges if v != var))
+
+    return graph
+
+def transitiveclosure(graph):
+    """
+    Return dict mapping each node in graph to the set of all nodes reachable
+    from it, not including itself unless it is part of a cycle. Computed in
+    a single pass, by finding strongly connected components (Tarjan's 
+    algorithm) and combining reachable sets of components in reverse 
+    topological order, which is the order Tarjan's algorithm finds them
+    """
+    index = {}
+    lowlink = {}
+    onstack = set()
+    stack = []
+    reach = {}
+    counter = 0
+
+    for root in graph:
+        if root in index:
+            continue
+        # Iterative depth first search, to avoid recursion limits
+        work = [(root, iter(graph[root]))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        onstack.add(root)
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = counter
+                    counter += 1
+                    stack.append(succ)
+                    onstack.add(succ)
+                    work.append((succ, iter(graph.get(succ, []))))
+                    break
+                elif succ in onstack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    # node is the root of a strongly connected component.
+                    # All components reachable from it are already complete
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onstack.discard(member)
+                        component.append(member)
+                        if member == node: break
+                    reachable = set()
+                    for member in component:
+                        for succ in graph.get(member, []):
+                            if succ not in component:
+                                reachable.add(succ)
+                                reachable.update(reach[succ])
+                    if len(component) > 1 or node in graph.get(node, []):
+                        reachable.update(component)
+                    for member in component:
+                        reach[member] = reachable
+
+    return reach
 
-        for coord in ds[var].coords:
-            G.add_edge(var,coord)
+def getdependents(ds, skip_attrs=['long_name', 'standard_name', 'name', 'description']):
+    """
+    Find all dependencies in dataset. Return dict with varnames as keys and dependent 
+    variable names in value array, in the same order as the variables in ds
+    """
+    graph = dependencygraph(ds, skip_attrs)
+    reach = transitiveclosure(graph)
+    order = {var: i for (i, var) in enumerate(ds.variables)}
 
+    depends = {}
     for var in ds.data_vars:
-        # depends[var] = getdependentvars(ds, var, skip_attrs)
-        depends[var] = []
-        for (node, deps) in networkx.algorithms.traversal.breadth_first_search.bfs_successors(G, var):
-            depends[var].extend(deps)
+        depends[var] = sorted(reach[var].difference([var]), key=order.get)
 
     return depends
 
@@ -225,36 +635,12 @@ def dependentlookup(depends):
         
 def getdependentvars(ds, var, skip_attrs=['long_name', 'standard_name', 'name', 'description']):
     """
-    Find other variables upon which var depends
+    Find other variables upon which var depends, because they are named in
+    the attributes of var, or the attributes of those variables
     """
-    depvars = set()
-    # Cycle through all the variables to be selected
-    # and check if they depend on any other variables
-    for attr in ds[var].attrs:
-        if attr in skip_attrs:
-            continue
-        for attvar in list(ds.data_vars) + list(ds.coords):
-            if attvar == var: 
-                continue
-            # Need to use a proper regex to search on word boundaries
-            # to stop spurious matching with variables like "u" and "v"
-            try:
-                if re.search(r'\b'+attvar+r'\b', ds[var].attrs[attr]):
-                    # Variable is mentioned in an attribute
-                    # so should also be copied 
-                    depvars.add(attvar)
-            except TypeError:
-                # Probably trying to match a number, so ignore
-                pass
-
-    depdepvars = set()
-    for var in depvars:
-        # One level of recursion to make sure we get all the 
-        # dependencies of the variables/coordindates we just
-        # found 
-        depdepvars = depdepvars.union(getdependentvars(ds, var, skip_attrs))
-
-    return list(depvars.union(depdepvars))
+    graph = dependencygraph(ds, skip_attrs, coords=False)
+    reach = transitiveclosure(graph)
+    return list(reach[var].difference([var]))
 
 def genfilepath(var):
     """
@@ -262,20 +648,388 @@ def genfilepath(var):
     and it's frequency
     """
 
-def writevar(var, filename, unlimited=None, engine='netcdf4'):
+def tempfilepath(filename):
+    """
+    Return the temporary path an output file is written to before it is
+    renamed to filename
+    """
+    return '{}.tmp'.format(filename)
+
+def removefile(filename):
+    """
+    Remove filename, or directory filename and its contents such as a zarr
+    store, ignoring it if it doesn't exist
+    """
+    try:
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        else:
+            os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+def replacefile(tmpfile, filename):
+    """
+    Rename tmpfile to filename. A directory, such as a zarr store, can't 
+    replace an existing directory, so any existing filename is removed first
+    """
+    if os.path.isdir(filename):
+        removefile(filename)
+    os.replace(tmpfile, filename)
+
+# Formats output files can be written in
+FORMATS = ('netcdf', 'zarr')
+
+# File extension of outputs in each format
+FORMAT_EXTENSIONS = {'netcdf': '.nc', 'zarr': '.zarr'}
+
+# Encoding settings only used by the netCDF library
+NETCDF_ENCODING = ('zlib', 'complevel', 'shuffle', 'fletcher32', 'contiguous', 
+                   'chunksizes', 'original_shape', 'least_significant_digit', 'source')
+
+def zarrdataset(ds):
     """
-    Save variable to netcdf file
+    Return a copy of ds with netCDF encoding converted for writing to zarr:
+    chunksizes become zarr chunks, and unless a compressor has been set 
+    (see setcodecs) deflate compression with shuffle a Zlib compressor 
+    with a Shuffle filter. Zarr chunks must not span dask
+    chunks, so variables with uneven dask chunks are rechunked to the zarr 
+    chunks, or to even chunks the size of their largest dask chunk
     """
-    print('Saving data to {fname}'.format(fname=filename))
-    if unlimited is not None:
-        if type(unlimited) is str:
-            unlimited = [unlimited]
-        var.to_netcdf(path=filename,format="NETCDF4", unlimited_dims=unlimited, engine=engine)
+    import numcodecs
+
+    ds = ds.copy()
+    for var in ds.variables.values():
+        encoding = {k: v for (k, v) in var.encoding.items() if k not in NETCDF_ENCODING}
+        numeric = np.dtype(var.encoding.get('dtype', var.dtype)).kind in 'biuf'
+        if numeric and 'compressor' not in var.encoding:
+            encoding['compressor'] = None
+            if var.encoding.get('zlib'):
+                encoding['compressor'] = numcodecs.Zlib(level=var.encoding.get('complevel', 4))
+                if var.encoding.get('shuffle'):
+                    itemsize = np.dtype(var.encoding.get('dtype', var.dtype)).itemsize
+                    encoding['filters'] = [numcodecs.Shuffle(elementsize=itemsize)]
+        chunks = var.encoding.get('chunksizes')
+        if isinstance(var.data, dask.array.Array):
+            if chunks is None:
+                chunks = tuple(max(c) for c in var.chunks)
+            if tuple(var.chunks) != dask.array.core.normalize_chunks(chunks, var.shape):
+                var.data = var.data.rechunk(chunks)
+        if chunks is not None:
+            encoding['chunks'] = tuple(chunks)
+        var.encoding = encoding
+    return ds
+
+# Access patterns the chunk shapes of output variables can be optimised for
+LAYOUTS = ('map', 'timeseries', 'balanced', 'auto')
+
+# Target size of chunks in output files, in bytes
+LAYOUT_CHUNK_SIZE = 2**22
+
+# HDF5 chunk cache size for each variable set by the netCDF library
+DEFAULT_CHUNK_CACHE = netCDF4.get_chunk_cache()[0]
+
+def fitchunks(shape, nelems):
+    """
+    Return chunks for shape with at most nelems elements, reducing the
+    outermost dimensions first
+    """
+    chunks = list(shape)
+    for i in range(len(chunks)):
+        inner = int(np.prod(chunks[i+1:], dtype=np.int64))
+        if chunks[i] * inner <= nelems:
+            break
+        chunks[i] = max(1, nelems // inner)
+    return tuple(chunks)
+
+def balancedchunks(shape, nelems):
+    """
+    Return chunks for shape with at most nelems elements, reducing all
+    dimensions by the same fraction so there are roughly the same number
+    of chunks along every dimension
+    """
+    total = np.prod(shape, dtype=np.int64)
+    if total <= nelems:
+        return tuple(shape)
+    fraction = (nelems / total) ** (1. / len(shape))
+    return tuple(max(1, int(n * fraction)) for n in shape)
+
+def layoutchunks(var, timedim, layout, chunksize=LAYOUT_CHUNK_SIZE):
+    """
+    Return the chunk shape for writing var, optimised for reading with the
+    access pattern layout (one of LAYOUTS), with chunks of up to chunksize
+    bytes. Variables smaller than chunksize are a single chunk. Otherwise
+    map has a single time step in each chunk, for reading whole fields. 
+    timeseries has every time in each chunk, for reading long time series
+    at a point. balanced has chunks reduced equally along all dimensions. 
+    auto chooses chunks so the same number of chunks is read for a whole 
+    field as for a whole time series at a point. Variables without timedim
+    are chunked the same for all layouts. Returns None for scalar and 
+    string variables
+    """
+    if var.ndim == 0 or var.dtype.kind in 'SU':
+        return None
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown layout {}, must be one of {}'.format(layout, ', '.join(LAYOUTS)))
+    nelems = max(1, chunksize // var.dtype.itemsize)
+    if np.prod(var.shape, dtype=np.int64) <= nelems:
+        return var.shape
+    if timedim not in var.dims:
+        return fitchunks(var.shape, nelems)
+    axis = var.get_axis_num(timedim)
+    ntime = var.shape[axis]
+    othershape = var.shape[:axis] + var.shape[axis+1:]
+    if layout == 'map':
+        timechunk = 1
+        otherchunks = fitchunks(othershape, nelems)
+    elif layout == 'timeseries':
+        timechunk = min(ntime, nelems)
+        otherchunks = balancedchunks(othershape, max(1, nelems // timechunk))
+    elif layout == 'balanced':
+        return balancedchunks(var.shape, nelems)
     else:
-        var.to_netcdf(path=filename,format="NETCDF4", engine=engine)
+        # Choose the number of time steps so reading a whole field and 
+        # reading every time at a point read the same number of chunks
+        fieldsize = int(np.prod(othershape, dtype=np.int64))
+        timechunk = int(min(ntime, nelems, max(1, np.sqrt(ntime * nelems / fieldsize))))
+        otherchunks = balancedchunks(othershape, max(1, nelems // timechunk))
+    return otherchunks[:axis] + (timechunk,) + otherchunks[axis:]
+
+def setlayout(ds, timedim, layout, chunksize=LAYOUT_CHUNK_SIZE):
+    """
+    Set the chunk sizes used to write every variable in ds to those 
+    returned by layoutchunks
+    """
+    for v in ds.variables:
+        chunks = layoutchunks(ds[v].variable, timedim, layout, chunksize)
+        if chunks is None:
+            continue
+        encoding = dict(ds[v].encoding, chunksizes=chunks, contiguous=False)
+        # Otherwise xarray discards the chunk sizes as the shape has changed
+        encoding.pop('original_shape', None)
+        ds[v].encoding = encoding
+    return ds
+
+def chunkcachesize(ds, limit=None):
+    """
+    Return the HDF5 chunk cache size in bytes needed to write ds without
+    chunks being evicted before they are completely written. This is the 
+    size of one row of chunks along the slowest varying dimension of the 
+    largest variable which is not written in whole chunks, and is never 
+    less than the netCDF library default. If specified the size is at
+    most limit bytes
+    """
+    size = DEFAULT_CHUNK_CACHE
+    for v in ds.variables:
+        chunks = ds[v].encoding.get('chunksizes')
+        if not chunks or ds[v].chunks is None:
+            continue
+        # Each dask block is written in one step, so no cache is needed if 
+        # blocks contain whole chunks
+        if all(all(b % c == 0 for b in blocks[:-1]) and blocks[0] >= min(c, n)
+               for blocks, c, n in zip(ds[v].chunks, chunks, ds[v].shape)):
+            continue
+        row = ds[v].dtype.itemsize * chunks[0] * np.prod(ds[v].shape[1:], dtype=np.int64)
+        size = max(size, int(row))
+    if limit is not None:
+        size = min(size, limit)
+    return size
+
+def outputchunkcache(ds, chunkcache):
+    """
+    Return the chunk cache size in bytes for writing ds, where chunkcache
+    is a size in bytes, 'auto' or a function returning the size for ds
+    """
+    if chunkcache == 'auto':
+        chunkcache = chunkcachesize
+    if callable(chunkcache):
+        return chunkcache(ds)
+    return chunkcache
+
+def setchunkcache(size):
+    """
+    Set the HDF5 chunk cache size in bytes for each variable in netCDF files
+    opened or created after this call
+    """
+    _, nelems, preemption = netCDF4.get_chunk_cache()
+    netCDF4.set_chunk_cache(int(size), nelems, preemption)
+
+def writevar(var, filename, unlimited=None, engine='netcdf4', chunkcache=None, format='netcdf'):
+    """
+    Save variable to netcdf file, or a zarr store with consolidated metadata
+    if format is zarr. The data is written to a temporary file
+    which is renamed to filename when complete, so filename only exists
+    if it has been completely written. If specified, the HDF5 chunk cache 
+    is set to chunkcache bytes, or 'auto' to use chunkcachesize, or a
+    function which returns the size for var. The compressed chunks of the
+    variables in var.encoding['chunksources'] are copied from the inputs
+    if possible (see writepassthrough)
+    """
+    logger.debug('Saving data to {fname}'.format(fname=filename))
+    if chunkcache is not None:
+        setchunkcache(outputchunkcache(var, chunkcache))
+    tmpfile = tempfilepath(filename)
+    try:
+        if format == 'zarr':
+            # Chunks are written in parallel by dask, without a lock
+            zarrdataset(var).to_zarr(tmpfile, mode='w', consolidated=True)
+        else:
+            if unlimited is not None and type(unlimited) is str:
+                unlimited = [unlimited]
+            if engine == 'h5netcdf':
+                # Compression filters other than zlib are HDF5 plugins
+                useplugins()
+            sources = var.encoding.get('chunksources')
+            if not sources or not writepassthrough(var, tmpfile, sources, unlimited, engine):
+                var.to_netcdf(path=tmpfile,format="NETCDF4", unlimited_dims=unlimited, engine=engine)
+    except:
+        removefile(tmpfile)
+        raise
+    replacefile(tmpfile, filename)
+
+def cf_encode(ds):
+    """
+    Return a copy of ds with all variables CF encoded, as they would be
+    written to disk, so dates and times are plain numbers with units
+    """
+    # Date and time variables are small but computed multiple times when
+    # encoded, so load them all in one step first
+    timevars = [v for v in ds.variables if ds[v].dtype.kind in 'mMO']
+    ds = ds.copy()
+    ds.update(ds[timevars].compute())
+    variables, attrs = xarray.conventions.encode_dataset_coordinates(ds)
+    variables, attrs = xarray.conventions.cf_encoder(variables, attrs)
+    encoded = xarray.Dataset(variables, attrs=attrs)
+    encoded.encoding = ds.encoding
+    return encoded
+
+def _writevar_job(var, filename, unlimited=None, engine='netcdf4', chunkcache=None, format='netcdf'):
+    """
+    Call writevar in a worker process, returning filename when complete
+    """
+    writevar(var, filename, unlimited=unlimited, engine=engine, chunkcache=chunkcache, format=format)
+    return filename
+
+def writevars_batched(outputs, batchsize, unlimited=None, engine='netcdf4', callback=None, chunkcache=None, format='netcdf'):
+    """
+    Write each (var, filename) pair in outputs to netcdf in batches of 
+    batchsize. The writes in a batch are delayed and computed together,
+    so dask can share reading input chunks between outputs. Files are
+    written to temporary paths and renamed once the batch is complete. 
+    If a batch fails all the temporary files in that batch are deleted 
+    and the exception re-raised. If there is a dask cluster its workers
+    use the largest chunk cache of any output in the batch
+    """
+    if unlimited is not None and type(unlimited) is str:
+        unlimited = [unlimited]
+
+    def computebatch(batch, cachesize):
+        if cachesize is not None:
+            # Data is written by the dask workers if there is a dask cluster
+            try:
+                from distributed import get_client
+                get_client().run(setchunkcache, cachesize)
+            except (ImportError, ValueError):
+                pass
+        try:
+            dask.compute(*[delayed for (delayed, filename) in batch])
+        except:
+            for delayed, filename in batch:
+                removefile(tempfilepath(filename))
+            raise
+        for delayed, filename in batch:
+            replacefile(tempfilepath(filename), filename)
+            if callback is not None:
+                callback(filename)
+
+    batch = []
+    cachesize = None
+    for var, filename in outputs:
+        if format == 'netcdf' and var.encoding.get('chunksources'):
+            # Copying chunks needs no computation, so is done straight away
+            writevar(var, filename, unlimited=unlimited, engine=engine, chunkcache=chunkcache)
+            if callback is not None:
+                callback(filename)
+            continue
+        logger.debug('Saving data to {fname}'.format(fname=filename))
+        if chunkcache is not None:
+            size = outputchunkcache(var, chunkcache)
+            setchunkcache(size)
+            cachesize = max(cachesize or 0, size)
+        if format == 'zarr':
+            delayed = zarrdataset(var).to_zarr(tempfilepath(filename), mode='w', 
+                                               consolidated=True, compute=False)
+        else:
+            delayed = var.to_netcdf(path=tempfilepath(filename), format="NETCDF4", 
+                                    unlimited_dims=unlimited, engine=engine, compute=False)
+        batch.append((delayed, filename))
+        if len(batch) >= batchsize:
+            computebatch(batch, cachesize)
+            batch = []
+            cachesize = None
+    if batch:
+        computebatch(batch, cachesize)
+
+def writevars(outputs, jobs=1, batchsize=None, unlimited=None, engine='netcdf4', callback=None, chunkcache=None, format='netcdf', loadlimit=None):
+    """
+    Write each (var, filename) pair in outputs to netcdf. If jobs is greater
+    than one the writes are dispatched, in order, to a pool of jobs worker
+    processes. Processes are used because the netCDF4/HDF5 library does not
+    allow concurrent access from threads. The number of outputs in flight is
+    bounded so that outputs are not generated faster than they can be written,
+    and if loadlimit is specified so is their total size in bytes, as each
+    output is copied to a worker process. If any write fails all pending writes are cancelled and the exception
+    re-raised. If batchsize is specified writes are computed by dask in
+    batches (see writevars_batched). If specified, callback is called with
+    the filename of each output once it has been completely written. 
+    chunkcache is the HDF5 chunk cache size used when writing (see writevar).
+    format is netcdf or zarr
+    """
+    if batchsize is not None:
+        return writevars_batched(outputs, batchsize, unlimited=unlimited, 
+                                 engine=engine, callback=callback, chunkcache=chunkcache,
+                                 format=format)
+
+    if jobs <= 1:
+        for var, filename in outputs:
+            writevar(var, filename, unlimited=unlimited, engine=engine, chunkcache=chunkcache, format=format)
+            if callback is not None:
+                callback(filename)
+        return
+
+    def finish():
+        future, size = pending.popleft()
+        filename = future.result()
+        if callback is not None:
+            callback(filename)
+        return size
+
+    # Use spawn rather than fork, as a forked HDF5 library is not safe to use
+    context = multiprocessing.get_context('spawn')
+    pending = deque()
+    pendingsize = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        try:
+            for var, filename in outputs:
+                # Send CF encoded data to the workers, so only numeric arrays
+                # need to be pickled rather than arrays of date objects
+                encoded = cf_encode(var)
+                size = encoded.nbytes
+                while pending and (len(pending) >= 2 * jobs or 
+                                   (loadlimit is not None and pendingsize + size > loadlimit)):
+                    pendingsize -= finish()
+                logger.debug('Saving data to {fname}'.format(fname=filename))
+                pending.append((pool.submit(_writevar_job, encoded, filename, unlimited, engine, chunkcache, format), size))
+                pendingsize += size
+            while pending:
+                finish()
+        except:
+            for future, size in pending:
+                future.cancel()
+            raise
 
 
-def open_files(file_paths, concat_dim, delvars=None, verbose=False, encoding={}):
+def open_files(file_paths, concat_dim, delvars=None, encoding={}, index=None, chunks=None):
 
     def dropvars(ds):
         nonlocal delvars
@@ -289,24 +1043,225 @@ def open_files(file_paths, concat_dim, delvars=None, verbose=False, encoding={})
                 ds = ds.drop(delvars)
         return(ds)
 
-    ds = xarray.open_mfdataset(file_paths, 
-                               decode_cf=False, 
-                               engine='netcdf4', 
-                               data_vars='minimal',
-                               preprocess=dropvars,
-                               parallel=True,
-                               concat_dim=concat_dim)
+    ds = None
+    if index is not None:
+        # Construct dataset from the metadata in the index file, which
+        # means only new or changed files need to be opened
+        if type(file_paths) is str:
+            file_paths = [file_paths]
+        ds = datasetfromindex(indexfiles(file_paths, index), concat_dim, delvars, chunks)
+        if ds is None:
+            logger.warning('Files cannot be combined using index {}, opening all files'.format(index))
+
+    if ds is None:
+        ds = xarray.open_mfdataset(file_paths, 
+                                   decode_cf=False, 
+                                   engine='netcdf4', 
+                                   data_vars='minimal',
+                                   preprocess=dropvars,
+                                   parallel=True,
+                                   chunks=chunks,
+                                   concat_dim=concat_dim)
 
-    if verbose and delvars is not None: 
-        print('Deleted {} from dataset'.format(delvars))
+    if delvars is not None: 
+        logger.debug('Deleted {} from dataset'.format(delvars))
 
+    # By default each variable is a single chunk for each input file. Use 
+    # readchunks to limit the size of chunks read from each file, and 
+    # planchunks to choose chunks once the time axis is known
     for v in ds:
-        if 'chunksizes' in ds[v].encoding:
-            ds[v] = ds[v].chunk(ds[v].encoding['chunksizes'])
         ds[v].encoding.update(encoding)
 
     return ds
 
+def decodevars(ds, timevar, names=()):
+    """
+    Return ds, opened with decode_cf=False, with the time coordinate timevar
+    and its bounds, variables without the time dimension and the variables
+    in names decoded as by decode_cf. Other variables keep the values and
+    dtype they are stored with, and their _FillValue, scale_factor and
+    add_offset attributes, so they are written as they were read without 
+    being decoded and encoded again
+    """
+    timedim = ds[timevar].dims[0]
+    decode = set(names)
+    decode.add(timevar)
+    for attr in ('bounds', 'climatology'):
+        if attr in ds[timevar].attrs:
+            decode.add(ds[timevar].attrs[attr])
+    # Coordinates and other time invariant variables are small, and their
+    # decoded values are used for the geospatial extents
+    decode.update(v for v in ds.variables if timedim not in ds[v].dims)
+    stored = [v for v in ds.variables if v not in decode]
+
+    # All the variables are passed every time, so coordinates referenced
+    # by variables in either group are found
+    variables = dict(ds.variables)
+    decoded, attrs, coords = xarray.conventions.decode_cf_variables(
+        variables, ds.attrs, drop_variables=stored)
+    undecoded, _, storedcoords = xarray.conventions.decode_cf_variables(
+        variables, ds.attrs, mask_and_scale=False, decode_times=False,
+        drop_variables=list(decode))
+    decoded.update(undecoded)
+
+    newds = xarray.Dataset({v: decoded[v] for v in ds.variables}, attrs=attrs)
+    newds = newds.set_coords(coords.union(storedcoords).intersection(decoded))
+    newds.encoding = ds.encoding
+    return newds
+
+def planchunks(ds, timedim, freqs, target):
+    """
+    Return a dictionary of dask chunks for each variable in ds. Chunks along
+    timedim are aligned with the input chunks (usually one chunk per input
+    file) and with the periods of each of freqs (e.g. output and aggregation 
+    frequency), so every output reads whole chunks. Chunks are as large as
+    possible up to target bytes, and are multiples of the chunk sizes on 
+    disk, so no chunk on disk is read more than once. If a single time step
+    is larger than target the other dimensions are split, outermost first.
+    ds must have a decodable time coordinate, but can otherwise be undecoded
+    """
+    timeds = xarray.decode_cf(ds[[timedim]])
+    boundaries = set([0])
+    for freq in freqs:
+        counts = timegroups(timeds, freq, timedim)[1]
+        boundaries.update(np.cumsum(counts)[:-1])
+    # Input file boundaries
+    for v in ds.data_vars:
+        if timedim in ds[v].dims and ds[v].chunks is not None:
+            boundaries.update(np.cumsum(ds[v].chunks[ds[v].get_axis_num(timedim)])[:-1])
+            break
+    boundaries = sorted(boundaries) + [ds.dims[timedim]]
+
+    plan = {}
+    for v in ds.data_vars:
+        var = ds[v]
+        if var.chunks is None:
+            continue
+        diskchunks = var.encoding.get('chunksizes') or (1,) * var.ndim
+        itemsize = var.dtype.itemsize
+        chunks = {}
+        if timedim in var.dims:
+            axis = var.get_axis_num(timedim)
+            disktime = diskchunks[axis]
+            stepbytes = itemsize * np.prod([n for (d, n) in zip(var.dims, var.shape) if d != timedim], dtype=np.int64)
+            steps = max(disktime, int(target // max(stepbytes, 1)) // disktime * disktime)
+            timechunks = []
+            for start, end in zip(boundaries[:-1], boundaries[1:]):
+                for piece in range(start, end, steps):
+                    timechunks.append(min(steps, end - piece))
+            chunks[timedim] = tuple(timechunks)
+            blockbytes = itemsize * min(steps, max(timechunks))
+        else:
+            blockbytes = itemsize
+        # Split other dimensions if necessary, outermost first
+        otherdims = [(d, n, c) for (d, n, c) in zip(var.dims, var.shape, diskchunks) if d != timedim]
+        for i, (dim, size, diskchunk) in enumerate(otherdims):
+            inner = blockbytes * np.prod([n for (d, n, c) in otherdims[i+1:]], dtype=np.int64)
+            if inner * size <= target:
+                chunks[dim] = size
+                continue
+            n = max(diskchunk, int(target // inner) // diskchunk * diskchunk)
+            chunks[dim] = min(n, size)
+            blockbytes *= chunks[dim]
+        plan[v] = chunks
+
+    return plan
+
+def readchunks(ds, timedim, target):
+    """
+    Return a dictionary of chunk sizes for each dimension to open the input
+    files with (see open_files), so no chunk read from a file is much larger
+    than target bytes. ds is the first input file. Chunks are the smallest
+    planned by planchunks for any variable, and only need to be aligned with
+    the output periods afterwards, so reading never loads a whole file
+    """
+    chunks = {}
+    for v, varchunks in planchunks(ds, timedim, [], target).items():
+        for dim, size in varchunks.items():
+            if type(size) is tuple:
+                size = max(size)
+            chunks[dim] = min(size, chunks.get(dim, size))
+    return chunks
+
+def applychunks(ds, plan):
+    """
+    Rechunk the variables in ds according to plan (see planchunks)
+    """
+    for v, chunks in plan.items():
+        encoding = ds[v].encoding
+        ds[v] = ds[v].chunk(chunks)
+        ds[v].encoding = encoding
+    return ds
+
+def chunkreport(ds):
+    """
+    Return a string describing the number of chunks, size of the largest chunk
+    and number of tasks in the dask graph of ds
+    """
+    nchunks = 0
+    largest = 0
+    for v in ds.variables:
+        if ds[v].chunks is not None:
+            nchunks += ds[v].data.npartitions
+            chunksize = ds[v].dtype.itemsize * np.prod([max(c) for c in ds[v].chunks], dtype=np.int64)
+            largest = max(largest, chunksize)
+    ntasks = len(ds.__dask_graph__() or {})
+    return '{} chunks, largest {}, {} tasks in graph'.format(nchunks, dask.utils.format_bytes(largest), ntasks)
+
+def timecoverage(path, timevar, record=None):
+    """
+    Return the first and last time in a file, the time units and calendar, and
+    True if the first and last times are from the time bounds. Only the time 
+    variable, and the time bounds if they exist, are read from the file. If an 
+    index record for the file is given the file is not opened
+    """
+    bounded = False
+    if record is not None:
+        timeattrs = record['variables'][timevar]['attrs']
+        values = record['variables'][timevar]['values']
+        if 'values' in record['variables'].get(timeattrs.get('bounds'), {}):
+            values = record['variables'][timeattrs['bounds']]['values']
+            bounded = True
+    else:
+        with netCDF4.Dataset(path) as f:
+            timeattrs = f.variables[timevar].__dict__
+            values = f.variables[timevar][:]
+            if timeattrs.get('bounds') in f.variables:
+                values = f.variables[timeattrs['bounds']][:]
+                bounded = True
+
+    calendar = timeattrs.get('calendar', timeattrs.get('calendar_type', 'standard')).lower()
+
+    return values.min(), values.max(), timeattrs['units'], calendar, bounded
+
+def selectfiles(paths, timevar, start=None, end=None, calendar=None, index=None):
+    """
+    Return the files which contain data between start and end, which are
+    partial date strings of the form YYYY[-MM[-DD]], inclusive. Either can 
+    be None to leave the time window open on that side. Optionally override 
+    the calendar in the files
+    """
+    records = [None,] * len(paths)
+    if index is not None:
+        records = indexfiles(paths, index)
+
+    selected = []
+    for path, record in zip(paths, records):
+        first, last, units, filecalendar, bounded = timecoverage(path, timevar, record)
+        filecalendar = calendar or filecalendar
+        if start is not None:
+            startnum = cftime.date2num(parse_date_bounds(start, filecalendar)[0], units, filecalendar)
+            # The end of the last time bounds is not included in the file
+            if last < startnum or (bounded and last == startnum):
+                continue
+        if end is not None:
+            endnum = cftime.date2num(parse_date_bounds(end, filecalendar)[1], units, filecalendar)
+            if first >= endnum:
+                continue
+        selected.append(path)
+
+    return selected
+
 def findmatchingvars(ds, att='units', matchstrings=[], ignorecase=True, coords_only=False):
     """
     Find variables with matching attributes
@@ -333,14 +1288,14 @@ def findmatchingvars(ds, att='units', matchstrings=[], ignorecase=True, coords_o
 def add_vars(ds, fnames, timevar):
 
     for fname in fnames:
-        print('Adding {}'.format(fname))
+        logger.info('Adding {}'.format(fname))
         add_ds = xarray.open_dataset(fname, decode_cf=False)
         if timevar in add_ds.coords:
             delvars = [timevar]
             for var in add_ds:
                 if timevar in add_ds[var].dims:
                     delvars.append(var)
-            print('Deleting following variables with a time dimension from {}: {}'.format(fname, delvars))
+            logger.info('Deleting following variables with a time dimension from {}: {}'.format(fname, delvars))
             add_ds = add_ds.drop(delvars)
 
         # Updating the additional dataset means vars from
@@ -355,14 +1310,14 @@ def make_added_ds(fnames, timevar):
     ds = xarray.Dataset()
 
     for fname in fnames:
-        print('Adding {}'.format(fname))
+        logger.info('Adding {}'.format(fname))
         add_ds = xarray.open_dataset(fname, decode_cf=False)
         if timevar in add_ds.coords:
             delvars = [timevar]
             for var in add_ds:
                 if timevar in add_ds[var].dims:
                     delvars.append(var)
-            print('Deleting following variables with a time dimension from {}: {}'.format(fname, delvars))
+            logger.info('Deleting following variables with a time dimension from {}: {}'.format(fname, delvars))
             add_ds = add_ds.drop(delvars)
 
         # Updating the additional dataset means vars from
@@ -17,8 +17,10 @@ limitations under the License.
 
 from __future__ import print_function
 
+import cftime
 from cftime import num2date, date2num
 import datetime
+import re
 import numpy as np
 import pandas as pd
 import xarray as xr
@@ -51,6 +53,33 @@ def format_date(dateobj, timeformat):
 
     return datestring
 
+def parse_date_bounds(datestring, calendar='standard'):
+    """
+    Parse a (possibly partial) date string of the form YYYY[-MM[-DD]] and 
+    return the start and end dates of the period it spans, e.g. 2255 spans 
+    the whole year from 2255-01-01 to 2256-01-01. The end date is exclusive
+    """
+    match = re.fullmatch(r'(\d+)(?:-(\d{1,2})(?:-(\d{1,2}))?)?', datestring.strip())
+    if match is None:
+        raise ValueError('Date {} not of the form YYYY[-MM[-DD]]'.format(datestring))
+
+    year, month, day = [int(x) if x is not None else None for x in match.groups()]
+
+    if day is not None:
+        start = cftime.datetime(year, month, day, calendar=calendar)
+        end = start + datetime.timedelta(days=1)
+    elif month is not None:
+        start = cftime.datetime(year, month, 1, calendar=calendar)
+        if month == 12:
+            end = cftime.datetime(year + 1, 1, 1, calendar=calendar)
+        else:
+            end = cftime.datetime(year, month + 1, 1, calendar=calendar)
+    else:
+        start = cftime.datetime(year, 1, 1, calendar=calendar)
+        end = cftime.datetime(year + 1, 1, 1, calendar=calendar)
+
+    return start, end
+
 def date2num_round(dates, units, calendar):
     return np.round(date2num(dates, units, calendar),8)
 
@@ -207,8 +236,14 @@ def rebase_dataset(ds, target_units=None, timevar='time', offset=None):
 
     return newds
 
-def shift_time(ds):
+def shift_time(ds, shift):
     """
-    Apply time shift to un-decoded time axis, to align datasets and 
+    Apply time shift to un-decoded time axis, by subtracting shift from all 
+    variables with units of the form "units since date". The shift is applied
+    lazily to variables which are dask arrays, so they are not read until 
+    they are written
     """
-    pass
\ No newline at end of file
+    for name in list(ds.variables):
+        if ' since ' in ds[name].attrs.get('units', '').lower():
+            ds[name] = ds[name].copy(data = ds[name].data - shift)
+    return ds
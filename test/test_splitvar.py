@@ -23,6 +23,10 @@ limitations under the License.
 from __future__ import print_function
 
 import copy
+import datetime
+import io
+import json
+import dask.array
 import os
 from pathlib import Path
 import pytest
@@ -161,6 +165,42 @@ def test_splitbytime():
         assert(var.shape[0] == size)
         # print(var.shape[0],size)
 
+def test_periods():
+
+    # Same periods as resample, whether times are encoded, cftime objects
+    # or datetime64, and for offsets labelled by their start or end
+    for calendar in ('noleap', '360_day', 'all_leap', 'julian', 'standard', 'proleptic_gregorian'):
+        encoded = xr.DataArray(np.arange(0, 3000, 0.25), dims='time', name='time',
+                               attrs={'units': 'days since 1990-01-01 03:00', 'calendar': calendar})
+        decoded = xr.decode_cf(encoded.to_dataset())['time']
+        for freq in ('MS', '24MS', '5D', 'M', 'A', 'QS-JUL'):
+            counts = decoded.resample(time=freq).count()
+            counts = counts.isel(time=counts.values > 0)
+            for times in (encoded, decoded):
+                periods = PeriodIndex(times, freq)
+                assert((periods.counts == counts.values).all())
+                assert((periods.labels.values == counts['time'].values).all())
+                assert(periods.slices()[1] == slice(periods.starts[1], periods.starts[1] + counts.values[1]))
+
+    with pytest.raises(ValueError):
+        PeriodIndex(encoded[::-1], 'MS')
+
+    # Split encoded monthly times by century without decoding them
+    months = np.tile([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31], 1000)
+    times = xr.DataArray(np.cumsum(months) - 15., dims='time', name='time',
+                         attrs={'units': 'days since 0001-01-01', 'calendar': 'noleap'})
+    var = xr.DataArray(np.arange(len(months)), dims='time', coords={'time': times})
+    assert([len(v) for v in splitbytime(var, '1200MS')] == [1200] * 10)
+
+    # Variables which don't vary in time are not split, even with periods
+    periods = PeriodIndex(times, '1200MS')
+    assert([len(v.time) for v in groupbytime(var.to_dataset(name='v'), '1200MS', periods=periods)] == [1200] * 10)
+    assert(list(groupbytime(xr.Dataset({'area': ('x', [1.])}), '1200MS', periods=periods)) == [])
+
+    assert(get_time_type(decoded) == 'datetime')
+    assert(get_time_type(xr.DataArray([datetime.timedelta(days=1)])) == 'delta')
+    assert(get_time_type(encoded) is None)
+
 def test_splitbyvariable():
 
     testfile = 'test/ocean_scalar.nc'
@@ -246,3 +286,719 @@ def test_getdependents():
             # Non dependent vars should all have the same dependencies
             assert(sorted(v) == ['average_DT', 'average_T1', 'average_T2', 'nv', 'scalar_axis', 'time', 'time_bounds'])
 
+
+def compare_outputs(dir1, dir2, nfiles):
+    """
+    Check the same output files exist in both directories and have
+    identical contents
+    """
+    files1 = sorted(p.relative_to(dir1) for p in Path(dir1).glob('**/*.nc'))
+    files2 = sorted(p.relative_to(dir2) for p in Path(dir2).glob('**/*.nc'))
+
+    assert(len(files1) == nfiles)
+    assert(files1 == files2)
+
+    for fname in files1:
+        with xr.open_dataset(Path(dir1) / fname) as ds1, xr.open_dataset(Path(dir2) / fname) as ds2:
+            assert(ds1.identical(ds2))
+
+def test_transpose():
+
+    testfile = 'test/ocean_scalar.nc'
+
+    for outdir, opts in (('test/byvar', ''), ('test/bytime', '--transpose')):
+        splitvar.cli.main_parse_args(shlex.split('--overwrite {} -v ke_tot -v temp_global_ave -f 24MS -o {} {}'.format(opts, outdir, testfile)))
+
+    compare_outputs('test/byvar', 'test/bytime', 14)
+
+def test_jobs():
+
+    testfile = 'test/ocean_scalar.nc'
+
+    for outdir, jobs in (('test/serial', 1), ('test/jobs', 2)):
+        splitvar.cli.main_parse_args(shlex.split('--overwrite -j {} -v ke_tot -v temp_global_ave -f 24MS -o {} {}'.format(jobs, outdir, testfile)))
+
+    compare_outputs('test/serial', 'test/jobs', 14)
+
+    # Outputs in flight are limited to loadlimit bytes, so an output larger
+    # than the limit is only sent once every earlier output is written
+    ds = xr.open_dataset(testfile, decode_times=False)[['ke_tot']]
+    os.makedirs('test/limit', exist_ok=True)
+    written = []
+    def outputs(limit):
+        for i in range(6):
+            if limit is not None and i > 0:
+                assert(len(written) == i - 1)
+            yield ds, 'test/limit/limit{}.nc'.format(i)
+    for limit in (None, 1):
+        written = []
+        writevars(outputs(limit), jobs=2, callback=written.append, loadlimit=limit)
+        assert(len(written) == 6)
+    shutil.rmtree('test/limit')
+
+    # A failed write raises an exception and doesn't leave a partial file
+    ds = xr.open_dataset(testfile, decode_times=False)
+    fname = 'test/jobs/failed.nc'
+    with pytest.raises(ValueError):
+        writevars([(ds, fname)], jobs=2, engine='notanengine')
+    assert(not os.path.exists(fname))
+
+def test_workers():
+
+    testfile = 'test/ocean_scalar.nc'
+
+    for outdir, opts in (('test/serialworkers', ''), ('test/workers', '--workers 1 --threads-per-worker 2 --batch-size 3')):
+        splitvar.cli.main_parse_args(shlex.split('--overwrite {} -v ke_tot -f 24MS -o {} {}'.format(opts, outdir, testfile)))
+
+    compare_outputs('test/serialworkers', 'test/workers', 7)
+
+    with pytest.raises(SystemExit):
+        splitvar.cli.parse_args(shlex.split('-j 2 --workers 2 {}'.format(testfile)))
+
+def test_fileindex():
+
+    ds = xr.open_dataset('test/ocean_scalar.nc', decode_cf=False)
+    ds = ds[['ke_tot', 'temp_global_ave', 'time_bounds']]
+
+    outdir = Path('test') / 'fileindex'
+    outdir.mkdir(exist_ok=True)
+    files = []
+    # Write out of time order to check files are sorted
+    for start, end in ((100, 150), (0, 50), (50, 100)):
+        fname = str(outdir / 'part_{}.nc'.format(start))
+        ds.isel(time=slice(start, end)).to_netcdf(fname, unlimited_dims=['time'])
+        files.append(fname)
+
+    index = str(outdir / 'index.db')
+    if os.path.exists(index):
+        os.remove(index)
+
+    dsmf = open_files(files, 'time')
+
+    # First pass creates the index, second reads from it
+    for i in range(2):
+        dsindex = open_files(files, 'time', index=index)
+        assert(dsindex.identical(dsmf))
+        for var in dsmf.variables:
+            assert(dsindex[var].encoding == dsmf[var].encoding)
+            # Time bounds are stored in the index, so are already in memory
+            if var != 'time_bounds':
+                assert(dsindex[var].chunks == dsmf[var].chunks)
+
+    dsmf.close()
+    dsindex.close()
+
+    # Changed files are rescanned
+    ds.isel(time=slice(100, 140)).to_netcdf(files[0], unlimited_dims=['time'])
+    dsindex = open_files(files, 'time', index=index)
+    assert(dsindex.time.size == 140)
+    dsindex.close()
+
+    # Files which can't be simply concatenated fall back to open_mfdataset
+    ds = ds.isel(time=slice(0, 50))
+    ds['temp_global_ave'] = ds['temp_global_ave'].isel(time=0)
+    ds.to_netcdf(files[1], unlimited_dims=['time'])
+    records = indexfiles(files, index)
+    assert(datasetfromindex(records, 'time') is None)
+
+def test_timewindow():
+
+    ds = xr.open_dataset('test/ocean_scalar.nc', decode_cf=False)
+    ds = ds[['ke_tot', 'time_bounds']]
+
+    outdir = Path('test') / 'timewindow'
+    outdir.mkdir(exist_ok=True)
+    files = []
+    # Files span 0053-07 to 0057-08, 0057-09 to 0061-10 and 0061-11 to 0065-12
+    for start, end in ((0, 50), (50, 100), (100, 150)):
+        fname = str(outdir / 'part_{}.nc'.format(start))
+        ds.isel(time=slice(start, end)).to_netcdf(fname, unlimited_dims=['time'])
+        files.append(fname)
+
+    assert(selectfiles(files, 'time', '0058', '0058') == files[1:2])
+    assert(selectfiles(files, 'time', '0057-08', '0057-09') == files[0:2])
+    # Upper time bound is not included in the file
+    assert(selectfiles(files, 'time', '0057-09') == files[1:])
+    assert(selectfiles(files, 'time', None, '0057-08') == files[0:1])
+    assert(selectfiles(files, 'time', '0070') == [])
+
+    for name, opts in (('full', ''), ('window', '--start 0058 --end 0061')):
+        splitvar.cli.main_parse_args(shlex.split('--overwrite {} -f Y -o {} {}'.format(opts, outdir / name, ' '.join(files))))
+
+    full = outdir / 'full' / 'simname' / 'ke-tot'
+    window = outdir / 'window' / 'simname' / 'ke-tot'
+
+    assert(sorted(p.name for p in window.glob('*.nc')) == 
+        ['ke-tot_simname_{0:04d}01_{0:04d}12.nc'.format(year) for year in range(58, 62)])
+    for fname in window.glob('*.nc'):
+        with xr.open_dataset(fname) as ds1, xr.open_dataset(full / fname.name) as ds2:
+            assert(ds1.identical(ds2))
+
+def test_manifest():
+
+    testfile = 'test/ocean_scalar.nc'
+    outdir = Path('test') / 'manifest'
+    manifestfile = str(outdir / 'manifest.jsonl')
+    shutil.rmtree(str(outdir), ignore_errors=True)
+
+    def run(opts='', freq='24MS'):
+        splitvar.cli.main_parse_args(shlex.split('--manifest {} {} -v ke_tot -f {} -o {} {}'.format(manifestfile, opts, freq, outdir, testfile)))
+        return {p: p.stat().st_mtime_ns for p in outdir.glob('**/*.nc')}
+
+    # Simulate an output left half written by an interrupted run
+    partial = outdir / 'simname' / 'ke-tot' / 'ke-tot_simname_005307_005506.nc'
+    partial.parent.mkdir(parents=True)
+    partial.write_bytes(b'partial')
+
+    first = run()
+    assert(len(first) == 7)
+    assert(list(outdir.glob('**/*.tmp')) == [])
+
+    entries = readmanifest(manifestfile)
+    assert(len(entries) == 7)
+    for fname in first:
+        entry = entries[str(fname.resolve())]
+        assert(entry['size'] == fname.stat().st_size)
+        assert(entry['sha256'] == filechecksum(str(fname)))
+    with xr.open_dataset(partial) as ds:
+        assert('ke_tot' in ds)
+
+    # Completed outputs are not written again
+    assert(run() == first)
+
+    # A changed output is written again
+    fname = sorted(first)[-1]
+    with open(str(fname), 'ab') as f:
+        f.write(b'junk')
+    second = run()
+    assert([p for p in first if second[p] != first[p]] == [fname])
+
+    # Changing options which alter the outputs invalidates all of them
+    third = run('-d history')
+    assert(all(third[p] != second[p] for p in first))
+
+    # An output only partly inside a time window has fewer times, so is
+    # written again with all its times by a run without the window
+    shutil.rmtree(str(outdir))
+    cut = outdir / 'simname' / 'ke-tot' / 'ke-tot_simname_0058_0058.nc'
+    window = run('--timeformat %Y --start 0058-07', freq='Y')
+    with xr.open_dataset(cut) as ds:
+        assert(ds.sizes['time'] == 6)
+    full = run('--timeformat %Y', freq='Y')
+    assert([p for p in window if full[p] != window[p]] == [cut])
+    with xr.open_dataset(cut) as ds:
+        assert(ds.sizes['time'] == 12)
+
+def test_usebounds():
+
+    testfile = 'test/ocean_scalar.nc'
+
+    ds = open_files(testfile, 'time')
+    midpoint = bounds_midpoint(ds['time_bounds'])
+    # Bounds are not read until the midpoints are needed
+    assert(isinstance(midpoint.data, dask.array.Array))
+    expected = [(e.values - b.values)//2 + b.values for (b,e) in ds['time_bounds']]
+    assert(np.array_equal(midpoint.values, expected))
+
+    outdir = Path('test') / 'usebounds'
+    splitvar.cli.main_parse_args(shlex.split('--overwrite --usebounds -v ke_tot -f 24MS -o {} {}'.format(outdir, testfile)))
+
+    with xr.open_mfdataset(str(outdir / 'simname' / 'ke-tot' / '*.nc'), decode_times=False) as dsout:
+        assert(np.array_equal(dsout['time'].values, expected))
+
+def test_timeshift():
+
+    testfile = 'test/ocean_scalar.nc'
+
+    ds = open_files(testfile, 'time')
+    shifted = shift_time(ds.copy(), 365.)
+    for var in ('time', 'average_T1', 'average_T2'):
+        assert(np.array_equal(shifted[var].values, ds[var].values - 365.))
+        assert(shifted[var].attrs == ds[var].attrs)
+    # Data variables are shifted lazily
+    assert(isinstance(shifted['average_T1'].data, dask.array.Array))
+    assert(np.array_equal(shifted['ke_tot'].values, ds['ke_tot'].values))
+
+    outdir = Path('test') / 'timeshift'
+    splitvar.cli.main_parse_args(shlex.split('--overwrite --timeshift auto -v ke_tot -f 24MS -o {} {}'.format(outdir, testfile)))
+
+    with xr.open_mfdataset(str(outdir / 'simname' / 'ke-tot' / '*.nc'), decode_times=False) as dsout:
+        assert(np.array_equal(dsout['time'].values, ds['time'].values - ds['time'].values[0]))
+        assert(np.array_equal(dsout['average_T1'].values, ds['average_T1'].values - ds['time'].values[0]))
+
+def test_geospatialcache():
+
+    lat = xr.DataArray(np.linspace(-80, 80, 12).reshape(3, 4), dims=['y', 'x'], attrs={'units': 'degrees_north'})
+    lon = xr.DataArray(np.linspace(0, 330, 12).reshape(3, 4), dims=['y', 'x'], attrs={'units': 'degrees_east'})
+    # Longitude of a moving observation platform varies in time
+    track = xr.DataArray(np.arange(4.), dims=['time'], attrs={'units': 'degrees_east'})
+    ds = xr.Dataset({'temp': (['time', 'y', 'x'], np.zeros((4, 3, 4))), 'track': track}, 
+                    coords={'time': np.arange(4), 'lat': lat, 'lon': lon})
+
+    args = splitvar.cli.parse_args(['dummy.nc'])
+    cache = {}
+    for period, (trackmin, trackmax) in ((slice(0, 2), (0., 1.)), (slice(2, 4), (0., 3.))):
+        dsbytime = ds.isel(time=period).copy()
+        splitvar.cli.setoutputattrs(dsbytime, 'time', args, cache)
+        assert(dsbytime.attrs['geospatial_lat_min'] == -80.)
+        assert(dsbytime.attrs['geospatial_lat_max'] == 80.)
+        assert(dsbytime.attrs['geospatial_lon_min'] == trackmin)
+        assert(dsbytime.attrs['geospatial_lon_max'] == 330.)
+
+    assert(sorted(cache) == ['lat', 'lon'])
+
+    # Cached extents are not recomputed
+    cache['lat'] = (-10., 10.)
+    splitvar.cli.setoutputattrs(dsbytime, 'time', args, cache)
+    assert(dsbytime.attrs['geospatial_lat_min'] == -10.)
+
+    # The time coordinate need not be named after its dimension
+    ds = ds.rename({'time': 't'}).assign_coords(time=('t', np.arange(4)))
+    cache = {}
+    for period in (slice(0, 2), slice(2, 4)):
+        splitvar.cli.setoutputattrs(ds.isel(t=period).copy(), 'time', args, cache)
+    assert(sorted(cache) == ['lat', 'lon'])
+
+def test_transitiveclosure():
+
+    graph = {'a': ['b'], 'b': ['c'], 'c': ['b', 'd'], 'd': [], 'e': ['e'], 'f': ['a']}
+    reach = transitiveclosure(graph)
+
+    assert(reach['a'] == {'b', 'c', 'd'})
+    # Nodes in a cycle can reach themselves
+    assert(reach['b'] == {'b', 'c', 'd'})
+    assert(reach['d'] == set())
+    assert(reach['e'] == {'e'})
+    assert(reach['f'] == {'a', 'b', 'c', 'd'})
+
+    ds = xr.Dataset({'u': ('x', [0.], {'coordinates': 'LAT', 'cell_methods': 'x: mean u_v: sum'}),
+                     'u_v': ('x', [0.], {'ancillary_variables': 'u-bnds'}),
+                     'u-bnds': ('x', [0.]),
+                     'lat': ('x', [0.]),
+                     'LAT': ('x', [0.])},
+                    coords={'x': [0.]})
+
+    # Names are whole words, and matched ignoring case only if there is no exact match
+    assert(dependencygraph(ds)['u'] == ['LAT', 'x', 'u_v'])
+    assert(getdependents(ds)['u'] == ['u_v', 'u-bnds', 'LAT', 'x'])
+    assert(sorted(getdependentvars(ds, 'u')) == ['LAT', 'u-bnds', 'u_v', 'x'])
+
+def test_aggregate():
+
+    testfile = 'test/ocean_scalar.nc'
+    statistics = list(STATISTICS)
+
+    ds = xr.decode_cf(open_files(testfile, 'time'))
+    dsagg = resamplebytime(ds, 'ke_tot', '6MS', statistics=statistics)
+    # Lazily loaded and in memory data give identical results
+    assert(dsagg.compute().identical(resamplebytime(ds.load(), 'ke_tot', '6MS', statistics=statistics)))
+
+    resampler = ds['ke_tot'].resample(time='6MS')
+    for stat in statistics:
+        expected = getattr(resampler, stat)()
+        assert(np.allclose(dsagg[statvarname('ke_tot', stat)].values, expected.values, rtol=1e-6))
+        assert(np.array_equal(dsagg['time'].values, expected['time'].values))
+    assert(dsagg['ke_tot_max'].attrs['cell_methods'] == 'time: mean time: maximum')
+    assert(np.array_equal(dsagg['average_DT'].values, ds['average_DT'].resample(time='6MS').sum().values))
+
+    # Other axes are split so each group is reduced in chunks of at most chunksize bytes
+    data = dask.array.ones((24, 10, 6), chunks=(6, 10, 6))
+    counts = [12, 12]
+    for stat in statistics:
+        reduced = reduce_groups(data, 0, counts, stat, chunksize=12*6*8*2)
+        assert(reduced.chunks == ((1, 1), (2,) * 5, (6,)))
+        assert(np.allclose(reduced.compute(), reduce_groups(data.compute(), 0, counts, stat)))
+    assert(reduce_groups(data, 0, counts, 'mean', chunksize=12*8*4).chunks == ((1, 1), (1,) * 10, (4, 2)))
+
+    for outdir, opts in (('test/aggregate', ''), ('test/aggregatebytime', '--transpose')):
+        splitvar.cli.main_parse_args(shlex.split('--overwrite -cp {} --aggregate 6MS --statistic mean --statistic max -v ke_tot -v temp_global_ave -f 24MS -o {} {}'.format(opts, outdir, testfile)))
+
+    compare_outputs('test/aggregate', 'test/aggregatebytime', 14)
+
+    # Statistics are only calculated when aggregating
+    with pytest.raises(SystemExit):
+        splitvar.cli.parse_args(shlex.split('--statistic max {}'.format(testfile)))
+
+    with xr.open_dataset('test/aggregate/simname/ke-tot/ke-tot_simname_005307_005501.nc') as dsout:
+        assert('ke_tot' in dsout and 'ke_tot_max' in dsout and 'temp_global_ave' not in dsout)
+        assert(dsout.dims['time'] == 4)
+        assert(dsout['time_bounds'].values[0][0] == dsout['time'].values[0])
+        assert(dsout['time_bounds'].values[-1][1] == dsout['time_bounds'].values[-1][0] + datetime.timedelta(days=181))
+
+def test_streamaggregate():
+
+    testfile = 'test/ocean_scalar.nc'
+    statistics = list(STATISTICS)
+
+    # Chunks which don't align with the aggregation periods
+    ds = xr.decode_cf(open_files(testfile, 'time')).chunk({'time': 7})
+    expected = list(groupbytime(resamplebytime(ds, 'ke_tot', '6MS', statistics=statistics), '24MS'))
+    streamed = list(streamaggregate(ds, 'ke_tot', '6MS', '24MS', statistics=statistics))
+    assert(len(streamed) == len(expected))
+    for ds1, ds2 in zip(streamed, expected):
+        assert(ds1.identical(ds2.compute()))
+
+    # Outputs which aren't wanted are skipped
+    wanted = lambda dsbytime: dsbytime['time'].values[0].year != 57
+    streamed = list(streamaggregate(ds, 'ke_tot', '6MS', '24MS', statistics=statistics, wanted=wanted))
+    assert(len(streamed) == len(expected) - 1)
+
+    opts = '--overwrite -cp --aggregate 6MS --statistic mean --statistic std -v ke_tot -v temp_global_ave -f 24MS'
+    for outdir, stream in (('test/resampled', ''), ('test/streamed', '--stream'), ('test/streamedbytime', '--stream --transpose')):
+        splitvar.cli.main_parse_args(shlex.split('{} {} -o {} {}'.format(opts, stream, outdir, testfile)))
+
+    compare_outputs('test/resampled', 'test/streamed', 14)
+    compare_outputs('test/resampled', 'test/streamedbytime', 14)
+
+def test_planchunks():
+
+    ds = open_files('test/ocean_scalar.nc', 'time')
+    times = xr.decode_cf(ds[['time']])['time']
+
+    plan = planchunks(ds, 'time', ['24MS', '6MS'], 2**20)
+    chunked = applychunks(ds, plan)
+    # Chunk boundaries align with the aggregation periods
+    counts = timegroups(xr.decode_cf(ds[['time']]), '6MS', 'time')[1]
+    assert(set(np.cumsum(counts)) <= set(np.cumsum(chunked['ke_tot'].chunks[0])))
+    assert(chunked['ke_tot'].encoding == ds['ke_tot'].encoding)
+    assert(chunked.identical(ds))
+
+    # Time steps larger than the target are split along the other dimensions
+    ds = xr.Dataset({'temp': xr.Variable(('time', 'lat', 'lon'), dask.array.zeros((12, 100, 50), dtype='f4'))},
+                    coords={'time': times[:12].values})
+    ds['temp'].encoding['chunksizes'] = (1, 10, 50)
+    plan = planchunks(ds, 'time', ['MS'], 2000*4)
+    assert(plan['temp'] == {'time': (1,)*12, 'lat': 40, 'lon': 50})
+    plan = planchunks(ds, 'time', ['12MS'], 2**20)
+    assert(plan['temp'] == {'time': (12,), 'lat': 100, 'lon': 50})
+
+    # Chunks to read input files with are limited to the target
+    assert(readchunks(ds, 'time', 2000*4) == {'time': 1, 'lat': 40, 'lon': 50})
+    assert(readchunks(ds, 'time', 20000*5) == {'time': 5, 'lat': 100, 'lon': 50})
+
+def test_layout():
+
+    var = xr.Variable(('time', 'lat', 'lon'), np.zeros((365, 200, 400), dtype='f4'))
+    assert(layoutchunks(var, 'time', 'map', 2**20) == (1, 200, 400))
+    assert(layoutchunks(var, 'time', 'map', 2**18) == (1, 163, 400))
+    assert(layoutchunks(var, 'time', 'timeseries', 2**20) == (365, 18, 37))
+    assert(layoutchunks(var, 'time', 'balanced', 2**20) == (75, 41, 83))
+    # Same number of chunks read for a field and a time series
+    chunks = layoutchunks(var, 'time', 'auto', 2**20)
+    assert(abs(365 / chunks[0] - 200 * 400 / (chunks[1] * chunks[2])) < 2)
+    # Small and static variables are a single chunk
+    for layout in LAYOUTS:
+        assert(layoutchunks(xr.Variable(('time', 'nv'), np.zeros((365, 2))), 'time', layout) == (365, 2))
+        assert(layoutchunks(var[0], 'time', layout, 2**18) == (163, 400))
+    assert(layoutchunks(xr.Variable((), 0.), 'time', 'map') is None)
+
+    testfile = 'test/ocean_scalar.nc'
+    outdir = 'test/layout'
+    # By default the netCDF library chooses chunks of one time step
+    for layout in ('', '--layout timeseries'):
+        splitvar.cli.main_parse_args(shlex.split('--overwrite -cp {} --chunk-cache auto -v ke_tot -f 12MS -o {} {}'.format(layout, outdir, testfile)))
+        outputs = sorted(Path(outdir).glob('**/*.nc'))
+        assert(len(outputs) == 13)
+        for output in outputs:
+            with nc.Dataset(output) as f:
+                ntime = len(f.dimensions['time']) if layout else 1
+                assert(f.variables['ke_tot'].chunking() == [ntime, 1])
+        shutil.rmtree(outdir)
+
+def test_maxmemory():
+
+    assert(groupbysize({'a': 3, 'b': 3, 'c': 5, 'd': 1}, 6) == [['a', 'b'], ['c', 'd']])
+    assert(groupbysize({'a': 7, 'b': 1}, 6) == [['a'], ['b']])
+
+    budget = MemoryBudget(2**30, processes=1, threads=2, baseline=2**28)
+    assert(budget.available == 3 * 2**28)
+    assert(budget.chunktarget() == 3 * 2**28 // (4 * 2 * CHUNK_COPIES))
+    assert(budget.chunktarget(2**20) == 2**20)
+    assert(budget.loadlimit() == 3 * 2**27)
+    # The baseline is reserved for each worker process
+    budget = MemoryBudget(2**30, processes=2, threads=2, baseline=2**27)
+    assert(budget.available == 5 * 2**27)
+    assert(budget.loadlimit() == 5 * 2**25)
+    with pytest.raises(ValueError):
+        MemoryBudget(2**30, processes=4, baseline=2**28)
+    # One thread for each process unless specified
+    assert(MemoryBudget(2**30, baseline=2**28).chunktarget() == 3 * 2**28 // (4 * CHUNK_COPIES))
+
+    assert(peakrss() > 0)
+
+    testfile = 'test/ocean_scalar.nc'
+    for outdir, opts in (('test/byvar', ''), ('test/maxmemory', '--transpose --max-memory 8GB --chunk-cache auto')):
+        splitvar.cli.main_parse_args(shlex.split('--overwrite {} -v ke_tot -v temp_global_ave -f 24MS -o {} {}'.format(opts, outdir, testfile)))
+
+    compare_outputs('test/byvar', 'test/maxmemory', 14)
+
+def test_profile():
+
+    profile = RunProfile()
+    with profile.stage('outer'):
+        with profile.stage('inner'):
+            pass
+        assert(list(profile.iterate([1, 2], 'inner')) == [1, 2])
+    assert(profile.stages['inner']['calls'] == 4)
+    assert(profile.stages['outer']['calls'] == 1)
+    profile.add('outer', bytes=10)
+    profile.add('outer', bytes=5)
+    assert(profile.stages['outer']['bytes'] == 15)
+
+    testfile = 'test/ocean_scalar.nc'
+    outdir = 'test/profile'
+    report = os.path.join(outdir, 'profile.json')
+    os.makedirs(outdir, exist_ok=True)
+    splitvar.cli.main_parse_args(shlex.split('--overwrite -v ke_tot -v temp_global_ave -f 24MS --profile {} --profiler cprofile -o {} {}'.format(report, outdir, testfile)))
+
+    with open(report) as f:
+        report = json.load(f)
+    assert(report['outputs'] == 14)
+    assert(len(report['files']) == 14)
+    assert(report['stages']['write']['outputs'] == 14)
+    assert(report['stages']['open_files']['files'] == 1)
+    assert(report['bytes_written'] == sum(os.path.getsize(f['path']) for f in report['files']))
+    assert(report['nbytes'] == sum(f['nbytes'] for f in report['files']))
+    assert(report['nbytes'] == report['stages']['write']['nbytes'])
+    assert(sum(s['time'] for s in report['stages'].values()) <= report['time'])
+    assert(os.path.exists(os.path.join(outdir, 'profile.prof')))
+
+def test_progress(capsys):
+
+    stream = io.StringIO()
+    progress = Progress(total=4, stream=stream, interval=0)
+    assert(progress.remaining() is None)
+    progress.skip()
+    progress.update('test/ocean_scalar.nc')
+    assert(progress.done == 1)
+    assert(progress.bytes == os.path.getsize('test/ocean_scalar.nc'))
+    assert(progress.remaining() >= 0)
+    assert(progress.status().startswith('1/3 outputs (1 skipped)'))
+    assert('ETA' in progress.status())
+    # Not a terminal, so nothing is written to the stream directly
+    assert(stream.getvalue() == '')
+
+    testfile = 'test/ocean_scalar.nc'
+    cmd = '--overwrite -v ke_tot -f 24MS {} -o test/progress {}'
+    splitvar.cli.main_parse_args(shlex.split(cmd.format('', testfile)))
+    out, err = capsys.readouterr()
+    assert('Finished 7/7 outputs' in err)
+    # The contents of each output are only shown when debugging
+    assert('Dimensions' not in err)
+    splitvar.cli.main_parse_args(shlex.split(cmd.format('--log-level debug --no-progress', testfile)))
+    out, err = capsys.readouterr()
+    assert('Dimensions' in err)
+    assert('Finished' not in err)
+    splitvar.cli.main_parse_args(shlex.split(cmd.format('--log-level warning', testfile)))
+    out, err = capsys.readouterr()
+    assert('Splitting' not in err)
+
+    # Variables which don't vary in time have no outputs
+    ds = xr.decode_cf(open_files(testfile, 'time'))
+    ds['area'] = ('x', [1.])
+    assert(splitvar.cli.countoutputs(ds, ['ke_tot', 'area'], 'time', '24MS') == 7)
+
+def test_zarr():
+
+    pytest.importorskip('zarr')
+
+    testfile = 'test/ocean_scalar.nc'
+    outdir = Path('test') / 'zarr'
+    manifestfile = str(outdir / 'manifest.jsonl')
+    shutil.rmtree(str(outdir), ignore_errors=True)
+
+    splitvar.cli.main_parse_args(shlex.split('--overwrite -v ke_tot -v temp_global_ave -f 24MS -o test/byvar {}'.format(testfile)))
+    for opts in ('', '-j 2 --overwrite'):
+        splitvar.cli.main_parse_args(shlex.split('--format zarr --manifest {} {} -v ke_tot -v temp_global_ave -f 24MS -o {} {}'.format(
+            manifestfile, opts, outdir, testfile)))
+
+    stores = sorted(p.relative_to(outdir) for p in outdir.glob('**/*.zarr'))
+    files = sorted(p.relative_to('test/byvar') for p in Path('test/byvar').glob('**/*.nc'))
+    assert(len(stores) == 14)
+    assert(stores == [f.with_suffix('.zarr') for f in files])
+    assert(list(outdir.glob('**/*.tmp')) == [])
+
+    for fname in files:
+        with xr.open_dataset(Path('test/byvar') / fname) as ds:
+            store = str(outdir / fname.with_suffix('.zarr'))
+            assert(os.path.exists(os.path.join(store, '.zmetadata')))
+            assert(xr.open_zarr(store, consolidated=True).identical(ds))
+
+    entries = readmanifest(manifestfile)
+    for store in stores:
+        path = str((outdir / store).resolve())
+        assert(entries[path]['size'] == outputsize(path))
+        assert(entries[path]['sha256'] == filechecksum(path))
+
+def test_passthrough(capsys):
+
+    h5py = pytest.importorskip('h5py')
+    pytest.importorskip('h5netcdf')
+
+    # (file, start, stop) segments of an output with chunks of 2 times
+    assert(timealigned([(0, 2, 6), (1, 0, 4)], [6, 6], 2))
+    assert(not timealigned([(0, 1, 6)], [6], 2))
+    assert(timealigned([(0, 4, 5)], [5, 6], 2))
+    assert(not timealigned([(0, 4, 5), (1, 0, 2)], [5, 6], 2))
+
+    # Split the test file into inputs of 10 times, each chunked by 2 times
+    inputdir = Path('test') / 'passthrough_inputs'
+    shutil.rmtree(str(inputdir), ignore_errors=True)
+    inputdir.mkdir()
+    inputs = []
+    with xr.open_dataset('test/ocean_scalar.nc', decode_cf=False) as ds:
+        ds = ds[['ke_tot', 'temp_global_ave']]
+        for i in range(0, 40, 10):
+            path = str(inputdir / 'ocean_scalar_{:02d}.nc'.format(i))
+            encoding = {v: {'zlib': True, 'complevel': 5, 'chunksizes': (2, 1)} for v in ds.data_vars}
+            ds.isel(time=slice(i, i + 10)).to_netcdf(path, encoding=encoding, unlimited_dims=['time'])
+            inputs.append(path)
+
+    # 20 months per output, so outputs start and end on chunk boundaries
+    cmd = '--overwrite --log-level debug {} -v ke_tot -v temp_global_ave -f 600D -o {} {}'
+    splitvar.cli.main_parse_args(shlex.split(cmd.format('--no-passthrough', 'test/computed', ' '.join(inputs))))
+    out, err = capsys.readouterr()
+    assert('Copied' not in err)
+    splitvar.cli.main_parse_args(shlex.split(cmd.format('', 'test/copied', ' '.join(inputs))))
+    out, err = capsys.readouterr()
+    assert(err.count('Copied 10 chunks') == 4)
+
+    compare_outputs('test/computed', 'test/copied', 4)
+
+    # Inputs are concatenated in time order, so chunks are copied from the
+    # inputs in time order whatever order they are given in. Run in a new
+    # process, where the netCDF library hasn't been used yet, to check no
+    # HDF5 errors are printed
+    result = subprocess.run([sys.executable, '-m', 'splitvar.cli'] + 
+                            shlex.split(cmd.format('', 'test/reversed', ' '.join(inputs[::-1]))),
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    assert(result.returncode == 0)
+    assert(result.stderr.count('Copied 10 chunks') == 4)
+    assert('HDF5-DIAG' not in result.stderr)
+    compare_outputs('test/computed', 'test/reversed', 4)
+
+    # Nothing is copied from inputs whose times aren't those of the output
+    with xr.open_mfdataset(inputs) as ds:
+        index = ds.indexes['time']
+        sources = ChunkSources(inputs[::-1], 'time', index)
+        assert(sources.segments(ds.isel(time=slice(0, 20))) == [(3, 0, 10), (2, 0, 10)])
+        sources = ChunkSources(inputs, 'time', index, times=index.shift(1, 'D'))
+        assert(sources.segments(ds.isel(time=slice(0, 20))) is None)
+
+        # The chunks to copy for one output are not left in the encoding of
+        # the dataset it was selected from, where later outputs would find them
+        args = splitvar.cli.parse_args(shlex.split(cmd.format('', 'test/copied', ' '.join(inputs))))
+        sources = ChunkSources(inputs, 'time', index)
+        ds = decodevars(open_files(inputs, 'time'), 'time')
+        outputs = [(dsbytime, 'test/copied/{}.nc'.format(i)) for i, dsbytime in enumerate(groupbytime(ds, '600D'))]
+        for dsbytime, fpath in splitvar.cli.prepareoutputs(outputs, 'time', args, sources):
+            assert('chunksources' in dsbytime.encoding)
+        assert('chunksources' not in ds.encoding)
+
+    # Chunks are copied unchanged from the inputs
+    output = sorted(Path('test/copied').glob('**/ke-tot*.nc'))[0]
+    with h5py.File(inputs[1], 'r') as src, h5py.File(str(output), 'r') as dst:
+        assert(dst['ke_tot'].chunks == (2, 1))
+        assert(dst['ke_tot'].id.read_direct_chunk((10, 0)) == src['ke_tot'].id.read_direct_chunk((0, 0)))
+
+def test_codecs():
+
+    assert(parsecodec('zstd') == (None, 'zstd', DEFAULT_LEVELS['zstd']))
+    assert(parsecodec('ke_tot=zlib:1') == ('ke_tot', 'zlib', 1))
+    assert(parsecodecs(['zstd:9', 'ke_tot=none']) == {None: ('zstd', 9), 'ke_tot': ('none', 0)})
+    with pytest.raises(ValueError):
+        parsecodec('lzma')
+    with pytest.raises(SystemExit):
+        splitvar.cli.parse_args(['--codec', 'gzip', 'test/ocean_scalar.nc'])
+
+    h5py = pytest.importorskip('h5py')
+    pytest.importorskip('hdf5plugin')
+
+    testfile = 'test/ocean_scalar.nc'
+    splitvar.cli.main_parse_args(shlex.split('--overwrite -v ke_tot -v temp_global_ave -f 24MS -o test/byvar {}'.format(testfile)))
+    splitvar.cli.main_parse_args(shlex.split('--overwrite --codec zstd --codec ke_tot=zlib:1 -v ke_tot -v temp_global_ave -f 24MS -o test/codecs {}'.format(testfile)))
+
+    files = sorted(p.relative_to('test/byvar') for p in Path('test/byvar').glob('**/*.nc'))
+    assert(files == sorted(p.relative_to('test/codecs') for p in Path('test/codecs').glob('**/*.nc')))
+    for fname in files:
+        with xr.open_dataset(Path('test/byvar') / fname) as ds1, xr.open_dataset(Path('test/codecs') / fname, engine='h5netcdf') as ds2:
+            for name in ds1.variables:
+                assert(ds1[name].equals(ds2[name]))
+
+    # zlib is HDF5 filter 1, zstd is 32015
+    for fname in files:
+        with h5py.File(str(Path('test/codecs') / fname), 'r') as f:
+            for name in ('ke_tot', 'temp_global_ave'):
+                if name in f:
+                    filters = [filter for (filter, params) in filterpipeline(f[name])]
+                    assert((1 if name == 'ke_tot' else 32015) in filters)
+
+def test_precision():
+
+    assert(parsevariablespecs(['7', 'ke_tot=none'], keepbits) == {None: 7, 'ke_tot': None})
+    with pytest.raises(ValueError):
+        parsevariablespec('ke_tot=float16', packtype)
+    with pytest.raises(SystemExit):
+        splitvar.cli.parse_args(['--significant-digits', '0', 'test/ocean_scalar.nc'])
+
+    # Rounding errors are within half the last bit or digit kept, and
+    # ties are rounded to even
+    data = (np.random.default_rng(0).standard_normal(1000) * 10.**np.arange(-5, 5).repeat(100)).astype('float32')
+    data[:3] = [np.nan, np.inf, 0.]
+    finite = slice(3, None)
+    for nbits in (0, 7, 12):
+        rounded = bitround(data, nbits)
+        assert(np.isnan(rounded[0]) and rounded[1] == np.inf and rounded[2] == 0)
+        assert((np.abs(rounded - data)[finite] <= np.abs(data[finite]) * 2.**-(nbits + 1)).all())
+    for ndigits in (1, 3):
+        rounded = granularbitround(data, ndigits)
+        digit = 10.**(np.floor(np.log10(np.abs(data[finite]))) + 1 - ndigits)
+        assert((np.abs(rounded - data)[finite] <= digit / 2).all())
+    assert((bitround(np.array([1.5, 2.5, 3.5], dtype='float32'), 0) == [2, 2, 4]).all())
+
+    testfile = 'test/ocean_scalar.nc'
+    splitvar.cli.main_parse_args(shlex.split('--overwrite -v ke_tot -v temp_global_ave -f 24MS -o test/byvar {}'.format(testfile)))
+    splitvar.cli.main_parse_args(shlex.split('--overwrite --keep-bits 10 --keep-bits ke_tot=none --pack ke_tot=int16 -v ke_tot -v temp_global_ave -f 24MS -o test/precision {}'.format(testfile)))
+
+    files = sorted(p.relative_to('test/byvar') for p in Path('test/byvar').glob('**/*.nc'))
+    assert(files == sorted(p.relative_to('test/precision') for p in Path('test/precision').glob('**/*.nc')))
+    for fname in files:
+        with xr.open_dataset(Path('test/byvar') / fname) as ds1, xr.open_dataset(Path('test/precision') / fname) as ds2:
+            if 'ke_tot' in ds2:
+                var = ds2['ke_tot']
+                assert(var.encoding['dtype'] == 'int16')
+                assert('_QuantizeBitRoundNumberOfSignificantBits' not in var.attrs)
+                assert(np.allclose(var, ds1['ke_tot'], rtol=0, atol=var.encoding['scale_factor']))
+            else:
+                var = ds2['temp_global_ave']
+                assert(var.attrs['_QuantizeBitRoundNumberOfSignificantBits'] == 10)
+                assert(np.allclose(var, ds1['temp_global_ave'], rtol=2.**-11, atol=0))
+
+def test_decodevars():
+
+    # Packed data is written as stored, without being decoded
+    testfile = 'test/ocean_scalar.nc'
+    with xr.open_dataset(testfile) as ds:
+        ds = ds[['ke_tot', 'temp_global_ave']].load()
+    ds['ke_tot'][:3] = np.nan
+    packedfile = 'test/packed.nc'
+    ds.to_netcdf(packedfile, encoding={'ke_tot': {'dtype': 'int16', 'scale_factor': 0.1, 'add_offset': 3000.,
+                                                  '_FillValue': -32768}})
+
+    with xr.open_dataset(packedfile, decode_cf=False) as stored:
+        decoded = decodevars(stored, 'time')
+        assert(decoded['time'].dtype.kind == 'O')
+        assert(decoded['ke_tot'].dtype == 'int16')
+        assert(decoded['ke_tot'].attrs['scale_factor'] == 0.1)
+        assert((decoded['ke_tot'].values == stored['ke_tot'].values).all())
+        assert(decodevars(stored, 'time', ['ke_tot'])['ke_tot'].dtype.kind == 'f')
+
+        splitvar.cli.main_parse_args(shlex.split('--overwrite -v ke_tot -f 24MS -o test/packed {}'.format(packedfile)))
+        outputs = sorted(Path('test/packed').glob('**/*.nc'))
+        values = []
+        for fname in outputs:
+            with xr.open_dataset(fname, decode_cf=False) as ds:
+                assert(ds['ke_tot'].dtype == 'int16')
+                assert(ds['ke_tot'].attrs['_FillValue'] == -32768)
+                values.append(ds['ke_tot'].values)
+        assert((np.concatenate(values) == stored['ke_tot'].values).all())